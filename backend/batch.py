@@ -0,0 +1,104 @@
+"""
+Run a JSONL file of citizen questions through the RAG pipeline without a
+server, e.g. for nightly QA jobs. Same pipeline and batching as POST /batch
+(see rag/batch.py).
+
+Each input line is {"id": ..., "message": ..., "city": ...}; each output
+line is {"id", "city", "result" or "error", "latency_ms", "pipeline_ms"},
+plus "duplicate_of" for questions answered by an identical or near-identical
+one. Results are written as soon as they are ready, so their order differs
+from the input. A summary (throughput, latency percentiles) goes to stderr.
+
+Usage (from the backend directory):
+    python batch.py questions.jsonl --output answers.jsonl --concurrency 32
+    cat questions.jsonl | python batch.py - > answers.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import main as application
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def run(args, lines, output):
+    from rag.batch import parse_items, run_batch
+    from rag.llm_client import close_llm_client
+
+    items, errors = parse_items(lines)
+    for step in (
+        application.load_llm_client,
+        application.load_model,
+        application.load_index,
+        application.load_booking,
+    ):
+        step()
+
+    start = time.perf_counter()
+    latencies, executions, failed = [], 0, len(errors)
+    for error in errors:
+        output.write(json.dumps(error, ensure_ascii=False) + "\n")
+    try:
+        async for result in run_batch(
+            items,
+            application.vectorstore,
+            application.router,
+            concurrency=args.concurrency,
+            dedup_similarity=args.dedup_similarity,
+        ):
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            latencies.append(result["latency_ms"])
+            executions += "duplicate_of" not in result
+            failed += "error" in result
+    finally:
+        await close_llm_client()
+        application.booking_store.close()
+
+    elapsed = time.perf_counter() - start
+    total = len(items) + len(errors)
+    print(
+        f"{total} questions ({failed} failed, {executions} pipeline runs) "
+        f"in {elapsed:.1f}s: {total / elapsed:.1f} questions/s, "
+        f"latency p50 {percentile(latencies, 50):.0f} ms, "
+        f"p95 {percentile(latencies, 95):.0f} ms, p99 {percentile(latencies, 99):.0f} ms",
+        file=sys.stderr,
+    )
+
+
+def main():
+    from rag.batch import BATCH_CONCURRENCY, BATCH_DEDUP_SIMILARITY
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("input", help="JSONL file, or - for stdin")
+    parser.add_argument("--output", help="JSONL file (default: stdout)")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument(
+        "--dedup-similarity", type=float, default=BATCH_DEDUP_SIMILARITY
+    )
+    args = parser.parse_args()
+
+    source = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    with source:
+        lines = source.readlines()
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        asyncio.run(run(args, lines, output))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Throughput delle richieste in blocco (rag/batch.py, POST /batch e
+batch.py) rispetto all'invio di una richiesta alla volta, come fa un client
+che scorre le domande sul websocket.
+
+Le richieste sono quelle di benchmarks/data/queries.jsonl ripetute
+--repeat volte con piccole varianti (maiuscole, punteggiatura, saluti),
+come in un export del contact centre (con --unique ogni richiesta
+riceve un numero di pratica diverso). Il modello è lo stub locale
+(benchmarks/stub_llm.py), la cache semantica è disattivata.
+
+Scenari:
+- sequential: run_handler su una richiesta alla volta (le prime
+  --sequential richieste, il throughput vale anche per le altre);
+- batch: run_batch con --concurrency pipeline in parallelo, unendo solo le
+  richieste uguali a meno di maiuscole e punteggiatura;
+- batch+similar: come batch, unendo anche le richieste quasi uguali
+  (BATCH_DEDUP_SIMILARITY).
+
+Uso (dalla cartella backend):
+    python -m benchmarks.batch_throughput --repeat 25 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from benchmarks import stub_llm
+
+VARIANTS = (
+    "{query}",
+    "{lower}",
+    "{query}?",
+    "Buongiorno, {lower}",
+    "{query} Grazie.",
+)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def build_items(path, repeat, unique=False):
+    with open(path, "r", encoding="utf-8") as file:
+        rows = [json.loads(line) for line in file if line.strip()]
+    items = []
+    for round_ in range(repeat):
+        template = VARIANTS[round_ % len(VARIANTS)]
+        for row in rows:
+            query = row["query"]
+            message = template.format(query=query, lower=query.lower())
+            if unique:
+                message += f" (pratica {len(items)})"
+            items.append({"id": len(items), "message": message, "city": row["city"]})
+    return items
+
+
+async def sequential(items, vectorstore, router):
+    from rag.batch import history
+    from rag.chain import run_handler
+
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        item_start = time.perf_counter()
+        await run_handler(history(item["message"]), vectorstore, item["city"], None, router)
+        latencies.append(time.perf_counter() - item_start)
+    return {
+        "elapsed": time.perf_counter() - start,
+        "items": len(items),
+        "runs": len(items),
+        "latencies": latencies,
+    }
+
+
+async def batch(items, vectorstore, router, concurrency, similarity):
+    from rag.batch import run_batch
+
+    latencies, runs, errors = [], 0, 0
+    start = time.perf_counter()
+    async for result in run_batch(
+        items, vectorstore, router, concurrency=concurrency, dedup_similarity=similarity
+    ):
+        latencies.append(result["latency_ms"] / 1000)
+        runs += "duplicate_of" not in result
+        errors += "error" in result
+    if errors:
+        print(f"  {errors} richieste con errore")
+    return {
+        "elapsed": time.perf_counter() - start,
+        "items": len(items),
+        "runs": runs,
+        "latencies": latencies,
+    }
+
+
+async def run(args):
+    from init_db import load_documents_from_directory
+    from rag.batch import BATCH_DEDUP_SIMILARITY
+    from rag.catalogue import ServiceCatalogue
+    from rag.llm_client import close_llm_client, init_llm_client
+    from rag.router import IntentRouter
+    from rag.vec_db import ChromaDB
+
+    items = build_items(args.queries, args.repeat, args.unique)
+    init_llm_client()
+    with tempfile.TemporaryDirectory() as persist_directory:
+        catalogue = ServiceCatalogue()
+        vectorstore = ChromaDB(
+            load_documents_from_directory(args.documents, catalogue),
+            persist_directory=persist_directory,
+            catalogue=catalogue,
+        )
+        router = IntentRouter(catalogue, vectorstore.embeddings) if args.router else None
+        # Riscaldamento del modello di embedding e delle connessioni
+        await sequential(items[:4], vectorstore, router)
+
+        print(
+            f"{len(items)} richieste, stub LLM {args.llm_latency * 1000:.0f} ms, "
+            f"router {'attivo' if router else 'disattivato'}"
+        )
+        print(
+            f"{'scenario':>14} {'richieste':>9} {'esecuzioni':>10} {'rich./s':>8} "
+            f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+        )
+        scenarios = [
+            ("sequential", sequential(items[: args.sequential], vectorstore, router)),
+            ("batch", batch(items, vectorstore, router, args.concurrency, 2.0)),
+            (
+                "batch+similar",
+                batch(items, vectorstore, router, args.concurrency, BATCH_DEDUP_SIMILARITY),
+            ),
+        ]
+        for name, scenario in scenarios:
+            stats = await scenario
+            latencies = [latency * 1000 for latency in stats["latencies"]]
+            print(
+                f"{name:>14} {stats['items']:>9} {stats['runs']:>10} "
+                f"{stats['items'] / stats['elapsed']:>8.1f} "
+                f"{statistics.median(latencies):>8.0f} {percentile(latencies, 95):>8.0f} "
+                f"{percentile(latencies, 99):>8.0f}"
+            )
+    await close_llm_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--queries", default="./benchmarks/data/queries.jsonl")
+    parser.add_argument("--documents", default="./documents")
+    parser.add_argument("--repeat", type=int, default=25)
+    parser.add_argument("--sequential", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument(
+        "--unique", action="store_true",
+        help="aggiunge un numero di pratica: nessuna richiesta è uguale a un'altra",
+    )
+    parser.add_argument(
+        "--no-router", dest="router", action="store_false",
+        help="tutte le richieste passano dal modello",
+    )
+    args = parser.parse_args()
+
+    stub_llm.start_in_thread(args.port, args.llm_latency)
+    os.environ["LLM_BASE_URL"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ.setdefault("API_KEY", "stub")
+    # Ogni richiesta deve percorrere l'intera pipeline
+    os.environ["SEMANTIC_CACHE_ENABLED"] = "0"
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
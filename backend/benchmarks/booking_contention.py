@@ -0,0 +1,123 @@
+"""
+Contesa sulle prenotazioni: migliaia di richieste simultanee sulla stessa
+fascia oraria.
+
+Crea un database temporaneo con una sola fascia di capienza --capacity e
+lancia --requests prenotazioni contemporanee da --threads thread in ognuno
+di --processes processi (ogni processo ha il proprio BookingStore sullo
+stesso file, come più worker uvicorn). Verifica che le prenotazioni riuscite
+siano esattamente pari alla capienza e riporta throughput e latenze.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.booking_contention --requests 5000 --threads 64 --processes 4
+"""
+
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rag.booking import BookingStore, SlotUnavailable
+from rag.catalogue import ServiceRecord
+
+SLOT = ("roma", "passaporto", "2024-12-07", "09.00-10.00")
+
+
+def seed(path, capacity):
+    record = ServiceRecord(
+        id="benchmark",
+        comune=SLOT[0],
+        service=SLOT[1],
+        page_content="passaporto",
+        info="",
+        date_orari={SLOT[2]: [SLOT[3]]},
+        need_to_do=[],
+    )
+    store = BookingStore(path, capacity)
+    store.seed([record])
+    store.close()
+
+
+def run_worker(path, capacity, requests, threads, barrier, results):
+    store = BookingStore(path, capacity)
+    latencies = []
+    counts = {"ok": 0, "conflict": 0}
+    lock = threading.Lock()
+
+    def reserve(i):
+        start = time.perf_counter()
+        try:
+            store.reserve(*SLOT, citizen=f"{os.getpid()}-{i}")
+            outcome = "ok"
+        except SlotUnavailable:
+            outcome = "conflict"
+        elapsed = time.perf_counter() - start
+        with lock:
+            counts[outcome] += 1
+            latencies.append(elapsed)
+
+    barrier.wait()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(reserve, range(requests)))
+    store.close()
+    results.put((counts, latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000, help="totale")
+    parser.add_argument("--threads", type=int, default=64, help="per processo")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--capacity", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bookings.sqlite3")
+        seed(path, args.capacity)
+
+        barrier = multiprocessing.Barrier(args.processes + 1)
+        results = multiprocessing.Queue()
+        per_process = args.requests // args.processes
+        workers = [
+            multiprocessing.Process(
+                target=run_worker,
+                args=(path, args.capacity, per_process, args.threads, barrier, results),
+            )
+            for _ in range(args.processes)
+        ]
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        start = time.perf_counter()
+        collected = [results.get() for _ in workers]
+        elapsed = time.perf_counter() - start
+        for worker in workers:
+            worker.join()
+
+        ok = sum(counts["ok"] for counts, _ in collected)
+        conflicts = sum(counts["conflict"] for counts, _ in collected)
+        latencies = sorted(l for _, values in collected for l in values)
+        conn = sqlite3.connect(path)
+        reserved, rows = conn.execute(
+            "SELECT reserved, (SELECT COUNT(*) FROM reservations) FROM slots"
+        ).fetchone()
+        conn.close()
+
+    print(f"richieste      {ok + conflicts}")
+    print(f"riuscite       {ok} (capienza {args.capacity})")
+    print(f"rifiutate      {conflicts}")
+    print(f"nel database   reserved={reserved}, prenotazioni={rows}")
+    print(f"throughput     {(ok + conflicts) / elapsed:.0f} richieste/s")
+    print(f"p50 / p99 ms   {statistics.median(latencies) * 1000:.3f} / "
+          f"{latencies[int(0.99 * (len(latencies) - 1))] * 1000:.3f}")
+    if ok != args.capacity or reserved != args.capacity or rows != args.capacity:
+        raise SystemExit("ERRORE: la fascia è stata prenotata oltre la capienza")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Token in input al modello con il contesto completo (PROMPT_CONTEXT=full) e
+con quello compatto (compact), sul set di richieste
+benchmarks/data/queries.jsonl, e quante informazioni essenziali restano nel
+contesto:
+
+- indirizzi e sportelli presenti nel testo del servizio;
+- la prima data disponibile, per le richieste di prenotazione;
+- i documenti necessari, per le richieste di informazioni.
+
+Ogni richiesta è valutata come secondo turno di una conversazione (la
+cronologia contiene un turno precedente sullo stesso servizio): i token
+contano la cronologia e la descrizione del servizio, il prompt di sistema è
+uguale nei due casi.
+
+Con --answers le risposte vengono generate dal modello configurato
+(LLM_BASE_URL, API_KEY) con entrambi i contesti e si confronta quante citano
+l'indirizzo del servizio (e la prima data, per le prenotazioni).
+
+Uso (dalla cartella backend):
+    python -m benchmarks.context_budget --budgets 150 300 500
+    python -m benchmarks.context_budget --answers
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+
+from rag import context
+from rag.catalogue import ServiceRecord, service_from_filename
+
+DEFAULT_QUERIES = "./benchmarks/data/queries.jsonl"
+DOCUMENTS_DIR = "./documents"
+
+_ADDRESS = re.compile(
+    r"\b(?:[Vv]ia|[Vv]iale|[Pp]iazza(?:le)?|[Cc]orso|[Ll]argo)"
+    r"(?:[ \t]+(?:[A-ZÀ-Ý][\w']*|\d+))+"
+)
+_PREVIOUS_TURN = "human asked: buongiorno, mi serve un'informazione\n"
+
+
+def load_cases(path, documents_dir):
+    cases = []
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if row["document"] is None:
+                continue
+            filepath = os.path.join(documents_dir, row["document"])
+            with open(filepath, "r", encoding="utf-8") as document:
+                data = json.load(document)
+            row["record"] = ServiceRecord.from_raw(
+                data["page_content"], data["metadata"], service_from_filename(filepath)
+            )
+            cases.append(row)
+    return cases
+
+
+def previous_answer(record):
+    """Risultato di un turno precedente, come lo restituisce run_handler."""
+    return {
+        "llm_response": {"info": context.truncate_tokens(record.info, 80), "is_info": True},
+        "response": record.date_orari,
+        "info": record.need_to_do,
+    }
+
+
+def prompt_for(case, mode, budget):
+    """(cronologia, contesto del servizio) come arrivano al modello."""
+    record = case["record"]
+    history = (
+        _PREVIOUS_TURN
+        + context.history_entry(previous_answer(record), mode)
+        + f"human asked: {case['query']}\n"
+    )
+    prompt = context.build_history(history, mode=mode)
+    return prompt, context.build_record_context(record, case["query"], budget, mode)
+
+
+def expected_facts(case):
+    record = case["record"]
+    facts = {"address": sorted({a.lower() for a in _ADDRESS.findall(record.info)})}
+    if case["intent"] == "booking" and record.date_orari:
+        facts["first_date"] = [min(record.date_orari)]
+    if case["intent"] == "info":
+        facts["need_to_do"] = [item.lower() for item in record.need_to_do]
+    return facts
+
+
+def retained(facts, text):
+    text = " ".join(text.lower().split())
+    return {
+        name: sum(value in text for value in values) / len(values)
+        for name, values in facts.items()
+        if values
+    }
+
+
+def evaluate(cases, mode, budget):
+    tokens = []
+    retention = {}
+    intent_hits = 0
+    for case in cases:
+        prompt, record_context = prompt_for(case, mode, budget)
+        tokens.append(
+            context.count_tokens(prompt) + context.count_tokens(record_context)
+        )
+        for name, value in retained(expected_facts(case), record_context).items():
+            retention.setdefault(name, []).append(value)
+        intent_hits += context.detect_intent(case["query"])[0] == case["intent"]
+    return {
+        "tokens_mean": statistics.mean(tokens),
+        "tokens_p95": sorted(tokens)[int(0.95 * (len(tokens) - 1))],
+        "retention": {name: statistics.mean(v) for name, v in retention.items()},
+        "intent_accuracy": intent_hits / len(cases),
+    }
+
+
+async def compare_answers(cases, budget):
+    """Genera le risposte con i due contesti e misura quante citano i fatti."""
+    from rag import metrics
+    from rag.chain import LlamaChromaHandler
+
+    handler = LlamaChromaHandler(vectorstore=None)
+    results = {}
+    for mode in ("full", "compact"):
+        mentions = {}
+        prompt_tokens = []
+        for case in cases:
+            trace = metrics.start_request()
+            prompt, record_context = prompt_for(case, mode, budget)
+            answer = await handler.send_response(prompt, record_context)
+            prompt_tokens.append(sum(trace.prompt_tokens.values()))
+            text = answer.get("info", "") if isinstance(answer, dict) else str(answer)
+            facts = expected_facts(case)
+            facts.pop("need_to_do", None)  # la risposta non li elenca tutti
+            for name, value in retained(facts, text).items():
+                mentions.setdefault(name, []).append(value > 0)
+        results[mode] = {
+            "prompt_tokens_mean": statistics.mean(prompt_tokens),
+            "mentions": {name: statistics.mean(v) for name, v in mentions.items()},
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--queries", default=DEFAULT_QUERIES)
+    parser.add_argument("--documents", default=DOCUMENTS_DIR)
+    parser.add_argument(
+        "--budgets", type=int, nargs="+", default=[context.CONTEXT_TOKEN_BUDGET]
+    )
+    parser.add_argument("--answers", action="store_true")
+    args = parser.parse_args()
+
+    cases = load_cases(args.queries, args.documents)
+    full = evaluate(cases, "full", None)
+    print(f"{len(cases)} richieste con un servizio atteso")
+    print(
+        f"{'contesto':>14} {'token medi':>11} {'p95':>6} {'riduzione':>10} "
+        f"{'indirizzi':>10} {'1a data':>8} {'documenti':>10}"
+    )
+    rows = [("full", full)] + [
+        (f"compact {budget}", evaluate(cases, "compact", budget))
+        for budget in args.budgets
+    ]
+    for name, stats in rows:
+        retention = stats["retention"]
+        print(
+            f"{name:>14} {stats['tokens_mean']:>11.0f} {stats['tokens_p95']:>6} "
+            f"{1 - stats['tokens_mean'] / full['tokens_mean']:>10.0%} "
+            f"{retention.get('address', float('nan')):>10.0%} "
+            f"{retention.get('first_date', float('nan')):>8.0%} "
+            f"{retention.get('need_to_do', float('nan')):>10.0%}"
+        )
+    print(f"intento riconosciuto: {rows[-1][1]['intent_accuracy']:.0%}")
+
+    if args.answers:
+        results = asyncio.run(compare_answers(cases, args.budgets[-1]))
+        for mode, stats in results.items():
+            mentions = ", ".join(
+                f"{name} {value:.0%}" for name, value in stats["mentions"].items()
+            )
+            print(
+                f"{mode:>8}: {stats['prompt_tokens_mean']:.0f} token in input, "
+                f"risposte che citano: {mentions}"
+            )
+
+
+if __name__ == "__main__":
+    main()
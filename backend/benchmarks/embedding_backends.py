@@ -0,0 +1,187 @@
+"""
+Backend degli embedding (EMBEDDING_BACKEND): torch (sentence-transformers
+fp32), onnx e onnx-int8 (rag/onnx_embeddings.py).
+
+Ogni backend viene caricato in un processo separato, di cui si misurano:
+- avvio: caricamento del modello e primo embedding;
+- memoria: RSS del processo dopo l'avvio e incremento dovuto al modello;
+- latenza di embed_query (p50/p99) sulle richieste di
+  benchmarks/data/queries.jsonl e tempo per testo in batch da 32.
+
+Verifica poi che i risultati del recupero coincidano con il primo backend
+(il riferimento): per ogni richiesta si cerca il servizio più simile tra
+quelli del suo comune in backend/documents, e si confrontano servizio
+trovato e similarità coseno tra i vettori delle richieste. Se la
+concordanza è sotto --min-agreement o la similarità sotto --min-cosine il
+comando termina con codice 1.
+
+Prima va esportato il modello: python -m rag.onnx_embeddings export
+
+Uso (dalla cartella backend):
+    python -m benchmarks.embedding_backends --backends torch onnx onnx-int8 --threads 1
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.intent_router import DEFAULT_QUERIES, DOCUMENTS_DIR, load_catalogue
+
+
+def rss_mb():
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def load_texts(queries_path, documents_dir):
+    with open(queries_path, "r", encoding="utf-8") as file:
+        queries = [json.loads(line) for line in file if line.strip()]
+    records = load_catalogue(documents_dir).services()
+    return queries, records
+
+
+def child(args):
+    """Misure di un singolo backend, eseguite nel processo figlio."""
+    from rag.vec_db import load_embeddings
+
+    queries, records = load_texts(args.queries, args.documents)
+    texts = [q["query"] for q in queries]
+    before = rss_mb()
+
+    start = time.perf_counter()
+    embeddings = load_embeddings(args.child)
+    embeddings.embed_query(texts[0])
+    startup = time.perf_counter() - start
+    after = rss_mb()
+
+    latencies = []
+    for _ in range(args.repeat):
+        for text in texts:
+            start = time.perf_counter()
+            embeddings.embed_query(text)
+            latencies.append(time.perf_counter() - start)
+    batch = texts[:32]
+    start = time.perf_counter()
+    embeddings.embed_documents(batch)
+    batch_per_text = (time.perf_counter() - start) / len(batch)
+
+    np.savez(
+        args.vectors,
+        queries=np.asarray(embeddings.embed_documents(texts), dtype=np.float32),
+        documents=np.asarray(
+            embeddings.embed_documents([r.page_content for r in records]), dtype=np.float32
+        ),
+    )
+    latencies.sort()
+    print(
+        json.dumps(
+            {
+                "startup_s": startup,
+                "rss_mb": rss_mb(),
+                "model_rss_mb": after - before,
+                "p50_ms": statistics.median(latencies) * 1000,
+                "p99_ms": latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+                "batch_ms": batch_per_text * 1000,
+            }
+        )
+    )
+
+
+def run_backend(backend, args, vectors):
+    env = dict(os.environ)
+    if args.threads:
+        env["ONNX_THREADS"] = str(args.threads)
+        env["OMP_NUM_THREADS"] = str(args.threads)
+    output = subprocess.run(
+        [
+            sys.executable, "-m", "benchmarks.embedding_backends",
+            "--child", backend, "--vectors", vectors,
+            "--queries", args.queries, "--documents", args.documents,
+            "--repeat", str(args.repeat),
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=env,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def top_services(vectors, queries, records):
+    """Indice del servizio più simile a ogni richiesta, tra quelli del suo comune."""
+    scores = vectors["queries"] @ vectors["documents"].T
+    found = []
+    for row, query in zip(scores, queries):
+        candidates = [i for i, r in enumerate(records) if r.comune == query["city"]]
+        found.append(max(candidates, key=lambda i: row[i]) if candidates else None)
+    return found
+
+
+def parity(reference, vectors, queries, records):
+    cosine = np.sum(reference["queries"] * vectors["queries"], axis=1)
+    expected = top_services(reference, queries, records)
+    found = top_services(vectors, queries, records)
+    return {
+        "agreement": sum(a == b for a, b in zip(expected, found)) / len(queries),
+        "cosine_min": float(cosine.min()),
+        "cosine_mean": float(cosine.mean()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx", "onnx-int8"])
+    parser.add_argument("--queries", default=DEFAULT_QUERIES)
+    parser.add_argument("--documents", default=DOCUMENTS_DIR)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--min-agreement", type=float, default=0.95)
+    parser.add_argument("--min-cosine", type=float, default=0.98)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--vectors", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    queries, records = load_texts(args.queries, args.documents)
+    print(f"{len(queries)} richieste, {len(records)} servizi")
+    print(
+        f"{'backend':>10} {'avvio s':>8} {'RSS MB':>7} {'modello MB':>11} "
+        f"{'p50 ms':>7} {'p99 ms':>7} {'batch ms':>9} {'concordanza':>12} {'coseno min':>11}"
+    )
+    ok = True
+    reference = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in args.backends:
+            path = os.path.join(tmp, f"{backend}.npz")
+            stats = run_backend(backend, args, path)
+            vectors = dict(np.load(path))
+            if reference is None:
+                reference = vectors
+            check = parity(reference, vectors, queries, records)
+            ok &= (
+                check["agreement"] >= args.min_agreement
+                and check["cosine_min"] >= args.min_cosine
+            )
+            print(
+                f"{backend:>10} {stats['startup_s']:>8.2f} {stats['rss_mb']:>7.0f} "
+                f"{stats['model_rss_mb']:>11.0f} {stats['p50_ms']:>7.2f} "
+                f"{stats['p99_ms']:>7.2f} {stats['batch_ms']:>9.2f} "
+                f"{check['agreement']:>12.0%} {check['cosine_min']:>11.4f}"
+            )
+    print(f"parità con {args.backends[0]}: {'ok' if ok else 'FALLITA'}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
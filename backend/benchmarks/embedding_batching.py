@@ -0,0 +1,79 @@
+"""
+Throughput degli embedding delle query al variare della finestra di batching.
+
+Un numero fisso di client concorrenti richiede embedding delle query di
+benchmarks/data/queries.jsonl; per ogni finestra (ms) si misurano embedding/s
+e latenza p50/p99 di EmbeddingBatcher, confrontati con una chiamata al
+modello per richiesta ("none").
+
+Uso (dalla cartella backend):
+    python -m benchmarks.embedding_batching --concurrency 64 --windows 0 1 2 5 10
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from rag.vec_db import EmbeddingBatcher, _search_executor, load_embeddings
+
+
+async def run_clients(embed, queries, concurrency, requests):
+    latencies = []
+    counter = iter(range(requests))
+
+    async def client(offset):
+        for i in counter:
+            text = f"{queries[(i + offset) % len(queries)]} {i}"
+            start = time.perf_counter()
+            await embed(text)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(n) for n in range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+async def run(args):
+    embeddings = load_embeddings()  # backend scelto da EMBEDDING_BACKEND
+    with open(args.queries, "r", encoding="utf-8") as file:
+        queries = [json.loads(line)["query"] for line in file if line.strip()]
+    embeddings.embed_documents(queries)  # riscaldamento
+
+    loop = asyncio.get_running_loop()
+
+    async def unbatched(text):
+        return await loop.run_in_executor(_search_executor, embeddings.embed_query, text)
+
+    print(f"{'window':>8} {'emb/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for window in ["none"] + args.windows:
+        if window == "none":
+            embed = unbatched
+        else:
+            embed = EmbeddingBatcher(
+                embeddings, max_batch_size=args.batch_size, max_wait_ms=window
+            ).embed
+        latencies, elapsed = await run_clients(
+            embed, queries, args.concurrency, args.requests
+        )
+        latencies.sort()
+        print(
+            f"{window:>8} {len(latencies) / elapsed:>8.0f} "
+            f"{statistics.median(latencies) * 1000:>8.1f} "
+            f"{latencies[int(0.99 * (len(latencies) - 1))] * 1000:>8.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 1, 2, 5, 10])
+    parser.add_argument("--queries", default="./benchmarks/data/queries.jsonl")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Ricerca ibrida (BM25 per comune + embedding, rag/lexical_index.py) contro
+la sola ricerca su Chroma, sul set etichettato benchmarks/data/queries.jsonl:
+recall@1 sulle richieste con un documento atteso, falsi positivi su quelle
+senza, quota di richieste risolte dalla scorciatoia lessicale (senza
+embedding) e latenza di aget_from_chroma.
+
+Con --shortcut-scores, --weights e --max-distances prova tutte le
+combinazioni delle soglie, per tararle sul modello di embedding in uso
+(LEXICAL_SHORTCUT_SCORE, HYBRID_DENSE_WEIGHT, SEARCH_MAX_DISTANCE).
+
+Uso (dalla cartella backend):
+    python -m benchmarks.hybrid_retrieval
+    python -m benchmarks.hybrid_retrieval --shortcut-scores 1.5 2.5 4 --weights 0.5 0.7 1.0
+"""
+
+import argparse
+import asyncio
+import itertools
+import statistics
+import tempfile
+import time
+
+from benchmarks.retrieval_strategies import load_labelled_queries
+from init_db import load_documents_from_directory
+from rag import vec_db
+from rag.catalogue import ServiceCatalogue
+from rag.lexical_index import (
+    HYBRID_DENSE_WEIGHT,
+    LEXICAL_SHORTCUT_SCORE,
+    LexicalIndex,
+)
+from rag.retrieval import heuristic_rewrite
+from rag.vec_db import SEARCH_MAX_DISTANCE, ChromaDB, document_id
+
+
+async def evaluate(vectorstore, queries, rewrite, repeat):
+    hits, positives, false_positives, negatives, shortcuts = 0, 0, 0, 0, 0
+    latencies = []
+    for query in queries:
+        text = heuristic_rewrite(query["query"]) if rewrite else query["query"]
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results = await vectorstore.aget_from_chroma(text, query["city"])
+            latencies.append(time.perf_counter() - start)
+
+        found = document_id(results[0][0]) if results else None
+        shortcuts += vectorstore.lexical_search(text, query["city"])[1] is not None
+        if query["expected_id"] is None:
+            negatives += 1
+            false_positives += found is not None
+        else:
+            positives += 1
+            hits += found == query["expected_id"]
+
+    latencies.sort()
+    return {
+        "recall@1": hits / positives if positives else 0.0,
+        "false_positives": f"{false_positives}/{negatives}",
+        "shortcut": shortcuts / len(queries),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+    }
+
+
+async def run(args):
+    queries = load_labelled_queries(args.queries, args.documents)
+    with tempfile.TemporaryDirectory() as persist_directory:
+        catalogue = ServiceCatalogue()
+        vectorstore = ChromaDB(
+            load_documents_from_directory(args.documents, catalogue),
+            persist_directory=persist_directory,
+            catalogue=catalogue,
+        )
+        records = [
+            r for r in vectorstore.catalogue.records() if r.id in vectorstore.document_ids
+        ]
+        # Riscaldamento del modello di embedding
+        vectorstore.embeddings.embed_documents([q["query"] for q in queries])
+
+        print(f"{len(queries)} richieste, testo {'ripulito' if args.rewrite else 'grezzo'}")
+        print(
+            f"{'ricerca':>8} {'scorc.':>7} {'peso':>5} {'dist.':>6} {'recall@1':>9} "
+            f"{'false+':>7} {'senza emb.':>11} {'p50 ms':>7} {'p99 ms':>7}"
+        )
+        configurations = [("dense", None, None, args.max_distances[0])] + [
+            ("hybrid", score, weight, distance)
+            for score, weight, distance in itertools.product(
+                args.shortcut_scores, args.weights, args.max_distances
+            )
+        ]
+        for mode, score, weight, distance in configurations:
+            vec_db.SEARCH_MAX_DISTANCE = distance
+            if mode == "dense":
+                vectorstore.lexical_index = None
+            else:
+                vectorstore.lexical_index = LexicalIndex(
+                    shortcut_score=score, dense_weight=weight
+                )
+                vectorstore.lexical_index.build(records)
+            stats = await evaluate(vectorstore, queries, args.rewrite, args.repeat)
+            print(
+                f"{mode:>8} {score if score is not None else '-':>7} "
+                f"{weight if weight is not None else '-':>5} {distance:>6} "
+                f"{stats['recall@1']:>9.2f} {stats['false_positives']:>7} "
+                f"{stats['shortcut']:>11.0%} {stats['p50_ms']:>7.2f} {stats['p99_ms']:>7.2f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--queries", default="./benchmarks/data/queries.jsonl")
+    parser.add_argument("--documents", default="./documents")
+    parser.add_argument(
+        "--raw", dest="rewrite", action="store_false",
+        help="cerca il testo dell'utente senza ripulirlo",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--shortcut-scores", type=float, nargs="+", default=[LEXICAL_SHORTCUT_SCORE]
+    )
+    parser.add_argument("--weights", type=float, nargs="+", default=[HYBRID_DENSE_WEIGHT])
+    parser.add_argument(
+        "--max-distances", type=float, nargs="+", default=[SEARCH_MAX_DISTANCE]
+    )
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
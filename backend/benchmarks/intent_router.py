@@ -0,0 +1,139 @@
+"""
+Instradamento locale (rag/router.py) sul set etichettato
+benchmarks/data/queries.jsonl: quante richieste vengono riconosciute senza
+modello, con quale accuratezza (servizio e intento), quanti falsi positivi
+sulle richieste fuori dominio, il tempo per richiesta e le chiamate al
+modello risparmiate rispetto alla pipeline con riformulazione (due chiamate
+per richiesta: nessuna per una prenotazione instradata, una per una
+richiesta di informazioni instradata).
+
+Di default usa solo le regole lessicali; con --embeddings anche il
+classificatore a embedding (carica il modello di embedding).
+
+Uso (dalla cartella backend):
+    python -m benchmarks.intent_router
+    python -m benchmarks.intent_router --embeddings --min-similarity 0.5 0.6 0.7
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from rag.catalogue import ServiceCatalogue, ServiceRecord, service_from_filename
+from rag.router import ROUTER_MIN_MARGIN, ROUTER_MIN_SIMILARITY, IntentRouter
+
+DEFAULT_QUERIES = "./benchmarks/data/queries.jsonl"
+DOCUMENTS_DIR = "./documents"
+
+
+def load_catalogue(directory):
+    catalogue = ServiceCatalogue()
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(directory, filename), "r", encoding="utf-8") as file:
+            data = json.load(file)
+        catalogue.add(
+            ServiceRecord.from_raw(
+                data["page_content"], data["metadata"], service_from_filename(filename)
+            )
+        )
+    return catalogue
+
+
+class _Embedder:
+    """Espone aembed_query come il vectorstore, calcolando l'embedding in linea."""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    async def aembed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+
+async def evaluate(router, queries, vectorstore):
+    outcomes = {"correct": 0, "wrong": 0, "fallback": 0, "false_positive": 0}
+    methods = {}
+    llm_calls = 0
+    durations = []
+    for query in queries:
+        start = time.perf_counter()
+        route = await router.route(query["query"], query["city"], vectorstore)
+        durations.append(time.perf_counter() - start)
+
+        if route is None:
+            outcomes["fallback"] += 1
+            llm_calls += 2
+            continue
+        methods[route.method] = methods.get(route.method, 0) + 1
+        llm_calls += 0 if route.intent == "booking" else 1
+        expected = query["document"]
+        if expected is None:
+            outcomes["false_positive"] += 1
+        elif (
+            service_from_filename(expected) == route.record.service
+            and route.intent == query["intent"]
+        ):
+            outcomes["correct"] += 1
+        else:
+            outcomes["wrong"] += 1
+    return {
+        "outcomes": outcomes,
+        "methods": methods,
+        "llm_calls": llm_calls,
+        "baseline_llm_calls": 2 * len(queries),
+        "median_us": statistics.median(durations) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--queries", default=DEFAULT_QUERIES)
+    parser.add_argument("--documents", default=DOCUMENTS_DIR)
+    parser.add_argument("--embeddings", action="store_true")
+    parser.add_argument(
+        "--min-similarity", type=float, nargs="+", default=[ROUTER_MIN_SIMILARITY]
+    )
+    parser.add_argument("--min-margin", type=float, default=ROUTER_MIN_MARGIN)
+    args = parser.parse_args()
+
+    with open(args.queries, "r", encoding="utf-8") as file:
+        queries = [json.loads(line) for line in file if line.strip()]
+    catalogue = load_catalogue(args.documents)
+
+    embeddings = vectorstore = None
+    if args.embeddings:
+        from rag.vec_db import load_embeddings
+
+        embeddings = load_embeddings()
+        vectorstore = _Embedder(embeddings)
+
+    print(f"{len(queries)} richieste, {len(catalogue)} servizi")
+    print(
+        f"{'soglia':>7} {'corrette':>9} {'errate':>7} {'fuori dom.':>10} "
+        f"{'al modello':>10} {'chiamate LLM':>13} {'mediana µs':>11}  metodi"
+    )
+    thresholds = args.min_similarity if args.embeddings else [None]
+    for threshold in thresholds:
+        router = IntentRouter(
+            catalogue,
+            embeddings,
+            min_similarity=threshold or ROUTER_MIN_SIMILARITY,
+            min_margin=args.min_margin,
+        )
+        stats = asyncio.run(evaluate(router, queries, vectorstore))
+        outcomes = stats["outcomes"]
+        print(
+            f"{threshold if threshold is not None else '-':>7} "
+            f"{outcomes['correct']:>9} {outcomes['wrong']:>7} "
+            f"{outcomes['false_positive']:>10} {outcomes['fallback']:>10} "
+            f"{stats['llm_calls']:>6}/{stats['baseline_llm_calls']:<6} "
+            f"{stats['median_us']:>11.0f}  {stats['methods']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Load test della pipeline asincrona contro lo stub LLM locale.
+
+Esegue run_handler con un numero crescente di sessioni concorrenti (ognuna
+invia i propri messaggi in sequenza) e riporta p50/p95/p99 della latenza per
+messaggio. Con la pipeline asincrona la latenza resta circa pari a due
+round-trip dello stub finché la CPU non è satura; per misure pulite avviare
+lo stub in un processo separato (python -m benchmarks.stub_llm) e passare
+--llm-url, altrimenti viene avviato in un thread dello stesso processo.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.load_test --sessions 1 8 32 128 --messages 5
+
+Con lo stub a 200 ms nello stesso processo, su un solo core: p50 438 ms
+con 1 sessione, 460 ms con 8 (17 msg/s), 628 ms con 32 (46 msg/s); con 128
+sessioni la CPU è satura (55 msg/s, p50 2.2 s).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from langchain.docstore.document import Document
+
+from benchmarks import stub_llm
+from rag.catalogue import ServiceCatalogue, ServiceRecord
+from rag.lexical_index import HYBRID_SEARCH, LexicalIndex
+from rag.vec_db import ChromaDB, EmbeddingBatcher
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class StubEmbeddings:
+    """Embedding fittizio con un costo fisso per chiamata al modello."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return [[1.0, 0.0, 0.0] for _ in texts]
+
+
+class StubVectorStore(ChromaDB):
+    """Vector store fittizio con embedding e ricerca bloccanti di durata fissa."""
+
+    def __init__(self, search_latency):
+        self.search_latency = search_latency
+        self.embeddings = StubEmbeddings(search_latency)
+        self.embedding_batcher = EmbeddingBatcher(self.embeddings)
+        self.document_ids = set()
+        self.version = 0
+        with open("./documents/RM_passaporto.json", "r", encoding="utf-8") as file:
+            data = json.load(file)
+        record = ServiceRecord.from_raw(data["page_content"], data["metadata"], "passaporto")
+        self.catalogue = ServiceCatalogue()
+        self.catalogue.add(record)
+        self.doc = Document(page_content=record.page_content, metadata=record.index_metadata())
+        self.document_ids.add(record.id)
+        self.matrix_index = None
+        self.successor = None
+        # Stessa ricerca ibrida di ChromaDB, sull'unica scheda
+        self.lexical_index = LexicalIndex() if HYBRID_SEARCH else None
+        self.refresh_lexical_index()
+
+    def get_from_chroma_by_vector(self, embedding, comune="roma", lexical_hits=None):
+        time.sleep(self.search_latency)
+        if lexical_hits:
+            return self.lexical_index.fuse([(self.doc, 0.5)], lexical_hits)[:1]
+        return [(self.doc, 0.5)]
+
+
+async def run_session(run_handler, vectorstore, messages, latencies):
+    for i in range(messages):
+        start = time.perf_counter()
+        await run_handler(f"human asked: vorrei fare il passaporto {i}\n", vectorstore, "roma")
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_level(run_handler, vectorstore, sessions, messages):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(run_session(run_handler, vectorstore, messages, latencies) for _ in range(sessions))
+    )
+    elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--search-latency", type=float, default=0.002)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--llm-url", default=None, help="stub LLM già avviato")
+    args = parser.parse_args()
+
+    if args.llm_url is None:
+        stub_llm.start_in_thread(args.port, args.llm_latency)
+        args.llm_url = f"http://127.0.0.1:{args.port}/v1"
+    os.environ["LLM_BASE_URL"] = args.llm_url
+    os.environ.setdefault("API_KEY", "stub")
+    # Ogni messaggio deve percorrere l'intera pipeline
+    os.environ["SEMANTIC_CACHE_ENABLED"] = "0"
+
+    asyncio.run(run_levels(args))
+
+
+async def run_levels(args):
+    from rag.chain import run_handler
+    from rag.llm_client import close_llm_client
+
+    vectorstore = StubVectorStore(args.search_latency)
+
+    print(f"{'sessions':>8} {'msg/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for sessions in args.sessions:
+        latencies, elapsed = await run_level(
+            run_handler, vectorstore, sessions, args.messages
+        )
+        print(
+            f"{sessions:>8} {len(latencies) / elapsed:>8.1f} "
+            f"{statistics.median(latencies) * 1000:>8.0f} "
+            f"{percentile(latencies, 95) * 1000:>8.0f} "
+            f"{percentile(latencies, 99) * 1000:>8.0f}"
+        )
+
+    await close_llm_client()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Costo del logging sul percorso della richiesta: per ogni richiesta simulata
+vengono registrati gli stessi messaggi della pipeline (main.py, chain.py,
+vec_db.py) e si misura il tempo che l'event loop passa nelle chiamate di log.
+
+Configurazioni:
+- sync: basicConfig con FileHandler e StreamHandler sincroni e i messaggi
+  di prima (payload ricevuto due volte, Document e risultati completi a INFO);
+- queue: stessi messaggi, con la coda e il thread di scrittura di
+  rag/log_config.py (formattazione JSON e troncamento fuori dall'event loop);
+- queue+levels: i messaggi attuali (payload e Document a DEBUG, un
+  riepilogo a INFO) con la coda.
+
+Con --write-delay-ms ogni scrittura su disco attende il tempo indicato, per
+simulare un disco lento o uno stderr con pipe piena. Oltre alla latenza
+riporta il tempo per svuotare la coda dopo l'ultima richiesta e i messaggi
+scartati: le richieste sono inviate senza pause, quindi con molte richieste
+la coda (--queue-size) può riempirsi prima che il thread di scrittura la
+svuoti.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.logging_overhead --requests 2000
+    python -m benchmarks.logging_overhead --requests 500 --write-delay-ms 2
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+from langchain.docstore.document import Document
+
+from benchmarks.intent_router import DOCUMENTS_DIR, load_catalogue
+from rag import metrics
+from rag.log_config import (
+    LOG_QUEUE_SIZE,
+    configure_logging,
+    set_session,
+    stop_logging,
+)
+
+main_logger = logging.getLogger("main")
+chain_logger = logging.getLogger("rag.chain")
+
+
+class SlowFile:
+    """File che attende delay secondi a ogni flush (uno per messaggio)."""
+
+    def __init__(self, path, delay):
+        self.file = open(path, "w", encoding="utf-8")
+        self.delay = delay
+
+    def write(self, text):
+        self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+        if self.delay:
+            time.sleep(self.delay)
+
+    def close(self):
+        self.file.close()
+
+
+def legacy_messages(session_id, data, parsed, results, result):
+    """I messaggi di una richiesta prima di rag/log_config.py."""
+    main_logger.info(f"Session {session_id} - Received: {data}")
+    main_logger.info(f"Session {session_id} - Parsed data: {parsed}")
+    chain_logger.info("Avvio del handler...")
+    chain_logger.info("Esecuzione della ricerca su Chroma...")
+    logging.info("Esecuzione della ricerca su Chroma...")
+    logging.info("Ricerca completata con successo.")
+    logging.info("Risultati: %s", results)
+    logging.info(f"Risultato trovato con score <= {1.15}.")
+    logging.info(" Risultati: %s", results)
+    logging.info(" Risultati: %s", result)
+
+
+def current_messages(session_id, data, parsed, results, result):
+    """I messaggi di una richiesta con i livelli attuali."""
+    main_logger.debug("Session %s - Parsed data: %s", session_id, parsed)
+    main_logger.info(
+        "Session %s - Message received",
+        session_id,
+        extra={"city": parsed["city"], "stream": False},
+    )
+    chain_logger.info("Avvio del handler...")
+    chain_logger.info("Esecuzione della ricerca su Chroma...")
+    logging.debug("Esecuzione della ricerca su Chroma...")
+    logging.debug("Risultati: %s", results)
+    logging.info(
+        "Risultato trovato: %s (distanza %.3f)",
+        results[0][0].metadata["record_id"],
+        results[0][1],
+    )
+    chain_logger.debug("Risultati: %s", results)
+    chain_logger.debug("Risultati: %s", result)
+
+
+async def run(messages, requests, payloads):
+    latencies = []
+    for i in range(requests):
+        session_id, data, parsed, results, result = payloads[i % len(payloads)]
+        set_session(session_id)
+        metrics.start_request(parsed["city"])
+        start = time.perf_counter()
+        messages(session_id, data, parsed, results, result)
+        latencies.append(time.perf_counter() - start)
+        # Tra due richieste l'event loop passa ad altro, come nel server
+        await asyncio.sleep(0)
+    return latencies
+
+
+def build_payloads(documents_dir):
+    payloads = []
+    for index, record in enumerate(load_catalogue(documents_dir).services()):
+        parsed = {
+            "message": f"vorrei informazioni su {record.service}",
+            "city": record.comune,
+            "trace_id": f"bench-{index}",
+        }
+        doc = Document(page_content=record.page_content, metadata=record.index_metadata())
+        results = [(doc, 0.42)]
+        result = {"results": results, "formatted_query": parsed["message"]}
+        payloads.append((f"session-{index}", json.dumps(parsed), parsed, results, result))
+    return payloads
+
+
+def dropped():
+    return sum(
+        metrics.LOG_RECORDS_DROPPED.labels(reason)._value.get()
+        for reason in ("sampled", "queue_full")
+    )
+
+
+def measure(mode, args, payloads, tmp):
+    streams = [
+        SlowFile(os.path.join(tmp, f"{mode}-{name}.log"), args.write_delay_ms / 1000)
+        for name in ("stderr", "file")
+    ]
+    if mode == "sync":
+        logging.basicConfig(
+            level=logging.INFO,
+            format="%(asctime)s - %(levelname)s - %(message)s",
+            handlers=[logging.StreamHandler(stream) for stream in streams],
+            force=True,
+        )
+    else:
+        configure_logging(
+            level="INFO",
+            log_format="json",
+            sample_rates=args.sample_rates,
+            queue_size=args.queue_size,
+            streams=streams,
+        )
+    messages = current_messages if mode == "queue+levels" else legacy_messages
+    before = dropped()
+
+    latencies = asyncio.run(run(messages, args.requests, payloads))
+    start = time.perf_counter()
+    stop_logging()
+    drain = time.perf_counter() - start
+    for stream in streams:
+        stream.close()
+    size = sum(
+        os.path.getsize(os.path.join(tmp, f"{mode}-{name}.log"))
+        for name in ("stderr", "file")
+    )
+
+    latencies.sort()
+    return {
+        "mean_us": statistics.mean(latencies) * 1e6,
+        "p50_us": statistics.median(latencies) * 1e6,
+        "p99_us": latencies[int(0.99 * (len(latencies) - 1))] * 1e6,
+        "drain_ms": drain * 1000,
+        "dropped": dropped() - before,
+        "kb_per_request": size / 1024 / args.requests,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--documents", default=DOCUMENTS_DIR)
+    parser.add_argument("--write-delay-ms", type=float, default=0.0)
+    parser.add_argument("--sample-rates", default="")
+    parser.add_argument("--queue-size", type=int, default=LOG_QUEUE_SIZE)
+    parser.add_argument(
+        "--modes", nargs="+", default=["sync", "queue", "queue+levels"]
+    )
+    args = parser.parse_args()
+
+    payloads = build_payloads(args.documents)
+    print(f"{args.requests} richieste, scrittura {args.write_delay_ms} ms per messaggio")
+    print(
+        f"{'modo':>13} {'media us':>9} {'p50 us':>8} {'p99 us':>8} "
+        f"{'svuotamento ms':>15} {'scartati':>9} {'KB/richiesta':>13}"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in args.modes:
+            stats = measure(mode, args, payloads, tmp)
+            print(
+                f"{mode:>13} {stats['mean_us']:>9.1f} {stats['p50_us']:>8.1f} "
+                f"{stats['p99_us']:>8.1f} {stats['drain_ms']:>15.1f} "
+                f"{stats['dropped']:>9.0f} {stats['kb_per_request']:>13.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
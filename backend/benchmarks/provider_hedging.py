@@ -0,0 +1,137 @@
+"""
+Latenza di coda con più provider LLM (rag/providers.py), contro stub locali
+con latenza lognormale e errori iniettati.
+
+Scenari:
+- single: un solo provider;
+- hedged: due provider con la stessa distribuzione; la richiesta di riserva
+  parte quando il primo supera il proprio p95 osservato;
+- failover: il primo provider risponde sempre 429, il circuit breaker lo
+  esclude dopo LLM_BREAKER_FAILURES errori consecutivi.
+
+Per ogni scenario riporta p50/p95/p99, richieste fallite, richieste di
+riserva avviate e vinte, risposte ottenute dopo un failover e le richieste
+ricevute da ogni provider (il costo dell'hedging).
+
+Uso (dalla cartella backend):
+    python -m benchmarks.provider_hedging --requests 400 --concurrency 8 --sigma 1.0
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from benchmarks import stub_llm
+from rag import metrics
+from rag.llm_client import _create_client, _is_retryable, chat_completion
+from rag.providers import Provider, ProviderPool
+
+MESSAGES = [
+    {"role": "system", "content": "Riformula la richiesta."},
+    {"role": "user", "content": "vorrei rinnovare il passaporto"},
+]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def counter_value(counter, *labels):
+    return counter.labels(*labels)._value.get()
+
+
+async def run_scenario(ports, requests, concurrency, hedge):
+    providers = [
+        Provider(f"stub{port}", _create_client(f"http://127.0.0.1:{port}/v1", "stub"), "stub")
+        for port in ports
+    ]
+    pool = ProviderPool(providers, is_failure=_is_retryable, hedge=hedge)
+    before = {
+        p.name: counter_value(metrics.LLM_PROVIDER_REQUESTS, p.name, "ok")
+        + counter_value(metrics.LLM_PROVIDER_REQUESTS, p.name, "error")
+        + counter_value(metrics.LLM_PROVIDER_REQUESTS, p.name, "cancelled")
+        for p in providers
+    }
+    launched = counter_value(metrics.LLM_HEDGES, "launched")
+    won = counter_value(metrics.LLM_HEDGES, "won")
+    failover = counter_value(metrics.LLM_HEDGES, "failover")
+
+    latencies = []
+    failures = 0
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(None)
+
+    async def worker():
+        nonlocal failures
+        while not queue.empty():
+            queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                await chat_completion(pool, model="stub", messages=MESSAGES, max_tokens=16)
+            except Exception:
+                failures += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    await pool.close()
+    sent = {
+        p.name: counter_value(metrics.LLM_PROVIDER_REQUESTS, p.name, "ok")
+        + counter_value(metrics.LLM_PROVIDER_REQUESTS, p.name, "error")
+        + counter_value(metrics.LLM_PROVIDER_REQUESTS, p.name, "cancelled")
+        - before[p.name]
+        for p in providers
+    }
+    return {
+        "latencies": latencies,
+        "failures": failures,
+        "launched": counter_value(metrics.LLM_HEDGES, "launched") - launched,
+        "won": counter_value(metrics.LLM_HEDGES, "won") - won,
+        "failover": counter_value(metrics.LLM_HEDGES, "failover") - failover,
+        "sent": sent,
+        "breakers": {p.name: p.breaker.state for p in providers},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--sigma", type=float, default=1.0)
+    parser.add_argument("--port", type=int, default=8301)
+    args = parser.parse_args()
+
+    slow_a, slow_b, failing = args.port, args.port + 1, args.port + 2
+    options = {"distribution": "lognormal", "sigma": args.sigma}
+    stub_llm.start_in_thread(slow_a, args.latency, seed=1, **options)
+    stub_llm.start_in_thread(slow_b, args.latency, seed=2, **options)
+    stub_llm.start_in_thread(failing, 0.01, error_rate=1.0, seed=3)
+
+    scenarios = [
+        ("single", [slow_a], False),
+        ("hedged", [slow_a, slow_b], True),
+        ("failover", [failing, slow_b], True),
+    ]
+    print(
+        f"{'scenario':>9} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'falliti':>8} "
+        f"{'riserva':>8} {'vinte':>6} {'failover':>9}  richieste per provider / breaker"
+    )
+    for name, ports, hedge in scenarios:
+        result = asyncio.run(run_scenario(ports, args.requests, args.concurrency, hedge))
+        latencies = result["latencies"] or [float("nan")]
+        print(
+            f"{name:>9} {statistics.median(latencies) * 1000:>7.0f} "
+            f"{percentile(latencies, 95) * 1000:>7.0f} "
+            f"{percentile(latencies, 99) * 1000:>7.0f} {result['failures']:>8} "
+            f"{result['launched']:>8.0f} {result['won']:>6.0f} {result['failover']:>9.0f}  "
+            f"{result['sent']} {result['breakers']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
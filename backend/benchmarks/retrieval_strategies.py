@@ -0,0 +1,136 @@
+"""
+Confronta le strategie di ricerca (RETRIEVAL_STRATEGY) sul set etichettato
+benchmarks/data/queries.jsonl: recall@1 sulle richieste con un documento
+atteso, falsi positivi su quelle senza, latenza per richiesta e numero di
+chiamate al modello.
+
+Di default la riformulazione è servita dallo stub locale, che restituisce il
+testo dell'utente: la latenza è indicativa ma la recall della strategia llm
+coincide con quella raw. Per confrontare l'accuratezza reale passare --llm-url
+con l'endpoint del modello (e API_KEY nell'ambiente).
+
+Uso (dalla cartella backend):
+    python -m benchmarks.retrieval_strategies --strategies raw heuristic llm parallel
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from langchain.docstore.document import Document
+
+from benchmarks import stub_llm
+from init_db import load_documents_from_directory
+from rag.catalogue import ServiceCatalogue
+from rag.retrieval import RETRIEVAL_STRATEGIES
+from rag.vec_db import ChromaDB, document_id
+
+
+def load_labelled_queries(path, documents_dir):
+    with open(path, "r", encoding="utf-8") as file:
+        queries = [json.loads(line) for line in file if line.strip()]
+    for query in queries:
+        expected = None
+        if query["document"] is not None:
+            with open(
+                os.path.join(documents_dir, query["document"]), "r", encoding="utf-8"
+            ) as file:
+                data = json.load(file)
+            expected = document_id(
+                Document(page_content=data["page_content"], metadata=data["metadata"])
+            )
+        query["expected_id"] = expected
+    return queries
+
+
+async def evaluate(strategy, vectorstore, queries):
+    from rag.chain import LlamaChromaHandler
+
+    handler = LlamaChromaHandler(vectorstore, strategy=strategy)
+    llm_calls = 0
+    send_request = handler.send_request
+
+    async def counting_send_request(prompt):
+        nonlocal llm_calls
+        llm_calls += 1
+        return await send_request(prompt)
+
+    handler.send_request = counting_send_request
+
+    hits, positives, false_positives, negatives, latencies = 0, 0, 0, 0, []
+    for query in queries:
+        start = time.perf_counter()
+        result = await handler.process_query(
+            f"human asked: {query['query']}\n", query["city"]
+        )
+        latencies.append(time.perf_counter() - start)
+
+        found = document_id(result["results"][0][0]) if result["results"] else None
+        if query["expected_id"] is None:
+            negatives += 1
+            false_positives += found is not None
+        else:
+            positives += 1
+            hits += found == query["expected_id"]
+
+    return {
+        "recall@1": hits / positives if positives else 0.0,
+        "false_positives": f"{false_positives}/{negatives}",
+        "p50_ms": statistics.median(latencies) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "llm_calls": llm_calls / len(queries),
+    }
+
+
+async def run(args):
+    from rag.llm_client import close_llm_client
+
+    queries = load_labelled_queries(args.queries, args.documents)
+    with tempfile.TemporaryDirectory() as persist_directory:
+        catalogue = ServiceCatalogue()
+        vectorstore = ChromaDB(
+            load_documents_from_directory(args.documents, catalogue),
+            persist_directory=persist_directory,
+            catalogue=catalogue,
+        )
+        print(
+            f"{'strategy':>10} {'recall@1':>9} {'false+':>7} "
+            f"{'p50 ms':>8} {'mean ms':>8} {'llm/req':>8}"
+        )
+        for strategy in args.strategies:
+            stats = await evaluate(strategy, vectorstore, queries)
+            print(
+                f"{strategy:>10} {stats['recall@1']:>9.2f} {stats['false_positives']:>7} "
+                f"{stats['p50_ms']:>8.1f} {stats['mean_ms']:>8.1f} {stats['llm_calls']:>8.2f}"
+            )
+    await close_llm_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--strategies", nargs="+", default=list(RETRIEVAL_STRATEGIES),
+        choices=RETRIEVAL_STRATEGIES,
+    )
+    parser.add_argument("--queries", default="./benchmarks/data/queries.jsonl")
+    parser.add_argument("--documents", default="./documents")
+    parser.add_argument("--llm-latency", type=float, default=0.4)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--llm-url", default=None, help="endpoint reale o stub già avviato")
+    args = parser.parse_args()
+
+    if args.llm_url is None:
+        stub_llm.start_in_thread(args.port, args.llm_latency)
+        args.llm_url = f"http://127.0.0.1:{args.port}/v1"
+        os.environ.setdefault("API_KEY", "stub")
+    os.environ["LLM_BASE_URL"] = args.llm_url
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
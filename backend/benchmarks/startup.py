@@ -0,0 +1,93 @@
+"""
+Tempi di avvio del backend: import di main.py, tempo fino alla prima
+risposta di /health (liveness) e fino a /ready = 200 (tutti i componenti
+caricati), con l'avvio in background e con EAGER_STARTUP=1.
+
+Con l'avvio in background /health risponde subito, mentre modello, indice e
+client LLM vengono caricati; con EAGER_STARTUP=1 il server accetta
+connessioni solo a caricamento concluso.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.startup --runs 3
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); import main; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def import_time():
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def poll(url, process, deadline):
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("il server è terminato durante l'avvio")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return time.monotonic()
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.02)
+    raise TimeoutError(f"{url} non pronto")
+
+
+def server_times(eager, port, timeout):
+    env = dict(os.environ, EAGER_STARTUP="1" if eager else "0")
+    start = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        base = f"http://127.0.0.1:{port}"
+        deadline = start + timeout
+        health = poll(base + "/health", process, deadline) - start
+        ready = poll(base + "/ready", process, deadline) - start
+        return health, ready
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8140)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    imports = [import_time() for _ in range(args.runs)]
+    print(f"import main          {statistics.median(imports) * 1000:8.0f} ms")
+
+    print(f"{'mode':>10} {'/health ms':>11} {'/ready ms':>10}")
+    for eager in (False, True):
+        times = [server_times(eager, args.port, args.timeout) for _ in range(args.runs)]
+        print(
+            f"{'eager' if eager else 'background':>10} "
+            f"{statistics.median(t[0] for t in times) * 1000:>11.0f} "
+            f"{statistics.median(t[1] for t in times) * 1000:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
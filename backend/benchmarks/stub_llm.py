@@ -0,0 +1,199 @@
+"""
+Server locale compatibile con l'API chat completions di OpenAI, usato dai
+benchmark al posto di api.aimlapi.com.
+
+Risponde dopo una latenza configurabile: alla richiesta di riformulazione
+restituisce il testo dell'utente, alla richiesta di risposta finale un JSON
+nel formato atteso da LlamaChromaHandler.send_response. Con "stream": true
+la risposta è inviata come eventi SSE, un frammento ogni token_latency.
+
+La latenza (fino al primo token) può seguire una distribuzione: "fixed",
+"uniform" (latency ± spread), "normal" (deviazione latency * spread),
+"lognormal" (media latency, coda lunga controllata da sigma) o
+"exponential" (media latency, senza memoria come i tempi di coda). Con
+error_rate > 0 una parte delle richieste riceve un 429 o un 503, come da
+un provider sovraccarico.
+
+Uso:
+    python -m benchmarks.stub_llm --port 8099 --latency 0.4 --distribution lognormal --sigma 0.5
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+STUB_ANSWER = {
+    "info": "Puoi prenotare l'appuntamento presso lo sportello in Via Petroselli 50.",
+    "is_info": True,
+}
+
+
+DISTRIBUTIONS = ("fixed", "uniform", "normal", "lognormal", "exponential")
+
+
+class LatencyModel:
+    """Estrae la latenza di ogni richiesta dalla distribuzione configurata."""
+
+    def __init__(self, latency, distribution="fixed", spread=0.5, sigma=0.5, seed=None):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f"Distribuzione sconosciuta: {distribution}")
+        self.latency = latency
+        self.distribution = distribution
+        self.spread = spread
+        self.sigma = sigma
+        self.random = random.Random(seed)
+
+    def sample(self):
+        if self.distribution == "uniform":
+            low = self.latency * (1 - self.spread)
+            return self.random.uniform(max(0.0, low), self.latency * (1 + self.spread))
+        if self.distribution == "normal":
+            return max(0.0, self.random.gauss(self.latency, self.latency * self.spread))
+        if self.distribution == "lognormal" and self.latency > 0:
+            # mu scelto in modo che la media sia latency
+            mu = math.log(self.latency) - self.sigma**2 / 2
+            return self.random.lognormvariate(mu, self.sigma)
+        if self.distribution == "exponential" and self.latency > 0:
+            return self.random.expovariate(1 / self.latency)
+        return self.latency
+
+
+def _usage(body, content):
+    # Stima grossolana: circa 4 caratteri per token
+    prompt = sum(len(m.get("content") or "") for m in body["messages"]) // 4
+    completion = len(content) // 4
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "total_tokens": prompt + completion,
+    }
+
+
+def _stream_chunks(content: str, model: str, token_latency: float, usage=None):
+    def chunk(choices, **extra):
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": choices,
+            **extra,
+        }
+
+    async def events():
+        for i in range(0, len(content), 4):
+            delta = {"index": 0, "delta": {"content": content[i : i + 4]}, "finish_reason": None}
+            yield f"data: {json.dumps(chunk([delta]))}\n\n"
+            await asyncio.sleep(token_latency)
+        if usage is not None:
+            # stream_options.include_usage: ultimo frammento senza choices
+            yield f"data: {json.dumps(chunk([], usage=usage))}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def create_app(
+    latency: float = 0.2,
+    token_latency: float = 0.01,
+    distribution: str = "fixed",
+    spread: float = 0.5,
+    sigma: float = 0.5,
+    error_rate: float = 0.0,
+    seed=None,
+) -> FastAPI:
+    app = FastAPI()
+    latency_model = LatencyModel(latency, distribution, spread, sigma, seed)
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        await asyncio.sleep(latency_model.sample())
+
+        if error_rate and latency_model.random.random() < error_rate:
+            status = latency_model.random.choice((429, 503))
+            return JSONResponse(
+                {"error": {"message": "stub overloaded", "type": "rate_limit"}},
+                status_code=status,
+                headers={"retry-after": "0.1"},
+            )
+
+        system_prompt = body["messages"][0]["content"]
+        if "JSON" in system_prompt:
+            content = json.dumps(STUB_ANSWER, ensure_ascii=False)
+        else:
+            content = body["messages"][-1]["content"][-200:]
+
+        if body.get("stream"):
+            usage = None
+            if (body.get("stream_options") or {}).get("include_usage"):
+                usage = _usage(body, content)
+            return _stream_chunks(content, body.get("model", "stub"), token_latency, usage)
+
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": _usage(body, content),
+        }
+
+    return app
+
+
+def start_in_thread(port: int, latency: float = 0.2, **options) -> uvicorn.Server:
+    """Avvia lo stub in un thread separato e attende che sia pronto."""
+    config = uvicorn.Config(
+        create_app(latency, **options), host="127.0.0.1", port=port, log_level="warning"
+    )
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default="fixed")
+    parser.add_argument("--spread", type=float, default=0.5)
+    parser.add_argument("--sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    uvicorn.run(
+        create_app(
+            args.latency,
+            args.token_latency,
+            args.distribution,
+            args.spread,
+            args.sigma,
+            args.error_rate,
+            args.seed,
+        ),
+        host="127.0.0.1",
+        port=args.port,
+        log_level="warning",
+    )
@@ -0,0 +1,235 @@
+"""
+Benchmark end-to-end senza rete: avvia lo stub OpenAI-compatibile
+(benchmarks/stub_llm.py), avvia il backend puntato sullo stub
+(LLM_BASE_URL), attende /ready, esegue il carico websocket di
+benchmarks/ws_load.py e campiona la memoria dei processi del server.
+
+Il report (throughput, p50/p95/p99 end-to-end e per fase, picco di RSS/PSS)
+può essere salvato con --output e confrontato con un report precedente con
+--baseline, per verificare l'effetto di una modifica sulle stesse condizioni.
+
+Per girare senza rete il modello di embedding deve essere già nella cache
+di HuggingFace: lo script imposta HF_HUB_OFFLINE=1.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.suite --sessions 32 --messages 10 --output base.json
+    python -m benchmarks.suite --sessions 32 --messages 10 --baseline base.json
+    python -m benchmarks.suite --server preload --workers 4 --distribution lognormal
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+from benchmarks.stub_llm import DISTRIBUTIONS
+from benchmarks.worker_memory import children, memory_kb
+from benchmarks.ws_load import DEFAULT_QUERIES, load_queries, print_report, run_load
+
+SERVERS = {
+    "uvicorn": [sys.executable, "-m", "uvicorn", "main:app"],
+    "preload": [sys.executable, "serve.py"],
+}
+
+
+def wait_for(url, processes, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for process in processes:
+            if process.poll() is not None:
+                raise RuntimeError(f"processo terminato durante l'avvio: {process.args}")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError(f"{url} non pronto")
+
+
+class MemorySampler(threading.Thread):
+    """Campiona RSS e PSS totali di un processo e dei suoi figli."""
+
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss_mb = 0.0
+        self.peak_pss_mb = 0.0
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        rss = pss = 0
+        for pid in [self.pid] + children(self.pid):
+            try:
+                stats = memory_kb(pid)
+            except (FileNotFoundError, ProcessLookupError):
+                continue
+            rss += stats.get("Rss", 0)
+            pss += stats.get("Pss", 0)
+        self.peak_rss_mb = max(self.peak_rss_mb, rss / 1024)
+        self.peak_pss_mb = max(self.peak_pss_mb, pss / 1024)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+
+def start_stub(args):
+    command = [
+        sys.executable, "-m", "benchmarks.stub_llm",
+        "--port", str(args.stub_port),
+        "--latency", str(args.latency),
+        "--token-latency", str(args.token_latency),
+        "--distribution", args.distribution,
+        "--spread", str(args.spread),
+        "--sigma", str(args.sigma),
+        "--error-rate", str(args.error_rate),
+        "--seed", str(args.seed),
+    ]
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def start_server(args):
+    env = dict(
+        os.environ,
+        LLM_BASE_URL=f"http://127.0.0.1:{args.stub_port}/v1",
+        API_KEY=os.getenv("API_KEY", "stub"),
+        HF_HUB_OFFLINE="1",
+        TRANSFORMERS_OFFLINE="1",
+    )
+    command = SERVERS[args.server] + ["--host", "127.0.0.1", "--port", str(args.port)]
+    if args.server == "preload" or args.workers > 1:
+        command += ["--workers", str(args.workers)]
+    return subprocess.Popen(
+        command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_suite(args):
+    stub = start_stub(args)
+    server = None
+    try:
+        wait_for(f"http://127.0.0.1:{args.stub_port}/health", [stub], 30)
+        start = time.monotonic()
+        server = start_server(args)
+        wait_for(f"http://127.0.0.1:{args.port}/ready", [stub, server], args.timeout)
+        ready_s = time.monotonic() - start
+
+        sampler = MemorySampler(server.pid)
+        sampler.start()
+        results = asyncio.run(
+            run_load(
+                f"ws://127.0.0.1:{args.port}/ws",
+                args.sessions,
+                args.messages,
+                args.think_time,
+                not args.no_stream,
+                load_queries(args.queries),
+                args.seed,
+            )
+        )
+        sampler.stop()
+    finally:
+        if server is not None:
+            stop(server)
+        stop(stub)
+
+    report = results.report()
+    report["ready_s"] = ready_s
+    report["memory"] = {
+        "peak_rss_mb": sampler.peak_rss_mb,
+        "peak_pss_mb": sampler.peak_pss_mb,
+    }
+    report["config"] = {
+        key: getattr(args, key)
+        for key in (
+            "server", "workers", "sessions", "messages", "think_time",
+            "latency", "token_latency", "distribution", "error_rate", "seed",
+        )
+    }
+    return report
+
+
+def compare(report, baseline):
+    """Stampa le variazioni rispetto a un report precedente."""
+
+    def delta(name, new, old, lower_is_better=True):
+        if not old:
+            return
+        change = (new - old) / old * 100
+        better = change < 0 if lower_is_better else change > 0
+        print(f"{name:>28} {old:>10.1f} {new:>10.1f} {change:>+8.1f}% {'ok' if better else ''}")
+
+    print(f"{'confronto':>28} {'baseline':>10} {'attuale':>10} {'diff':>9}")
+    delta("throughput msg/s", report["throughput"], baseline["throughput"], False)
+    delta("prompt tokens/msg", report["prompt_tokens"], baseline.get("prompt_tokens"))
+    for section in ("end_to_end", "first_delta"):
+        for pct in ("p50_ms", "p95_ms", "p99_ms"):
+            delta(f"{section} {pct}", report[section][pct], baseline[section][pct])
+    for stage, stats in report["stages"].items():
+        if stage in baseline["stages"]:
+            delta(f"{stage} p95_ms", stats["p95_ms"], baseline["stages"][stage]["p95_ms"])
+    delta("peak_pss_mb", report["memory"]["peak_pss_mb"], baseline["memory"]["peak_pss_mb"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--server", choices=SERVERS, default="uvicorn")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8150)
+    parser.add_argument("--stub-port", type=int, default=8199)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default="fixed")
+    parser.add_argument("--spread", type=float, default=0.5)
+    parser.add_argument("--sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="salva il report JSON")
+    parser.add_argument("--baseline", help="report JSON da confrontare")
+    args = parser.parse_args()
+
+    report = run_suite(args)
+    print(f"pronto in {report['ready_s']:.1f} s")
+    print_report(report)
+    print(
+        f"memoria: picco RSS {report['memory']['peak_rss_mb']:.0f} MB, "
+        f"picco PSS {report['memory']['peak_pss_mb']:.0f} MB"
+    )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            compare(report, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Latenza di ricerca k=1 filtrata per comune: MatrixIndex contro Chroma.
+
+Genera N embedding casuali normalizzati (384 dimensioni, come
+all-MiniLM-L6-v2) distribuiti su tre comuni, li carica in una collezione
+Chroma persistente e in un MatrixIndex, e misura p50/p99 delle ricerche.
+
+Uso (dalla cartella backend):
+    python -m benchmarks.vector_index --sizes 1000 100000 1000000
+Con --chroma-max si evita di caricare in Chroma le dimensioni più grandi.
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+
+import chromadb
+import numpy as np
+
+from rag.matrix_index import MatrixIndex
+
+COMUNI = ["roma", "bari", "napoli"]
+DIMENSIONS = 384
+
+
+def random_unit_vectors(rng, n):
+    vectors = rng.standard_normal((n, DIMENSIONS)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def time_queries(search, queries):
+    latencies = []
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        search(query, COMUNI[i % len(COMUNI)])
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return statistics.median(latencies) * 1000, latencies[int(0.99 * (len(latencies) - 1))] * 1000
+
+
+def benchmark_size(n, args, rng):
+    embeddings = random_unit_vectors(rng, n)
+    ids = [f"doc-{i}" for i in range(n)]
+    metadatas = [{"comune": COMUNI[i % len(COMUNI)]} for i in range(n)]
+    documents = [f"documento {i}" for i in range(n)]
+    queries = random_unit_vectors(rng, args.queries)
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        index = MatrixIndex(directory + "/matrix")
+        index.build(ids, embeddings, metadatas, documents)
+        build_s = time.perf_counter() - start
+        matrix = time_queries(lambda q, c: index.search(q, c, k=1), queries)
+        print(f"{n:>9} {'matrix':>8} {build_s:>9.1f} {matrix[0]:>8.3f} {matrix[1]:>8.3f}")
+
+        if n > args.chroma_max:
+            return
+        client = chromadb.PersistentClient(
+            path=directory + "/chroma",
+            settings=chromadb.Settings(anonymized_telemetry=False),
+        )
+        collection = client.create_collection("benchmark")
+        start = time.perf_counter()
+        for i in range(0, n, args.batch_size):
+            collection.add(
+                ids=ids[i : i + args.batch_size],
+                embeddings=embeddings[i : i + args.batch_size].tolist(),
+                metadatas=metadatas[i : i + args.batch_size],
+                documents=documents[i : i + args.batch_size],
+            )
+        build_s = time.perf_counter() - start
+        chroma = time_queries(
+            lambda q, c: collection.query(
+                query_embeddings=[q.tolist()], n_results=1, where={"comune": c}
+            ),
+            queries,
+        )
+        print(f"{n:>9} {'chroma':>8} {build_s:>9.1f} {chroma[0]:>8.3f} {chroma[1]:>8.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--chroma-max", type=int, default=1000000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'docs':>9} {'engine':>8} {'build s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for n in args.sizes:
+        benchmark_size(n, args, rng)
+
+
+if __name__ == "__main__":
+    main()
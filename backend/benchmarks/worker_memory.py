@@ -0,0 +1,114 @@
+"""
+Memoria occupata al crescere dei worker: serve.py (preload + fork) contro
+uvicorn --workers (ogni worker carica modello e indice per conto proprio).
+
+Per ogni modalità e numero di worker avvia il server, attende /health, invia
+qualche richiesta di riscaldamento e legge /proc/<pid>/smaps_rollup del
+processo principale e dei figli. Il PSS (proportional set size) divide le
+pagine condivise tra i processi che le usano, quindi la somma dei PSS è la
+memoria realmente occupata; la colonna "per worker" è l'incremento medio per
+ogni worker oltre il primo.
+
+Uso (dalla cartella backend, solo Linux):
+    python -m benchmarks.worker_memory --workers 1 2 4 8
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+import httpx
+
+MODES = {
+    "preload": [sys.executable, "serve.py"],
+    "uvicorn": [sys.executable, "-m", "uvicorn", "main:app"],
+}
+
+
+def children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            pids = [int(p) for p in file.read().split()]
+    except FileNotFoundError:
+        return []
+    return pids + [c for p in pids for c in children(p)]
+
+
+def memory_kb(pid):
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as file:
+        for line in file:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0].rstrip(":")] = int(parts[1])
+    return values
+
+
+def wait_ready(url, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("il server è terminato durante l'avvio")
+        try:
+            if httpx.get(url + "/health", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError("server non pronto")
+
+
+def measure(mode, workers, port, timeout):
+    command = MODES[mode] + [
+        "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers)
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        url = f"http://127.0.0.1:{port}"
+        wait_ready(url, process, timeout)
+        # Attende che tutti i worker abbiano completato l'avvio
+        time.sleep(2 + workers)
+        for _ in range(4 * workers):
+            httpx.get(url + "/bookings/roma/passaporto", timeout=10)
+        pids = [process.pid] + children(process.pid)
+        stats = [memory_kb(pid) for pid in pids]
+        return {
+            "processes": len(pids),
+            "rss_mb": sum(s["Rss"] for s in stats) / 1024,
+            "pss_mb": sum(s["Pss"] for s in stats) / 1024,
+        }
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--port", type=int, default=8130)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    print(f"{'mode':>8} {'workers':>8} {'procs':>6} {'RSS MB':>9} {'PSS MB':>9} {'per worker':>11}")
+    for mode in args.modes:
+        baseline = None
+        for workers in args.workers:
+            stats = measure(mode, workers, args.port, args.timeout)
+            per_worker = ""
+            if baseline is not None and workers > baseline[0]:
+                per_worker = f"{(stats['pss_mb'] - baseline[1]) / (workers - baseline[0]):.1f}"
+            elif baseline is None:
+                baseline = (workers, stats["pss_mb"])
+            print(
+                f"{mode:>8} {workers:>8} {stats['processes']:>6} "
+                f"{stats['rss_mb']:>9.1f} {stats['pss_mb']:>9.1f} {per_worker:>11}"
+            )
+
+
+if __name__ == "__main__":
+    main()
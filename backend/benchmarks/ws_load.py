@@ -0,0 +1,202 @@
+"""
+Generatore di carico websocket: riproduce le richieste registrate in
+benchmarks/data/queries.jsonl su sessioni concorrenti di Roma, Bari e Napoli.
+
+Ogni sessione apre /ws, sceglie un comune e invia i messaggi in sequenza
+(con una pausa di think_time tra una risposta e il messaggio successivo),
+chiedendo al server i tempi delle singole fasi ("timings": true). Il
+report contiene throughput, latenza end-to-end, tempo al primo frammento in
+streaming e p50/p95/p99 di ogni fase della pipeline.
+
+Uso (dalla cartella backend, con il server già avviato):
+    python -m benchmarks.ws_load --url ws://127.0.0.1:8000/ws --sessions 32 --messages 10
+Per avviare anche stub LLM e server e misurare la memoria: benchmarks.suite.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import websockets
+
+DEFAULT_QUERIES = "./benchmarks/data/queries.jsonl"
+
+
+def load_queries(path=DEFAULT_QUERIES):
+    """Restituisce {comune: [richieste]}"""
+    queries = {}
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                row = json.loads(line)
+                queries.setdefault(row["city"], []).append(row["query"])
+    return queries
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class LoadResults:
+    def __init__(self):
+        self.latencies = []
+        self.first_delta = []
+        self.stages = {}
+        self.prompt_tokens = []
+        self.outcomes = {"ok": 0, "busy": 0, "error": 0}
+        self.elapsed = 0.0
+
+    def add(self, latency, first_delta, timings, prompt_tokens=None):
+        self.outcomes["ok"] += 1
+        self.latencies.append(latency)
+        if first_delta is not None:
+            self.first_delta.append(first_delta)
+        for stage, ms in (timings or {}).items():
+            self.stages.setdefault(stage, []).append(ms / 1000)
+        if prompt_tokens is not None:
+            self.prompt_tokens.append(sum(prompt_tokens.values()))
+
+    def report(self):
+        def summary(values):
+            return {
+                "count": len(values),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+            }
+
+        return {
+            "throughput": self.outcomes["ok"] / self.elapsed if self.elapsed else 0.0,
+            "outcomes": dict(self.outcomes),
+            "end_to_end": summary(self.latencies),
+            "first_delta": summary(self.first_delta),
+            "stages": {stage: summary(v) for stage, v in sorted(self.stages.items())},
+            "prompt_tokens": (
+                sum(self.prompt_tokens) / len(self.prompt_tokens)
+                if self.prompt_tokens
+                else 0.0
+            ),
+        }
+
+
+async def run_session(url, city, queries, messages, think_time, stream, results, rng):
+    async with websockets.connect(url, max_size=None) as ws:
+        await ws.recv()  # messaggio di benvenuto
+        for _ in range(messages):
+            trace_id = uuid.uuid4().hex
+            start = time.perf_counter()
+            first_delta = None
+            await ws.send(
+                json.dumps(
+                    {
+                        "message": rng.choice(queries),
+                        # Come il frontend: "Roma", "Bari", "Napoli"
+                        "city": city.capitalize(),
+                        "stream": stream,
+                        "timings": True,
+                        "trace_id": trace_id,
+                    }
+                )
+            )
+            while True:
+                frame = json.loads(await ws.recv())
+                if frame.get("type") == "delta":
+                    if first_delta is None:
+                        first_delta = time.perf_counter() - start
+                    continue
+                break
+            latency = time.perf_counter() - start
+            if frame.get("type") == "busy":
+                results.outcomes["busy"] += 1
+                await asyncio.sleep(frame.get("retry_after", think_time))
+            elif frame.get("sender") == "System":
+                results.outcomes["error"] += 1
+            else:
+                results.add(
+                    latency, first_delta, frame.get("timings"), frame.get("prompt_tokens")
+                )
+            if think_time:
+                await asyncio.sleep(rng.expovariate(1 / think_time))
+
+
+async def run_load(url, sessions, messages, think_time=0.0, stream=True, queries=None, seed=0):
+    """Esegue il carico e restituisce un LoadResults."""
+    queries = queries or load_queries()
+    cities = sorted(queries)
+    rng = random.Random(seed)
+    results = LoadResults()
+    start = time.perf_counter()
+    outcomes = await asyncio.gather(
+        *(
+            run_session(
+                url,
+                cities[i % len(cities)],
+                queries[cities[i % len(cities)]],
+                messages,
+                think_time,
+                stream,
+                results,
+                random.Random(rng.random()),
+            )
+            for i in range(sessions)
+        ),
+        return_exceptions=True,
+    )
+    results.elapsed = time.perf_counter() - start
+    for outcome in outcomes:
+        if isinstance(outcome, Exception):
+            results.outcomes["error"] += 1
+    return results
+
+
+def print_report(report):
+    outcomes = report["outcomes"]
+    print(
+        f"throughput {report['throughput']:.1f} msg/s  "
+        f"(ok {outcomes['ok']}, busy {outcomes['busy']}, errori {outcomes['error']})"
+    )
+    print(f"token in input per messaggio (media) {report['prompt_tokens']:.0f}")
+    print(f"{'fase':>18} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    rows = [("end_to_end", report["end_to_end"]), ("first_delta", report["first_delta"])]
+    rows += list(report["stages"].items())
+    for name, stats in rows:
+        print(
+            f"{name:>18} {stats['count']:>6} {stats['p50_ms']:>9.1f} "
+            f"{stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="ws://127.0.0.1:8000/ws")
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = asyncio.run(
+        run_load(
+            args.url,
+            args.sessions,
+            args.messages,
+            args.think_time,
+            not args.no_stream,
+            load_queries(args.queries),
+            args.seed,
+        )
+    )
+    print_report(results.report())
+
+
+if __name__ == "__main__":
+    main()
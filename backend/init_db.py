@@ -1,71 +1,251 @@
 import logging
+import multiprocessing
 import os
 import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from langchain.schema import Document
-from rag.vec_db import ChromaDB
+from rag.catalogue import InvalidDocument, ServiceRecord, service_from_filename
+from rag.log_config import configure_logging
 
-def load_documents_from_directory(directory):
+try:
+    import orjson
+except ImportError:  # orjson è opzionale
+    orjson = None
+
+# Processi usati per leggere i file (0 = lettura nel processo corrente). Se
+# non impostata, il pool (min(4, CPU) processi) è usato solo quando i file
+# superano in totale LOADER_POOL_MIN_BYTES: avviare interpreti che importano
+# langchain costa secondi, più di quanto serva a leggere un corpus piccolo
+LOADER_WORKERS = os.getenv("LOADER_WORKERS")
+LOADER_POOL_MIN_BYTES = int(os.getenv("LOADER_POOL_MIN_BYTES", str(64 * 1024 * 1024)))
+
+
+def _loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _raise(error):
+    raise error
+
+
+def iter_document_files(directory):
+    """
+    Restituisce i file .json e .jsonl della cartella e delle sottocartelle;
+    una cartella non leggibile solleva OSError invece di essere saltata.
+    """
+    for root, dirs, files in os.walk(directory, onerror=_raise):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.endswith((".json", ".jsonl")):
+                yield os.path.join(root, filename)
+
+
+def documents_state(directory):
+    """
+    Stato dei file dei documenti ({percorso: (mtime_ns, dimensione)}), per
+    accorgersi di file aggiunti, modificati o rimossi senza leggerli.
+    """
+    state = {}
+    for filepath in iter_document_files(directory):
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:  # rimosso durante la scansione
+            continue
+        state[filepath] = (stat.st_mtime_ns, stat.st_size)
+    return state
+
+
+def parse_document_file(filepath):
+    """
+    Legge un file e restituisce la lista dei ServiceRecord validi.
+
+    Un file .json contiene un documento (o una lista di documenti), un file
+    .jsonl un documento per riga. date_orari e need_to_do vengono convertiti
+    e validati qui, una volta sola: i documenti non validi sono scartati con
+    un errore nel log. Un file non leggibile solleva OSError: i suoi
+    documenti non devono sembrare rimossi (sync_documents li eliminerebbe
+    dall'indice); un file rimosso nel frattempo non contiene documenti.
+    """
+    records = []
+    try:
+        with open(filepath, "rb") as file:
+            if filepath.endswith(".jsonl"):
+                for line_number, line in enumerate(file, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        records.append((f"{filepath}:{line_number}", _loads(line)))
+                    except ValueError:
+                        logging.error(
+                            f"Error decoding JSON from {filepath}:{line_number}"
+                        )
+            else:
+                data = _loads(file.read())
+                data = data if isinstance(data, list) else [data]
+                records = [(filepath, record) for record in data]
+    except ValueError:
+        logging.error(f"Error decoding JSON from {filepath}")
+        return []
+    except FileNotFoundError:
+        return []
+    except OSError as e:
+        logging.error(f"Error reading {filepath}: {e}")
+        raise
+
+    # Nei file .json il servizio si ricava dal nome (RM_passaporto.json),
+    # nei .jsonl deve essere indicato in metadata.service
+    default_service = (
+        None if filepath.endswith(".jsonl") else service_from_filename(filepath)
+    )
+    services = []
+    for source, record in records:
+        if not isinstance(record, dict):
+            logging.error(f"Invalid document in {source}: not an object")
+            continue
+        try:
+            services.append(
+                ServiceRecord.from_raw(
+                    record.get("page_content"),
+                    record.get("metadata"),
+                    default_service,
+                )
+            )
+        except InvalidDocument as e:
+            logging.error(f"Invalid document in {source}: {e}")
+    return services
+
+
+def _loader_workers(files):
+    """Processi per leggere files: LOADER_WORKERS, o 0 per un corpus piccolo."""
+    if LOADER_WORKERS is not None:
+        return int(LOADER_WORKERS)
+    size = 0
+    for filepath in files:
+        try:
+            size += os.path.getsize(filepath)
+        except FileNotFoundError:  # rimosso durante la scansione
+            continue
+        if size >= LOADER_POOL_MIN_BYTES:
+            return min(4, os.cpu_count() or 1)
+    return 0
+
+
+def iter_documents(directory, catalogue, workers=None):
     """
-    Load documents from JSON files in the specified directory.
+    Generatore dei documenti contenuti in directory (ricorsivamente).
 
-    Expected JSON file structure:
+    I documenti restituiti hanno solo i metadati da indicizzare (comune,
+    service, record_id); le schede complete finiscono in catalogue
+    (ServiceCatalogue), da passare anche a ChromaDB per risolverli.
+
+    Con workers=None i file sono letti nel processo corrente, salvo
+    LOADER_WORKERS impostata o un corpus oltre LOADER_POOL_MIN_BYTES. Con
+    workers > 0 sono letti da un pool di processi (avviati con spawn: il
+    processo che legge può avere thread e connessioni aperte); al più
+    2 * workers file sono in lettura o in attesa di essere consumati, quindi
+    la memoria non cresce con la dimensione del corpus.
+
+    Un errore di lettura interrompe il generatore con l'eccezione: chi
+    consuma i documenti non deve scambiare una lettura parziale per la
+    rimozione dei documenti mancanti.
+
+    Expected JSON record structure:
     {
-        "content": "Document text content",
+        "page_content": "Document text content",
         "metadata": {
-            "comune": "RM",
-            "date-orari": "...",
+            "comune": "roma",
+            "service": "passaporto",  // opzionale nei file .json
+            "date_orari": "{\\"2024-12-16\\": [\\"09.00-10.30\\"]}",
+            "need_to_do": "[documento, ricevuta]",
             "info": "..."
         }
     }
     """
-    documents = []
     try:
-        for filename in os.listdir(directory):
-            if filename.endswith(".json"):
-                filepath = os.path.join(directory, filename)
-                try:
-                    with open(filepath, "r", encoding="utf-8") as file:
-                        doc_data = json.load(file)
-
-                        # Create a Document object
-                        doc = Document(
-                            page_content=doc_data.get("page_content", ""),
-                            metadata=doc_data.get("metadata", {}),
-                        )
-                        documents.append(doc)
-                        logging.info(f"Loaded document from {filename}")
-                except json.JSONDecodeError:
-                    logging.error(f"Error decoding JSON from {filename}")
-                except Exception as e:
-                    logging.error(f"Error processing {filename}: {e}")
+        files = list(iter_document_files(directory))
+        if workers is None:
+            workers = _loader_workers(files)
+        if workers <= 0:
+            parsed = (
+                (filepath, parse_document_file(filepath)) for filepath in files
+            )
+            yield from _to_documents(parsed, catalogue)
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            yield from _to_documents(
+                _parse_in_pool(pool, files, 2 * workers), catalogue
+            )
     except Exception as e:
         logging.error(f"Error reading directory {directory}: {e}")
+        raise
+
+
+def _parse_in_pool(pool, files, max_in_flight):
+    in_flight = deque()
+    for filepath in files:
+        in_flight.append((filepath, pool.submit(parse_document_file, filepath)))
+        if len(in_flight) >= max_in_flight:
+            filepath, future = in_flight.popleft()
+            yield filepath, future.result()
+    while in_flight:
+        filepath, future = in_flight.popleft()
+        yield filepath, future.result()
+
+
+def _to_documents(parsed, catalogue):
+    for filepath, records in parsed:
+        for record in records:
+            catalogue.add(record)
+            yield Document(
+                page_content=record.page_content, metadata=record.index_metadata()
+            )
+        if records:
+            logging.info(f"Loaded {len(records)} document(s) from {filepath}")
 
-    return documents
+
+def load_documents_from_directory(directory, catalogue):
+    """
+    Load all documents from the JSON/JSONL files in the specified directory.
+    The full service records go into catalogue, see iter_documents().
+
+    Prefer iter_documents() for large corpora, so documents are indexed
+    while they are being read instead of being held in memory.
+    """
+    return list(iter_documents(directory, catalogue))
 
 def main():
+    from rag.catalogue import ServiceCatalogue
+    from rag.vec_db import ChromaDB
+
     try:
         # Directory containing JSON documents
         document_directory = "./documents"
 
         # Load documents from the directory
-        docs = load_documents_from_directory(document_directory)
+        catalogue = ServiceCatalogue()
+        docs = load_documents_from_directory(document_directory, catalogue)
 
         if not docs:
             logging.warning("No documents found in the directory.")
             return
 
         # Initialize the Chroma vector store with loaded documents
-        vector_store = ChromaDB(docs)
+        vector_store = ChromaDB(docs, catalogue=catalogue)
 
         # Example query
         query = "voglio fare il passaporto come posso fare"
-        results = vector_store.get_from_chroma(query, comune="BA")
+        results = vector_store.get_from_chroma(query, comune="bari")
 
         print("Search Results:")
-        for result in results:
-            print(f"Content: {result.page_content}")
+        for result, score in results or []:
+            record = vector_store.catalogue.get(result.metadata["record_id"])
+            print(f"Content: {result.page_content} (score {score:.3f})")
             print(f"Metadata: {result.metadata}")
+            print(f"Info: {record.info[:200]}")
             print("---")
 
     except Exception as e:
@@ -73,4 +253,5 @@ def main():
 
 
 if __name__ == "__main__":
+    configure_logging()
     main()
\ No newline at end of file
@@ -1,64 +1,479 @@
+import asyncio
 import logging
+import os
 import random
-from typing import List, Dict
-import debugpy
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from init_db import load_documents_from_directory
-from rag.chain import initialize_chroma, run_handler
+import secrets
+import signal
+import time
+from contextlib import asynccontextmanager, suppress
+from typing import List, Dict, Optional
+from fastapi import (
+    FastAPI,
+    Header,
+    HTTPException,
+    Request,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+from rag.admission import AdmissionController, Busy
+from rag.booking import BookingStore, SlotUnavailable, UnknownSlot
+from rag.catalogue import ServiceCatalogue
+from rag import metrics
+from rag.log_config import configure_logging, set_session
+from rag.session_store import create_session_store
 import json
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+# Structured JSON logs written by a background thread (see rag/log_config.py)
+configure_logging()
 logger = logging.getLogger(__name__)
 
-# Enable debugger
-debugpy.listen(("0.0.0.0", 5678))
+# Enable debugger only when explicitly requested
+if os.getenv("DEBUGPY_ENABLED") == "1":
+    import debugpy
+
+    debugpy.listen(("0.0.0.0", int(os.getenv("DEBUGPY_PORT", "5678"))))
+
+# With EAGER_STARTUP=1 the app only starts accepting connections once every
+# component is warmed up (for platforms without readiness probes)
+EAGER_STARTUP = os.getenv("EAGER_STARTUP", "0") == "1"
+
+DOCUMENTS_DIR = "./documents"
+# Seconds between checks of the documents directory for changes, which are
+# then reloaded without a restart (0 disables the watcher; POST
+# /admin/reload triggers a reload on demand)
+RELOAD_INTERVAL = float(os.getenv("RELOAD_INTERVAL", "0"))
+# POST /admin/reload and POST /batch require it in the X-Admin-Token header,
+# and respond 404 when it is not set: one unauthenticated batch could start
+# thousands of paid LLM calls
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Set by serve.py to the master's pid: the master syncs the index once and
+# then signals the workers (SIGUSR1), which switch to it in place, instead of
+# each worker rewriting the same index directory
+supervisor_pid: Optional[int] = None
+# In a preloading master only: the index with its Chroma client, used by the
+# master alone to sync it (vectorstore is then the read-only view the forked
+# workers search)
+index_writer = None
+
+# Warm-up state of each component, reported by /ready
+readiness: Dict[str, bool] = {
+    "llm_client": False,
+    "model": False,
+    "index": False,
+    "booking": False,
+    "sessions": False,
+}
+startup_errors: Dict[str, str] = {}
+
+# Set by the warm-up steps below
+embeddings = None
+catalogue: ServiceCatalogue = None
+vectorstore = None
+router = None
+booking_store: BookingStore = None
+session_store = None
+
+
+def load_llm_client():
+    # One LLM client (and HTTP connection pool) shared by every session
+    from rag.llm_client import init_llm_client
+
+    init_llm_client()
+    readiness["llm_client"] = True
+
+
+def load_model():
+    global embeddings
+
+    # langchain, chromadb and sentence-transformers are only imported here
+    from rag.vec_db import load_embeddings
+
+    embeddings = load_embeddings()
+    readiness["model"] = True
+
+
+def load_index():
+    """
+    Load documents and initialize vector store (documents are validated and
+    streamed into the index, only new or changed ones are embedded). The
+    parsed service records live in the catalogue; Chroma only stores their IDs
+    """
+    global catalogue, vectorstore, router
+    from init_db import iter_documents
+    from rag.chain import initialize_chroma
+    from rag.router import ROUTER_ENABLED, IntentRouter
+
+    loaded = ServiceCatalogue()
+    vectorstore = initialize_chroma(
+        iter_documents(DOCUMENTS_DIR, loaded), loaded, embeddings
+    )
+    catalogue = loaded
+    # Local intent/service classifier that answers known requests without the LLM
+    if ROUTER_ENABLED:
+        router = IntentRouter(catalogue, embeddings)
+    readiness["index"] = True
+
+
+def load_booking():
+    global booking_store
+
+    # Appointment slots of every service, seeded from the documents' date_orari
+    store = BookingStore()
+    store.seed(catalogue.services())
+    booking_store = store
+    if router is not None:
+        # Booking answers from the router offer the slots still free
+        router.availability = store.availability
+    readiness["booking"] = True
+
+
+# Serialises reloads; never taken on the request path
+reload_lock = asyncio.Lock()
+
+
+def build_snapshot():
+    """
+    Build the next catalogue, index and router from the current documents
+    while the live ones keep serving. Only new or changed documents are
+    embedded, and the booking store follows the documents' dates (slots no
+    longer listed are retired, reservations are kept)
+    """
+    from init_db import iter_documents
+    from rag.router import ROUTER_ENABLED, IntentRouter
+
+    loaded = ServiceCatalogue()
+    writer = index_writer if index_writer is not None else vectorstore
+    store, added, deleted = writer.reload(iter_documents(DOCUMENTS_DIR, loaded), loaded)
+    new_router = IntentRouter(loaded, embeddings) if ROUTER_ENABLED else None
+    # A preloading master has no booking store: the workers seed theirs when
+    # they follow the reload
+    if booking_store is not None:
+        booking_store.seed(loaded.services())
+    stats = {
+        "added": added,
+        "deleted": deleted,
+        "documents": len(store.document_ids),
+        "version": store.version,
+    }
+    return loaded, store, new_router, stats
+
+
+def swap_snapshot(snapshot, start, record=True):
+    global catalogue, vectorstore, router
+
+    from rag.chain import semantic_cache
+
+    loaded, store, new_router, stats = snapshot
+    if new_router is not None and booking_store is not None:
+        # Booking answers from the router offer the slots still free
+        new_router.availability = booking_store.availability
+    catalogue, vectorstore, router = loaded, store, new_router
+    if semantic_cache is not None and (stats["added"] or stats["deleted"]):
+        # Cached answers were built from the previous documents (entries stored
+        # by messages still running on them are rejected by index version)
+        semantic_cache.clear()
+    elapsed = time.perf_counter() - start
+    if record:
+        metrics.INDEX_RELOADS.labels("ok").inc()
+        metrics.INDEX_RELOAD_DURATION.observe(elapsed)
+    stats["seconds"] = round(elapsed, 3)
+    logger.info(f"Documents reloaded: {stats}")
+    return stats
+
+
+async def reload_documents():
+    """
+    Build a new snapshot in a worker thread, then swap the module-level
+    references on the event loop. Messages already running finish on the
+    snapshot they were handed (run_handler gets vectorstore and router as
+    arguments), the following ones use the new one
+    """
+    async with reload_lock:
+        start = time.perf_counter()
+        try:
+            snapshot = await asyncio.to_thread(build_snapshot)
+        except Exception:
+            metrics.INDEX_RELOADS.labels("error").inc()
+            raise
+        # No await in between: a message never sees half of the swap
+        return swap_snapshot(snapshot, start)
+
+
+def reload_preloaded():
+    """
+    Reload in a preloading master (see serve.py), which serves no requests:
+    the snapshot is built and swapped in place, workers forked afterwards
+    inherit it and the running ones follow it (follow_reload)
+    """
+    global index_writer, vectorstore
+
+    start = time.perf_counter()
+    try:
+        snapshot = build_snapshot()
+    except Exception:
+        metrics.INDEX_RELOADS.labels("error").inc()
+        raise
+    stats = swap_snapshot(snapshot, start)
+    index_writer = vectorstore
+    vectorstore = index_writer.read_only()
+    return stats
+
+
+def build_follower_snapshot():
+    """
+    In a worker of a preloading master, once the master has synced the
+    index: read the documents into a new catalogue and reopen the
+    memory-mapped matrix index, without touching Chroma. None when the
+    index on disk is the one already in use
+    """
+    from init_db import iter_documents
+    from rag.router import ROUTER_ENABLED, IntentRouter
+
+    loaded = ServiceCatalogue()
+    for _ in iter_documents(DOCUMENTS_DIR, loaded):
+        pass
+    store = vectorstore.follow(loaded)
+    if store is None:
+        return None
+    new_router = IntentRouter(loaded, embeddings) if ROUTER_ENABLED else None
+    if booking_store is not None:
+        booking_store.seed(loaded.services())
+    stats = {
+        "added": len(store.document_ids - vectorstore.document_ids),
+        "deleted": len(vectorstore.document_ids - store.document_ids),
+        "documents": len(store.document_ids),
+        "version": store.version,
+    }
+    return loaded, store, new_router, stats
+
+
+async def follow_reload():
+    """
+    Switch a worker of a preloading master to the index the master has just
+    reloaded (on SIGUSR1, and once at startup in case the signal came before
+    the handler was installed). Like reload_documents, websocket sessions
+    and in-flight messages are not affected; the master records the reload
+    metrics
+    """
+    async with reload_lock:
+        start = time.perf_counter()
+        try:
+            snapshot = await asyncio.to_thread(build_follower_snapshot)
+        except Exception:
+            logger.exception("Could not follow the reload, keeping the previous snapshot")
+            return
+        if snapshot is not None:
+            swap_snapshot(snapshot, start, record=False)
+
+
+def can_reload():
+    return readiness["index"] and readiness["booking"]
 
-app = FastAPI()
 
-# Load documents and initialize vector store
-docs = load_documents_from_directory("./documents")
-vectorstore = initialize_chroma(docs)
+async def watch_documents():
+    """
+    Check the documents directory every RELOAD_INTERVAL seconds and reload
+    once a change has been stable for a whole interval, so a file still
+    being written is not picked up half-way
+    """
+    from init_db import documents_state
+
+    loaded_state = await asyncio.to_thread(documents_state, DOCUMENTS_DIR)
+    previous = loaded_state
+    while True:
+        await asyncio.sleep(RELOAD_INTERVAL)
+        state = await asyncio.to_thread(documents_state, DOCUMENTS_DIR)
+        if state != loaded_state and state == previous and can_reload():
+            try:
+                await reload_documents()
+            except Exception:
+                logger.exception("Document reload failed")
+            loaded_state = state
+        previous = state
+
+
+def preload():
+    """
+    Load the components that can be shared by forked workers (see serve.py).
+    The workers get the model and a read-only view of the index over the
+    memory-mapped matrix; the Chroma client (a SQLite connection) stays with
+    the master, which alone syncs the index
+    """
+    global index_writer, vectorstore
+
+    load_model()
+    load_index()
+    index_writer = vectorstore
+    vectorstore = index_writer.read_only()
 
 
-# Manages per-user session state
+async def warm_up():
+    """
+    Load every component not loaded yet, in a worker thread so the event loop
+    keeps answering /health and /ready meanwhile. Each step records its own
+    state, so /ready shows how far startup got
+    """
+    steps = [
+        ("llm_client", load_llm_client),
+        ("model", load_model),
+        ("index", load_index),
+        ("booking", load_booking),
+    ]
+    start = time.perf_counter()
+    for name, step in steps:
+        if readiness[name]:
+            continue
+        try:
+            await asyncio.to_thread(step)
+        except Exception as e:
+            startup_errors[name] = str(e)
+            logger.exception(f"Startup step {name} failed")
+            return
+        logger.info(f"{name} ready after {time.perf_counter() - start:.2f}s")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global session_store
+
+    # Per-process resources are opened here rather than at import time, so
+    # that a preloading master (see serve.py) never hands its SQLite
+    # connections or sockets to the forked workers
+
+    # Conversation state, kept outside the connection so a client can resume
+    # its session after reconnecting, possibly to another worker
+    session_store = create_session_store()
+    readiness["sessions"] = True
+
+    # Heavy components load in the background: the app accepts connections
+    # (and answers /health) right away, /ready turns 200 once they are loaded
+    warm_up_task = asyncio.create_task(warm_up())
+    if EAGER_STARTUP:
+        await warm_up_task
+
+    # Documents changed on disk are reloaded without dropping sessions
+    # (under serve.py the master watches them)
+    watch_task = None
+    if RELOAD_INTERVAL > 0 and supervisor_pid is None:
+        watch_task = asyncio.create_task(watch_documents())
+    follow_tasks = set()  # the event loop only keeps weak references
+
+    def schedule_follow():
+        task = asyncio.create_task(follow_reload())
+        follow_tasks.add(task)
+        task.add_done_callback(follow_tasks.discard)
+
+    if supervisor_pid is not None and readiness["index"]:
+        # The handler first, then the check: a reload finished before the
+        # handler was installed is picked up by the check
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, schedule_follow)
+        schedule_follow()
+
+    yield
+
+    warm_up_task.cancel()
+    if watch_task is not None:
+        watch_task.cancel()
+    for task in follow_tasks:
+        task.cancel()
+    if readiness["llm_client"]:
+        from rag.llm_client import close_llm_client
+
+        await close_llm_client()
+    await session_store.close()
+    if booking_store is not None:
+        booking_store.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# Manages the websocket connections of this process; the conversation state
+# itself lives in the session store
 class WebSocketConnectionManager:
     def __init__(self):
-        # Dictionary to store active connections and their session histories
+        # Dictionary to store active connections of this process
         self.active_connections: Dict[str, Dict] = {}
 
     async def connect(self, websocket: WebSocket):
         """
-        Establish a new WebSocket connection and initialize its session
+        Establish a new WebSocket connection and attach it to a session. A
+        client reconnecting with its session_id and resume_token query
+        parameters gets its previous session (and history) back
 
         Args:
             websocket (WebSocket): The incoming WebSocket connection
 
         Returns:
-            str: A unique session identifier for this connection
+            str: The session identifier for this connection
         """
         await websocket.accept()
 
-        # Generate a unique session ID
-        # You might want to use a more robust method in production
-        session_id = str(id(websocket))
-
-        # Initialize session state
-        self.active_connections[session_id] = {"websocket": websocket, "history": []}
+        session_id = websocket.query_params.get("session_id")
+        resume_token = websocket.query_params.get("resume_token")
+        resumed = bool(session_id and resume_token) and await session_store.resume(
+            session_id, resume_token
+        )
+        if not resumed:
+            session_id, resume_token = await session_store.create()
+
+        # The same session opened again (e.g. a reconnect before the old
+        # socket noticed the drop) replaces the previous connection
+        previous = self.active_connections.get(session_id)
+        if previous is not None:
+            self.disconnect(session_id)
+            with suppress(Exception):
+                await previous["websocket"].close()
+
+        # Initialize connection state
+        metrics.ACTIVE_SESSIONS.inc()
+        self.active_connections[session_id] = {
+            "websocket": websocket,
+            "resume_token": resume_token,
+            "resumed": resumed,
+            # In-flight message tasks, cancelled when the client disconnects
+            "tasks": set(),
+        }
 
         return session_id
 
-    def disconnect(self, session_id: str):
+    def disconnect(self, session_id: str, websocket: WebSocket = None):
         """
-        Remove a WebSocket connection from active connections
+        Remove a WebSocket connection from active connections and cancel
+        any message still being processed for it. The session itself stays
+        in the store until it expires, so the client can resume it
 
         Args:
             session_id (str): The unique identifier for the session
+            websocket (WebSocket, optional): Only disconnect if the session
+                is still attached to this connection
+        """
+        session = self.active_connections.get(session_id)
+        if session is None:
+            return
+        if websocket is not None and session["websocket"] is not websocket:
+            return
+        del self.active_connections[session_id]
+        metrics.ACTIVE_SESSIONS.dec()
+        for task in session["tasks"]:
+            task.cancel()
+
+    def submit_message(self, session_id: str, data: str):
+        """
+        Schedule an incoming message without blocking the receive loop, so a
+        disconnect is noticed while the RAG pipeline is still running
+
+        Args:
+            session_id (str): The unique identifier for the session
+            data (str): The incoming message data
         """
-        if session_id in self.active_connections:
-            del self.active_connections[session_id]
+        tasks = self.active_connections[session_id]["tasks"]
+        task = asyncio.create_task(self.handle_message(session_id, data))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
 
     async def send_welcome_message(self, session_id: str):
         """
@@ -73,9 +488,15 @@ class WebSocketConnectionManager:
             "Benvenuto! Sono PAI, il tuo alleato per semplificare l'accesso ai servizi pubblici. Come posso esserti utile?",
         ]
 
-        websocket = self.active_connections[session_id]["websocket"]
-        await websocket.send_json(
+        session = self.active_connections[session_id]
+        await session["websocket"].send_json(
             {
+                # Sent back as query parameters to resume the session
+                "session": {
+                    "id": session_id,
+                    "resume_token": session["resume_token"],
+                    "resumed": session["resumed"],
+                },
                 "message": {
                     "llm_response": {
                         "info": random.choice(welcomes),
@@ -97,46 +518,145 @@ class WebSocketConnectionManager:
         """
         session = self.active_connections[session_id]
         websocket = session["websocket"]
-        history = session["history"]
 
+        # One message in flight per session (so history stays ordered), a
+        # global concurrency limit and a bounded, fair queue in front of it
+        try:
+            async with admission.slot(session_id):
+                await self._process_message(session_id, websocket, data)
+        except Busy as e:
+            logger.warning("Session %s - Message rejected: %s", session_id, e.reason)
+            await self._send_busy_message(websocket, data, e)
+
+    async def _process_message(self, session_id, websocket, data):
+        trace = None
+        error = None
+        # Every record logged while handling this message carries the session
+        set_session(session_id)
         try:
             # Parse the incoming message
             parsed_data = json.loads(data)
-            logger.info(f"Session {session_id} - Parsed data: {parsed_data}")
+            logger.debug("Session %s - Parsed data: %s", session_id, parsed_data)
 
             input_value = parsed_data.get("message")
             selected_city = parsed_data.get("city")
+            stream = bool(parsed_data.get("stream"))
+
+            # Per-request timings; the trace ID (client-provided or generated)
+            # is echoed in every frame of the response
+            client_trace_id = parsed_data.get("trace_id")
+            trace = metrics.start_request(
+                selected_city,
+                client_trace_id[:64] if isinstance(client_trace_id, str) else None,
+            )
+            logger.info(
+                "Session %s - Message received",
+                session_id,
+                extra={"city": selected_city, "stream": stream},
+            )
+
+            if not (readiness["llm_client"] and readiness["index"]):
+                await self._send_system_message(
+                    websocket,
+                    trace,
+                    "The assistant is still starting up, please try again in a moment.",
+                )
+                return
+
+            # Imported once warm-up has loaded the RAG modules
+            from rag.chain import REQUEST_TIMEOUT, run_handler
+            from rag.context import history_entry
+
+            # Add human input to history (a ring buffer of the last entries)
+            history = await session_store.append_history(
+                session_id, f"human asked: {input_value}\n"
+            )
+
+            # In streaming mode the answer text is sent as "delta" frames
+            # while it is generated, and the full result as a "final" frame
+            async def send_delta(text):
+                await websocket.send_json(
+                    {
+                        "sender": "Computer",
+                        "type": "delta",
+                        "message": {"info": text},
+                        "trace_id": trace.trace_id,
+                    }
+                )
 
-            # Add human input to history
-            history.append(f"human asked: {input_value}\n")
+            on_info = send_delta if stream else None
 
             # Run the RAG pipeline
-            result = run_handler("".join(history), vectorstore, selected_city)
+            result = await asyncio.wait_for(
+                run_handler(
+                    "".join(history), vectorstore, selected_city, on_info, router
+                ),
+                timeout=REQUEST_TIMEOUT,
+            )
 
             # Add AI response to history
-            history.append(f"you answered: {result}\n")
-
-            # Maintain a limited history (last 4 exchanges)
-            while len(history) > 4:
-                history.pop(0)
+            await session_store.append_history(session_id, history_entry(result))
 
             # Send response back to the client
-            await websocket.send_json({"sender": "Computer", "message": result})
+            response = {"sender": "Computer", "message": result, "trace_id": trace.trace_id}
+            if stream:
+                response["type"] = "final"
+            if parsed_data.get("timings"):
+                # Per-stage durations (ms) and prompt tokens, for benchmarks/ws_load.py
+                response["timings"] = {
+                    name: round(duration * 1000, 3)
+                    for name, duration in trace.stages.items()
+                }
+                response["prompt_tokens"] = trace.prompt_tokens
+            with metrics.stage("websocket_send"):
+                await websocket.send_json(response)
+
+        except asyncio.TimeoutError as e:
+            error = e
+            logger.error("Session %s - Request timed out", session_id)
+            await self._send_system_message(
+                websocket, trace, "The request took too long, please try again."
+            )
 
         except Exception as e:
-            logger.error(f"Error in session {session_id}: {e}")
+            error = e
+            logger.error("Error in session %s: %s", session_id, e)
             # Optionally send an error message back to the client
-            await websocket.send_json(
-                {
-                    "sender": "System",
-                    "message": "An error occurred while processing your request.",
-                }
+            await self._send_system_message(
+                websocket, trace, "An error occurred while processing your request."
             )
 
+        finally:
+            if trace is not None:
+                metrics.finish_request(trace, error)
+
+    async def _send_busy_message(self, websocket, data, busy: Busy):
+        payload = {
+            "sender": "System",
+            "type": "busy",
+            "message": "The assistant is busy, please try again shortly.",
+            "reason": busy.reason,
+            "retry_after": busy.retry_after,
+        }
+        with suppress(ValueError, AttributeError):
+            trace_id = json.loads(data).get("trace_id")
+            if isinstance(trace_id, str):
+                payload["trace_id"] = trace_id[:64]
+        await websocket.send_json(payload)
+
+    async def _send_system_message(self, websocket, trace, message):
+        payload = {"sender": "System", "message": message}
+        if trace is not None:
+            payload["trace_id"] = trace.trace_id
+        await websocket.send_json(payload)
+
 
 # Create a connection manager instance
 connection_manager = WebSocketConnectionManager()
 
+# Admission control for the RAG pipeline of this process
+admission = AdmissionController()
+
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
@@ -154,23 +674,181 @@ async def websocket_endpoint(websocket: WebSocket):
         # Listen for messages
         while True:
             data = await websocket.receive_text()
-            logger.info(f"Session {session_id} - Received: {data}")
 
-            # Handle the incoming message
-            await connection_manager.handle_message(session_id, data)
+            # Handle the incoming message in the background
+            connection_manager.submit_message(session_id, data)
 
     except WebSocketDisconnect:
         logger.info(f"WebSocket {session_id} disconnected")
         if session_id:
-            connection_manager.disconnect(session_id)
+            connection_manager.disconnect(session_id, websocket)
 
     except Exception as e:
         logger.error(f"Unexpected error in WebSocket {session_id}: {e}")
         if session_id:
-            connection_manager.disconnect(session_id)
+            connection_manager.disconnect(session_id, websocket)
 
 
 # Optional: Add a health check endpoint
 @app.get("/health")
 async def health_check():
+    """
+    Liveness: the process is up and serving requests (it may still be
+    warming up, see /ready)
+    """
     return {"status": "healthy"}
+
+
+@app.get("/ready")
+async def readiness_check(response: Response):
+    """
+    Readiness: 200 once every component is warmed up, 503 before that (or
+    if a startup step failed), with the state of each component
+    """
+    ready = all(readiness.values())
+    if not ready:
+        response.status_code = 503
+    status = {"status": "ready" if ready else "starting", "components": readiness}
+    if startup_errors:
+        status["status"] = "failed"
+        status["errors"] = startup_errors
+    return status
+
+
+def _require_admin(x_admin_token):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Admin endpoints are disabled")
+    if not (x_admin_token and secrets.compare_digest(x_admin_token, ADMIN_TOKEN)):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.post("/admin/reload")
+async def reload_endpoint(x_admin_token: Optional[str] = Header(None)):
+    """
+    Reload the documents without a restart: only new or changed documents
+    are embedded, and websocket sessions and in-flight messages are not
+    affected. Responds 409 while another reload is running. Under serve.py
+    the master reloads and then restarts the workers one at a time, so this
+    responds 202 right away. Disabled (404) unless ADMIN_TOKEN is set
+    """
+    _require_admin(x_admin_token)
+    if supervisor_pid is not None:
+        os.kill(supervisor_pid, signal.SIGHUP)
+        return JSONResponse(status_code=202, content={"status": "scheduled"})
+    if not can_reload():
+        raise HTTPException(status_code=503, detail="The index is starting up")
+    if reload_lock.locked():
+        raise HTTPException(status_code=409, detail="A reload is already in progress")
+    try:
+        return await reload_documents()
+    except Exception as e:
+        logger.exception("Document reload failed")
+        raise HTTPException(status_code=500, detail=f"Reload failed: {e}")
+
+
+@app.post("/batch")
+async def batch_endpoint(request: Request, x_admin_token: Optional[str] = Header(None)):
+    """
+    Run many questions through the RAG pipeline. The body is JSONL, one
+    {"id", "message", "city"} object per line; the response streams one
+    JSONL result per question as soon as it is ready (see rag/batch.py).
+    Each pipeline run takes one of the few admission slots reserved for
+    batches, and only when no websocket session is waiting for it
+    """
+    _require_admin(x_admin_token)
+    if not (readiness["llm_client"] and readiness["index"]):
+        raise HTTPException(status_code=503, detail="The assistant is starting up")
+    from rag.batch import parse_items, run_batch
+
+    try:
+        items, errors = parse_items((await request.body()).splitlines())
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    # The snapshot in use now serves the whole batch, even across a reload
+    store, batch_router = vectorstore, router
+
+    async def stream():
+        for error in errors:
+            yield json.dumps(error, ensure_ascii=False) + "\n"
+        async for result in run_batch(items, store, batch_router, admission=admission):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+class ReservationRequest(BaseModel):
+    comune: str
+    service: str
+    date: str
+    slot: str
+    citizen: Optional[str] = None
+
+
+def _require_booking():
+    if booking_store is None:
+        raise HTTPException(status_code=503, detail="Booking service is starting up")
+    return booking_store
+
+
+# Plain def: availability waits for the store's lock and queries SQLite
+@app.get("/bookings/{comune}/{service}")
+def booking_availability(comune: str, service: str, date: Optional[str] = None):
+    """
+    Free slots of a service, from the in-memory availability index
+
+    Args:
+        comune (str): The comune offering the service, e.g. "roma"
+        service (str): The service name, e.g. "passaporto"
+        date (str, optional): Only return the slots of this day (YYYY-MM-DD)
+    """
+    try:
+        slots = _require_booking().availability(comune.lower(), service, date)
+    except UnknownSlot as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"comune": comune.lower(), "service": service, "slots": slots}
+
+
+# Plain def: reservations hit SQLite, so FastAPI runs them in its threadpool
+@app.post("/bookings", status_code=201)
+def create_booking(request: ReservationRequest):
+    """
+    Atomically reserve a slot; responds 409 when the slot is already taken
+    """
+    try:
+        reservation_id = _require_booking().reserve(
+            request.comune.lower(), request.service, request.date, request.slot,
+            request.citizen,
+        )
+    except UnknownSlot as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except SlotUnavailable as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return booking_store.get_reservation(reservation_id)
+
+
+@app.get("/bookings/{reservation_id}")
+def get_booking(reservation_id: str):
+    reservation = _require_booking().get_reservation(reservation_id)
+    if reservation is None:
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    return reservation
+
+
+@app.delete("/bookings/{reservation_id}")
+def cancel_booking(reservation_id: str):
+    """
+    Release a reservation, making its slot available again
+    """
+    if not _require_booking().release(reservation_id):
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    return {"id": reservation_id, "status": "cancelled"}
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """
+    Prometheus metrics: per-stage latency histograms, LLM token, retry and
+    error counters, and active websocket sessions
+    """
+    content, content_type = metrics.render()
+    return Response(content=content, media_type=content_type)
@@ -0,0 +1,287 @@
+import asyncio
+import os
+from collections import deque
+from contextlib import asynccontextmanager
+
+from . import metrics
+
+# Richieste elaborate contemporaneamente (ognuna fa una o due chiamate al modello)
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "32"))
+# Richieste in attesa, in totale e per sessione
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+ADMISSION_SESSION_QUEUE = int(os.getenv("ADMISSION_SESSION_QUEUE", "2"))
+# Attesa massima in coda prima che la richiesta venga scartata
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "10"))
+# Un nuovo messaggio di una sessione con messaggi in attesa: "queue" lo mette
+# in coda, "supersede" scarta quelli in attesa
+ADMISSION_SESSION_POLICY = os.getenv("ADMISSION_SESSION_POLICY", "queue")
+# Slot occupati al più insieme dalle richieste in blocco (POST /batch), in
+# tutto il processo, e solo quando nessuna conversazione li può usare
+ADMISSION_BATCH_SLOTS = int(os.getenv("ADMISSION_BATCH_SLOTS", "4"))
+
+
+class Busy(Exception):
+    """Richiesta non ammessa: il client può riprovare dopo retry_after secondi."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("future", "enqueued")
+
+    def __init__(self, future, enqueued):
+        self.future = future
+        self.enqueued = enqueued
+
+
+class AdmissionController:
+    """
+    Limita le richieste in elaborazione e distribuisce gli slot liberi in modo
+    equo tra le sessioni.
+
+    - al più max_concurrency richieste in elaborazione in tutto il processo;
+    - al più una richiesta in elaborazione per sessione, le successive
+      attendono in ordine (o sostituiscono quelle in attesa con "supersede");
+    - le sessioni in attesa sono servite a turno (round robin), quindi un
+      client che invia molti messaggi non ritarda gli altri;
+    - la coda è limitata: una richiesta viene rifiutata subito se la coda è
+      piena o se l'attesa stimata supera max_wait, e scartata se resta in
+      coda oltre max_wait;
+    - le richieste in blocco (batch_slot) hanno priorità più bassa: ricevono
+      uno slot solo se nessuna conversazione in attesa lo può usare, e al
+      più batch_slots insieme.
+
+    Va usato dall'event loop.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=ADMISSION_MAX_CONCURRENCY,
+        max_queue=ADMISSION_MAX_QUEUE,
+        session_queue=ADMISSION_SESSION_QUEUE,
+        max_wait=ADMISSION_MAX_WAIT,
+        policy=ADMISSION_SESSION_POLICY,
+        batch_slots=ADMISSION_BATCH_SLOTS,
+    ):
+        if policy not in ("queue", "supersede"):
+            raise ValueError(f"Politica di ammissione sconosciuta: {policy}")
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.session_queue = session_queue
+        self.max_wait = max_wait
+        self.policy = policy
+        self.batch_slots = batch_slots
+        self.in_flight = 0
+        self.batch_in_flight = 0
+        self.queued = 0
+        self._running = set()  # sessioni con una richiesta in elaborazione
+        self._waiting = {}  # sessione -> deque di _Waiter
+        self._turns = deque()  # sessioni con richieste in attesa, a turno
+        self._batch_waiting = deque()  # _Waiter delle richieste in blocco
+        self._service_time = None  # media mobile della durata di una richiesta
+
+    def _retry_after(self):
+        service_time = self._service_time or 1.0
+        return round(service_time * (1 + self.queued / self.max_concurrency), 1)
+
+    def _reject(self, reason):
+        metrics.ADMISSION_REJECTED.labels(reason).inc()
+        return Busy(reason, self._retry_after())
+
+    def _update_gauges(self):
+        metrics.ADMISSION_IN_FLIGHT.set(self.in_flight)
+        metrics.ADMISSION_QUEUE_DEPTH.set(self.queued)
+
+    @asynccontextmanager
+    async def slot(self, session_id):
+        """
+        Attende uno slot per la sessione e lo rilascia all'uscita.
+
+        Raises:
+            Busy: se la richiesta è rifiutata, scartata o sostituita
+        """
+        await self._acquire(session_id)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            yield
+        finally:
+            self._release(session_id, loop.time() - start)
+
+    @asynccontextmanager
+    async def batch_slot(self, timeout):
+        """
+        Attende uno slot per una richiesta in blocco, al più timeout secondi,
+        e lo rilascia all'uscita.
+
+        Raises:
+            Busy: se nessuno slot si libera entro timeout ("batch_deadline")
+        """
+        loop = asyncio.get_running_loop()
+        if not self._batch_waiting and self._batch_can_run():
+            self._grant_batch()
+        else:
+            waiter = _Waiter(loop.create_future(), loop.time())
+            self._batch_waiting.append(waiter)
+            try:
+                await asyncio.wait_for(waiter.future, timeout=timeout)
+            except asyncio.TimeoutError:
+                self._batch_waiting.remove(waiter)
+                raise self._reject("batch_deadline")
+            except BaseException:
+                future = waiter.future
+                if future.done() and not future.cancelled():
+                    # Slot assegnato mentre la richiesta veniva annullata
+                    self._release_batch(None)
+                else:
+                    self._batch_waiting.remove(waiter)
+                raise
+        start = loop.time()
+        try:
+            yield
+        finally:
+            self._release_batch(loop.time() - start)
+
+    def _batch_can_run(self):
+        # Con slot liberi, le sessioni ancora in coda (_dispatch le serve per
+        # prime) attendono la propria richiesta in corso, non uno slot
+        return (
+            self.in_flight < self.max_concurrency
+            and self.batch_in_flight < self.batch_slots
+        )
+
+    def _grant_batch(self):
+        self.in_flight += 1
+        self.batch_in_flight += 1
+        self._update_gauges()
+
+    def _release_batch(self, elapsed):
+        self.batch_in_flight -= 1
+        self._release(None, elapsed)
+
+    async def _acquire(self, session_id):
+        waiters = self._waiting.get(session_id)
+        if (
+            self.in_flight < self.max_concurrency
+            and session_id not in self._running
+            and not waiters
+        ):
+            self._grant(session_id)
+            metrics.ADMISSION_WAIT.observe(0)
+            return
+
+        if waiters and self.policy == "supersede":
+            while waiters:
+                self._drop(waiters.popleft(), self._reject("superseded"))
+        elif waiters and len(waiters) >= self.session_queue:
+            raise self._reject("session_busy")
+        if self.queued >= self.max_queue:
+            raise self._reject("queue_full")
+        if self._service_time is not None and session_id not in self._running:
+            # Stima dell'attesa: le richieste già in coda si dividono gli slot
+            expected = self._service_time * (1 + self.queued // self.max_concurrency)
+            if expected > self.max_wait:
+                raise self._reject("overloaded")
+
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(loop.create_future(), loop.time())
+        if session_id not in self._waiting:
+            self._waiting[session_id] = deque()
+            self._turns.append(session_id)
+        self._waiting[session_id].append(waiter)
+        self.queued += 1
+        self._update_gauges()
+
+        try:
+            await asyncio.wait_for(waiter.future, timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            self._remove(session_id, waiter)
+            raise self._reject("deadline")
+        except BaseException:
+            future = waiter.future
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # Slot assegnato mentre la richiesta veniva annullata
+                self._release(session_id, None)
+            else:
+                self._remove(session_id, waiter)
+            raise
+        metrics.ADMISSION_WAIT.observe(loop.time() - waiter.enqueued)
+
+    def _grant(self, session_id):
+        self.in_flight += 1
+        self._running.add(session_id)
+        self._update_gauges()
+
+    def _drop(self, waiter, error):
+        self.queued -= 1
+        if not waiter.future.done():
+            waiter.future.set_exception(error)
+        self._update_gauges()
+
+    def _remove(self, session_id, waiter):
+        waiters = self._waiting.get(session_id)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self.queued -= 1
+            self._update_gauges()
+
+    def _release(self, session_id, elapsed):
+        self.in_flight -= 1
+        self._running.discard(session_id)
+        if elapsed is not None:
+            self._service_time = (
+                elapsed
+                if self._service_time is None
+                else 0.9 * self._service_time + 0.1 * elapsed
+            )
+        self._dispatch()
+        self._update_gauges()
+
+    def _dispatch(self):
+        """Assegna gli slot liberi alle sessioni in attesa, a turno."""
+        skipped = 0
+        while self.in_flight < self.max_concurrency and skipped < len(self._turns):
+            session_id = self._turns.popleft()
+            waiters = self._waiting.get(session_id)
+            # Scarta le richieste già annullate o scadute
+            while waiters and waiters[0].future.done():
+                waiters.popleft()
+                self.queued -= 1
+            if not waiters:
+                self._waiting.pop(session_id, None)
+                continue
+            if session_id in self._running:
+                self._turns.append(session_id)
+                skipped += 1
+                continue
+
+            waiter = waiters.popleft()
+            self.queued -= 1
+            self._grant(session_id)
+            waiter.future.set_result(None)
+            if waiters:
+                self._turns.append(session_id)
+            else:
+                del self._waiting[session_id]
+            skipped = 0
+
+        # Le richieste in blocco ricevono gli slot avanzati
+        while self._batch_waiting and self._batch_can_run():
+            waiter = self._batch_waiting.popleft()
+            if waiter.future.done():
+                continue
+            self._grant_batch()
+            waiter.future.set_result(None)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "sessions_waiting": len(self._waiting),
+            "batch_in_flight": self.batch_in_flight,
+            "batch_waiting": len(self._batch_waiting),
+            "service_time": self._service_time,
+        }
@@ -0,0 +1,282 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+import numpy as np
+
+from . import metrics
+from .admission import Busy
+from .chain import REQUEST_TIMEOUT, run_handler
+from .log_config import set_session
+from .retrieval import (
+    _HUMAN_PREFIX,
+    RETRIEVAL_STRATEGY,
+    heuristic_rewrite,
+    normalize_text,
+)
+from .vec_db import use_precomputed_embeddings
+
+logger = logging.getLogger(__name__)
+
+# Pipeline (e quindi chiamate al modello) in esecuzione insieme per blocco
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "16"))
+# Similarità coseno oltre la quale due richieste dello stesso comune
+# condividono un'unica esecuzione della pipeline (> 1: solo quelle uguali a
+# meno di maiuscole, accenti composti, spazi e punteggiatura)
+BATCH_DEDUP_SIMILARITY = float(os.getenv("BATCH_DEDUP_SIMILARITY", "0.97"))
+# Richieste massime per blocco
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+# Richieste il cui embedding è calcolato con una sola chiamata al modello
+BATCH_EMBEDDING_CHUNK = int(os.getenv("BATCH_EMBEDDING_CHUNK", "256"))
+# Secondi di attesa massima di uno slot di ammissione per richiesta: oltre,
+# la richiesta riceve un risultato di errore
+BATCH_ADMISSION_TIMEOUT = float(os.getenv("BATCH_ADMISSION_TIMEOUT", "300"))
+
+
+def parse_items(lines):
+    """
+    Legge le righe JSONL {"id", "message", "city"} (id facoltativo: numero
+    di riga). Restituisce le richieste valide e i risultati di errore delle
+    righe non valide.
+    """
+    items, errors = [], []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        row = None
+        try:
+            row = json.loads(line)
+            message, city = row["message"], row["city"]
+            if not (isinstance(message, str) and message.strip() and isinstance(city, str)):
+                raise ValueError("message e city devono essere stringhe non vuote")
+        except (ValueError, KeyError, TypeError) as e:
+            item_id = row.get("id", number) if isinstance(row, dict) else number
+            errors.append({"id": item_id, "error": f"Riga {number} non valida: {e}"})
+            continue
+        items.append(
+            {"id": row.get("id", number), "message": message, "city": city.lower().strip()}
+        )
+        if len(items) > BATCH_MAX_ITEMS:
+            raise ValueError(f"Più di {BATCH_MAX_ITEMS} richieste nel blocco")
+    return items, errors
+
+
+def history(message):
+    """Cronologia di una conversazione con un solo messaggio, come in main.py."""
+    return f"{_HUMAN_PREFIX}{message}\n"
+
+
+class _Run:
+    """Una esecuzione della pipeline e le richieste che ne ricevono il risultato."""
+
+    __slots__ = ("item", "duplicates", "outcome")
+
+    def __init__(self, item):
+        self.item = item
+        self.duplicates = []
+        # (risultato, errore, durata) una volta terminata
+        self.outcome = None
+
+    def texts(self):
+        """
+        Testi di cui la pipeline calcola l'embedding: il messaggio (router,
+        cache semantica, ricerca con le strategie raw e parallel) e, con la
+        strategia heuristic, la richiesta ripulita. La riformulazione del
+        modello non è nota prima: quell'embedding passa dal micro-batching
+        di EmbeddingBatcher.
+        """
+        message = self.item["message"].strip()
+        texts = [message]
+        if RETRIEVAL_STRATEGY == "heuristic":
+            texts.append(heuristic_rewrite(message))
+        return texts
+
+
+def plan(items):
+    """Raggruppa le richieste per comune, unendo quelle uguali: {comune: [_Run]}"""
+    runs = {}
+    for item in items:
+        key = normalize_text(item["message"])
+        group = runs.setdefault(item["city"], {})
+        if key in group:
+            group[key].duplicates.append(item)
+        else:
+            group[key] = _Run(item)
+    return {city: list(group.values()) for city, group in runs.items()}
+
+
+class _SimilarRuns:
+    """Esecuzioni già pianificate di un comune, per riconoscere le richieste quasi uguali."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.runs = []
+        self.vectors = []
+
+    def find(self, run, vector):
+        """L'esecuzione simile a run già pianificata, o None (run viene aggiunta)."""
+        vector = np.asarray(vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        if self.threshold <= 1.0 and self.vectors:
+            similarities = np.stack(self.vectors) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                return self.runs[best]
+        self.runs.append(run)
+        self.vectors.append(vector)
+        return None
+
+
+async def run_batch(
+    items,
+    vectorstore,
+    router=None,
+    concurrency=BATCH_CONCURRENCY,
+    dedup_similarity=BATCH_DEDUP_SIMILARITY,
+    admission=None,
+):
+    """
+    Esegue run_handler per ogni richiesta e restituisce i risultati (async
+    generator) man mano che sono pronti, non nell'ordine di ingresso.
+
+    Le richieste sono raggruppate per comune: gli embedding di cui la
+    pipeline ha bisogno sono calcolati con una chiamata al modello per
+    BATCH_EMBEDDING_CHUNK richieste, e le richieste uguali o quasi uguali
+    (dedup_similarity) condividono una sola esecuzione. Al più concurrency
+    pipeline sono in corso insieme; con admission (AdmissionController)
+    ognuna occupa anche uno degli slot riservati ai blocchi (batch_slot),
+    solo quando le conversazioni non li usano, e se non ne ottiene uno entro
+    BATCH_ADMISSION_TIMEOUT secondi riceve un risultato di errore.
+
+    Ogni risultato riporta latency_ms (dall'inizio del blocco) e
+    pipeline_ms (durata dell'esecuzione), e duplicate_of per le richieste
+    servite dall'esecuzione di un'altra. Ogni richiesta riceve esattamente
+    un risultato, anche se la pianificazione si interrompe con un errore.
+    """
+    batch_id = uuid.uuid4().hex[:12]
+    start = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    results = asyncio.Queue()
+    # Richieste senza risultato, per identità (gli id possono ripetersi)
+    pending = {id(item): item for item in items}
+    tasks = []
+
+    def publish(run, items):
+        output, error, duration = run.outcome
+        latency = round((time.perf_counter() - start) * 1000, 3)
+        for item in items:
+            if pending.pop(id(item), None) is None:
+                continue
+            result = {
+                "id": item["id"],
+                "city": item["city"],
+                "latency_ms": latency,
+                "pipeline_ms": round(duration * 1000, 3),
+            }
+            if run.item is not None and item is not run.item:
+                result["duplicate_of"] = run.item["id"]
+                metrics.BATCH_ITEMS.labels("duplicate").inc()
+            else:
+                metrics.BATCH_ITEMS.labels("ok" if error is None else "error").inc()
+            if error is not None:
+                result["error"] = str(error) or type(error).__name__
+            else:
+                result["result"] = output
+            results.put_nowait(result)
+
+    async def execute(run, vectors):
+        set_session(f"batch-{batch_id}")
+        use_precomputed_embeddings(vectors)
+        trace = metrics.start_request(run.item["city"], batch=True)
+        error = None
+        try:
+            output = await asyncio.wait_for(
+                run_handler(
+                    history(run.item["message"]),
+                    vectorstore,
+                    run.item["city"],
+                    None,
+                    router,
+                ),
+                timeout=REQUEST_TIMEOUT,
+            )
+        except Exception as e:
+            error = e
+            output = None
+        finally:
+            metrics.finish_request(trace, error)
+        run.outcome = (output, error, time.perf_counter() - trace.start)
+
+    async def admit(run, vectors):
+        try:
+            async with semaphore:
+                if admission is None:
+                    await execute(run, vectors)
+                else:
+                    # Le conversazioni hanno la precedenza sugli slot
+                    async with admission.batch_slot(BATCH_ADMISSION_TIMEOUT):
+                        await execute(run, vectors)
+        except Busy as e:
+            logger.warning("Richiesta del blocco %s non ammessa: %s", batch_id, e)
+            run.outcome = (None, e, 0.0)
+        except Exception as e:
+            logger.exception("Esecuzione del blocco %s non riuscita", batch_id)
+            run.outcome = (None, e, 0.0)
+        publish(run, [run.item] + run.duplicates)
+
+    async def schedule():
+        for city, runs in plan(items).items():
+            similar = _SimilarRuns(dedup_similarity)
+            for offset in range(0, len(runs), BATCH_EMBEDDING_CHUNK):
+                chunk = runs[offset : offset + BATCH_EMBEDDING_CHUNK]
+                texts = list(dict.fromkeys(t for run in chunk for t in run.texts()))
+                try:
+                    with metrics.stage("embedding"):
+                        embedded = await vectorstore.aembed_documents(texts)
+                except Exception as e:
+                    logger.error("Embedding del blocco %s non riuscito: %s", batch_id, e)
+                    for run in chunk:
+                        run.outcome = (None, e, 0.0)
+                        publish(run, [run.item] + run.duplicates)
+                    continue
+                vectors = dict(zip(texts, embedded))
+                for run in chunk:
+                    target = similar.find(run, vectors[run.item["message"].strip()])
+                    if target is None:
+                        tasks.append(asyncio.create_task(admit(run, vectors)))
+                    elif target.outcome is None:
+                        target.duplicates += [run.item] + run.duplicates
+                    else:
+                        # Esecuzione simile già terminata: stesso risultato subito
+                        publish(target, [run.item] + run.duplicates)
+
+    async def schedule_or_fail():
+        try:
+            await schedule()
+        except Exception as e:
+            logger.exception("Pianificazione del blocco %s interrotta", batch_id)
+            # Le esecuzioni avviate pubblicano i propri risultati, le
+            # richieste rimaste ricevono l'errore
+            await asyncio.gather(*tasks, return_exceptions=True)
+            failed = _Run(None)
+            failed.outcome = (None, e, 0.0)
+            publish(failed, list(pending.values()))
+
+    producer = asyncio.create_task(schedule_or_fail())
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    finally:
+        producer.cancel()
+        for task in tasks:
+            task.cancel()
+        logger.info(
+            "Blocco %s: %d richieste, %d esecuzioni della pipeline in %.2f s.",
+            batch_id,
+            len(items),
+            len(tasks),
+            time.perf_counter() - start,
+        )
@@ -0,0 +1,283 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+# Database delle prenotazioni e posti disponibili per ogni fascia oraria
+BOOKING_DB = os.getenv("BOOKING_DB", "./bookings.sqlite3")
+BOOKING_SLOT_CAPACITY = int(os.getenv("BOOKING_SLOT_CAPACITY", "1"))
+BOOKING_BUSY_TIMEOUT_MS = int(os.getenv("BOOKING_BUSY_TIMEOUT_MS", "5000"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS slots (
+    comune TEXT NOT NULL,
+    service TEXT NOT NULL,
+    date TEXT NOT NULL,
+    slot TEXT NOT NULL,
+    capacity INTEGER NOT NULL,
+    reserved INTEGER NOT NULL DEFAULT 0 CHECK (reserved >= 0 AND reserved <= capacity),
+    PRIMARY KEY (comune, service, date, slot)
+);
+CREATE TABLE IF NOT EXISTS reservations (
+    id TEXT PRIMARY KEY,
+    comune TEXT NOT NULL,
+    service TEXT NOT NULL,
+    date TEXT NOT NULL,
+    slot TEXT NOT NULL,
+    citizen TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reservations_slot
+    ON reservations (comune, service, date, slot);
+"""
+
+
+class UnknownSlot(LookupError):
+    """Fascia oraria non prevista per il servizio."""
+
+
+class SlotUnavailable(Exception):
+    """Fascia oraria senza posti liberi."""
+
+
+def normalize_date(date):
+    """2024-12-7 -> 2024-12-07"""
+    try:
+        return datetime.strptime(date, "%Y-%m-%d").date().isoformat()
+    except (TypeError, ValueError):
+        raise UnknownSlot(f"Data non valida: {date!r}")
+
+
+class BookingStore:
+    """
+    Prenotazioni delle fasce orarie dei servizi, salvate in SQLite (WAL).
+
+    La disponibilità è tenuta in memoria in un indice
+    (comune, service, data) -> {fascia: posti liberi}, ricaricato quando
+    PRAGMA data_version indica che un'altra connessione (un altro worker) ha
+    modificato il database: una ricerca costa una PRAGMA e non restituisce
+    mai posti già esauriti o liberati altrove. Prenotazioni e cancellazioni
+    sono transazioni atomiche decise dal database: l'UPDATE con la
+    condizione reserved < capacity garantisce che una fascia non venga mai
+    assegnata oltre la capienza, anche con più processi sullo stesso file.
+    """
+
+    def __init__(self, path=BOOKING_DB, capacity=BOOKING_SLOT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA busy_timeout={BOOKING_BUSY_TIMEOUT_MS}")
+        self._conn.executescript(_SCHEMA)
+        # La connessione è condivisa tra i thread: un'operazione alla volta
+        self._lock = threading.Lock()
+        self._availability = {}
+        self._data_version = None
+        self._load_availability()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _load_availability(self):
+        # Letta prima delle fasce: una modifica concorrente causa al più un
+        # ricaricamento in più
+        self._data_version = self._data_version_now()
+        availability = {}
+        rows = self._conn.execute(
+            "SELECT comune, service, date, slot, capacity - reserved FROM slots"
+        )
+        for comune, service, date, slot, free in rows:
+            availability.setdefault((comune, service, date), {})[slot] = free
+        self._availability = availability
+
+    def _data_version_now(self):
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _refresh(self):
+        # Con self._lock: i commit di questa connessione aggiornano già
+        # l'indice, data_version cambia solo per quelli delle altre
+        if self._data_version_now() != self._data_version:
+            self._load_availability()
+
+    def seed(self, records):
+        """
+        Allinea le fasce orarie ai ServiceRecord: inserisce quelle nuove e
+        ritira quelle non più presenti nei documenti. Una fascia ritirata
+        senza prenotazioni viene eliminata; con prenotazioni resta senza
+        altri posti (capacity = reserved) e le prenotazioni restano valide.
+        Le fasce ancora presenti e le relative prenotazioni restano
+        invariate. Senza alcuna fascia (nessun documento letto) non ne
+        viene ritirata nessuna.
+
+        Returns:
+            int: numero di fasce inserite o riaperte
+        """
+        rows = [
+            (record.comune, record.service, date, slot, self.capacity)
+            for record in records
+            for date, slots in record.date_orari.items()
+            for slot in slots
+        ]
+        wanted = {row[:4] for row in rows}
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                before = self._conn.total_changes
+                # Una fascia ritirata e poi di nuovo nei documenti viene riaperta
+                self._conn.executemany(
+                    "INSERT INTO slots (comune, service, date, slot, capacity) "
+                    "VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT DO UPDATE SET capacity = excluded.capacity "
+                    "WHERE capacity < excluded.capacity",
+                    rows,
+                )
+                inserted = self._conn.total_changes - before
+                retired = []
+                if wanted:
+                    retired = [
+                        key
+                        for key in self._conn.execute(
+                            "SELECT comune, service, date, slot FROM slots "
+                            "WHERE reserved < capacity"
+                        )
+                        if key not in wanted
+                    ]
+                self._conn.executemany(
+                    "DELETE FROM slots "
+                    "WHERE comune = ? AND service = ? AND date = ? AND slot = ? "
+                    "AND reserved = 0",
+                    retired,
+                )
+                self._conn.executemany(
+                    "UPDATE slots SET capacity = reserved "
+                    "WHERE comune = ? AND service = ? AND date = ? AND slot = ?",
+                    retired,
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._load_availability()
+        logging.info(
+            f"Prenotazioni: {inserted} fasce orarie nuove o riaperte su {len(rows)}, "
+            f"{len(retired)} ritirate."
+        )
+        return inserted
+
+    def availability(self, comune, service, date=None):
+        """Restituisce {data: [fasce con posti liberi]} dall'indice in memoria."""
+        if date is not None:
+            date = normalize_date(date)
+        with self._lock:
+            self._refresh()
+            availability = self._availability
+            if date is not None:
+                keys = [(comune, service, date)]
+            else:
+                keys = sorted(k for k in availability if k[:2] == (comune, service))
+            result = {}
+            for key in keys:
+                free = [slot for slot, n in availability.get(key, {}).items() if n > 0]
+                if free:
+                    result[key[2]] = sorted(free)
+        return result
+
+    def reserve(self, comune, service, date, slot, citizen=None):
+        """
+        Prenota un posto nella fascia indicata.
+
+        Returns:
+            str: ID della prenotazione
+
+        Raises:
+            UnknownSlot: se la fascia non esiste
+            SlotUnavailable: se la fascia non ha posti liberi
+        """
+        key = (comune, service, normalize_date(date))
+        with self._lock:
+            # Indice riallineato ai commit degli altri processi: un rifiuto
+            # rispecchia il database, senza prenderne il lock in scrittura
+            self._refresh()
+            free = self._availability.get(key, {}).get(slot)
+            if free is None:
+                raise UnknownSlot(f"Fascia {slot} del {key[2]} non disponibile per {service}")
+            if free <= 0:
+                raise SlotUnavailable(f"Fascia {slot} del {key[2]} esaurita")
+
+            reservation_id = uuid.uuid4().hex
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                updated = self._conn.execute(
+                    "UPDATE slots SET reserved = reserved + 1 "
+                    "WHERE comune = ? AND service = ? AND date = ? AND slot = ? "
+                    "AND reserved < capacity "
+                    "RETURNING capacity - reserved",
+                    (*key, slot),
+                ).fetchall()
+                if not updated:
+                    self._conn.execute("ROLLBACK")
+                    # Esaurita da un altro processo tra il controllo e l'UPDATE
+                    self._availability[key][slot] = 0
+                    raise SlotUnavailable(f"Fascia {slot} del {key[2]} esaurita")
+                self._conn.execute(
+                    "INSERT INTO reservations "
+                    "(id, comune, service, date, slot, citizen, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (reservation_id, *key, slot, citizen, time.time()),
+                )
+                self._conn.execute("COMMIT")
+            except SlotUnavailable:
+                raise
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._availability[key][slot] = updated[0][0]
+        return reservation_id
+
+    def release(self, reservation_id):
+        """
+        Annulla una prenotazione liberando il posto.
+
+        Returns:
+            bool: False se la prenotazione non esiste
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                deleted = self._conn.execute(
+                    "DELETE FROM reservations WHERE id = ? "
+                    "RETURNING comune, service, date, slot",
+                    (reservation_id,),
+                ).fetchall()
+                if not deleted:
+                    self._conn.execute("ROLLBACK")
+                    return False
+                free = self._conn.execute(
+                    "UPDATE slots SET reserved = reserved - 1 "
+                    "WHERE comune = ? AND service = ? AND date = ? AND slot = ? "
+                    "RETURNING capacity - reserved",
+                    deleted[0],
+                ).fetchall()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            comune, service, date, slot = deleted[0]
+            self._availability.setdefault((comune, service, date), {})[slot] = free[0][0]
+        return True
+
+    def get_reservation(self, reservation_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, comune, service, date, slot, citizen FROM reservations "
+                "WHERE id = ?",
+                (reservation_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("id", "comune", "service", "date", "slot", "citizen"), row))
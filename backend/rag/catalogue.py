@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import datetime
+
+_SLOT = re.compile(r"^\d{1,2}\.\d{2}-\d{1,2}\.\d{2}$")
+# Separa gli elementi di need_to_do sulle virgole non seguite da una cifra,
+# così gli importi come "€42,50" restano interi
+_ITEM_SEPARATOR = re.compile(r",(?!\d)")
+
+
+class InvalidDocument(ValueError):
+    """Documento con metadati mancanti o non validi."""
+
+
+def record_id(page_content, metadata):
+    """ID stabile calcolato dall'hash di contenuto e metadati originali."""
+    payload = json.dumps(
+        {"page_content": page_content, "metadata": metadata},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def parse_date_orari(value):
+    """
+    Converte date_orari in {data: [fasce orarie]} verificandone il formato.
+    Le date sono normalizzate in ISO (2024-12-7 -> 2024-12-07) e ordinate,
+    così router, contesto del modello e prenotazioni usano la stessa forma.
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value) if value.strip() else {}
+        except json.JSONDecodeError as e:
+            raise InvalidDocument(f"date_orari non è un JSON valido: {e}")
+    if not isinstance(value, dict):
+        raise InvalidDocument("date_orari deve essere un oggetto {data: [orari]}")
+
+    slots = {}
+    for date, times in value.items():
+        try:
+            day = datetime.strptime(date, "%Y-%m-%d").date().isoformat()
+        except (TypeError, ValueError):
+            raise InvalidDocument(f"data non valida in date_orari: {date!r}")
+        if not isinstance(times, list) or not all(
+            isinstance(t, str) and _SLOT.match(t) for t in times
+        ):
+            raise InvalidDocument(f"orari non validi per {date}: {times!r}")
+        # 2024-12-7 e 2024-12-07 sono lo stesso giorno
+        slots.setdefault(day, [])
+        slots[day] += [t for t in times if t not in slots[day]]
+    return dict(sorted(slots.items()))
+
+
+def parse_need_to_do(value):
+    """Converte need_to_do ("[a, b, c]" o lista) in una lista di stringhe."""
+    if isinstance(value, list):
+        items = value
+    elif isinstance(value, str):
+        text = value.strip()
+        try:
+            items = json.loads(text)
+        except json.JSONDecodeError:
+            if not (text.startswith("[") and text.endswith("]")):
+                raise InvalidDocument("need_to_do deve essere una lista [a, b, ...]")
+            items = _ITEM_SEPARATOR.split(text[1:-1])
+        if not isinstance(items, list):
+            raise InvalidDocument("need_to_do deve essere una lista [a, b, ...]")
+    else:
+        raise InvalidDocument("need_to_do deve essere una lista [a, b, ...]")
+    return [str(item).strip() for item in items if str(item).strip()]
+
+
+def service_from_filename(filepath):
+    """RM_passaporto.json -> passaporto"""
+    stem = os.path.splitext(os.path.basename(filepath))[0]
+    prefix, _, service = stem.partition("_")
+    return service or prefix
+
+
+class ServiceRecord:
+    """Scheda di un servizio di un comune, con i metadati già convertiti."""
+
+    __slots__ = (
+        "id",
+        "comune",
+        "service",
+        "page_content",
+        "info",
+        "date_orari",
+        "need_to_do",
+    )
+
+    def __init__(self, id, comune, service, page_content, info, date_orari, need_to_do):
+        self.id = id
+        self.comune = comune
+        self.service = service
+        self.page_content = page_content
+        self.info = info
+        self.date_orari = date_orari
+        self.need_to_do = need_to_do
+
+    @classmethod
+    def from_raw(cls, page_content, metadata, default_service=None):
+        """
+        Valida un documento nel formato dei file JSON e lo converte.
+
+        Raises:
+            InvalidDocument: se mancano campi obbligatori o non sono validi
+        """
+        if not isinstance(page_content, str) or not page_content.strip():
+            raise InvalidDocument("page_content mancante")
+        if not isinstance(metadata, dict):
+            raise InvalidDocument("metadata mancante")
+        comune = metadata.get("comune")
+        if not isinstance(comune, str) or not comune.strip():
+            raise InvalidDocument("metadata.comune mancante")
+        service = metadata.get("service") or default_service
+        if not service:
+            raise InvalidDocument("metadata.service mancante")
+        info = metadata.get("info", "")
+        if not isinstance(info, str):
+            raise InvalidDocument("metadata.info deve essere una stringa")
+
+        return cls(
+            id=record_id(page_content, metadata),
+            comune=comune.strip().lower(),
+            service=service,
+            page_content=page_content,
+            info=info,
+            date_orari=parse_date_orari(metadata.get("date_orari", {})),
+            need_to_do=parse_need_to_do(metadata.get("need_to_do", [])),
+        )
+
+    def index_metadata(self):
+        """Metadati salvati in Chroma: solo quanto serve a filtrare e risolvere."""
+        return {"comune": self.comune, "service": self.service, "record_id": self.id}
+
+    def prompt_text(self):
+        """Descrizione del servizio passata al modello per la risposta."""
+        return (
+            f"comune {self.comune} "
+            f"need_to_do [{', '.join(self.need_to_do)}] "
+            f"date_orari {json.dumps(self.date_orari)} "
+            f"info {self.info}"
+        )
+
+
+class ServiceCatalogue:
+    """Catalogo dei servizi in memoria, indicizzato per ID e per (comune, servizio)."""
+
+    def __init__(self):
+        self._by_id = {}
+        self._by_service = {}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def add(self, record: ServiceRecord):
+        existing = self._by_service.get((record.comune, record.service))
+        if existing is not None and existing.id != record.id:
+            logging.warning(
+                f"Servizio {record.service} duplicato per {record.comune}, "
+                "la ricerca per servizio restituisce l'ultimo caricato."
+            )
+        self._by_id[record.id] = record
+        self._by_service[(record.comune, record.service)] = record
+
+    def get(self, record_id):
+        return self._by_id.get(record_id)
+
+    def find(self, comune, service):
+        return self._by_service.get((comune, service))
+
+    def records(self):
+        """Tutte le schede, comprese quelle di servizi duplicati."""
+        return list(self._by_id.values())
+
+    def services(self, comune=None):
+        return [
+            record
+            for (record_comune, _), record in self._by_service.items()
+            if comune is None or record_comune == comune
+        ]
@@ -1,53 +1,277 @@
+import asyncio
+import copy
 import json
 import logging
 import os
+import re
+import time
+from collections import OrderedDict
 
+import numpy as np
 from dotenv import load_dotenv
-from openai import OpenAI
-
-from .vec_db import ChromaDB
+from openai import AsyncOpenAI
+
+from . import metrics
+from .catalogue import ServiceCatalogue, ServiceRecord
+from .context import build_history, build_record_context, count_message_tokens
+from .llm_client import LLM_MODEL, chat_completion, get_llm_client
+from .retrieval import (
+    PARALLEL_ACCEPT_SCORE,
+    RETRIEVAL_STRATEGIES,
+    RETRIEVAL_STRATEGY,
+    heuristic_rewrite,
+    last_user_turn,
+    normalize_text,
+)
+from .vec_db import ChromaDB, reuse_embeddings
 
 logger = logging.getLogger(__name__)
 
 # Carica le variabili d'ambiente
 load_dotenv()
 
-# Configurazione del logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("chain_app.log"), logging.StreamHandler()],
-)
+# Tempo massimo per l'intera pipeline di un messaggio
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "60"))
+
+# Cache semantica delle risposte
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "1") == "1"
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1024"))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
 
 # Configura il prompt per la formattazione della query
 
 
+class InfoStreamExtractor:
+    """
+    Estrae in modo incrementale il valore del campo "info" dal JSON generato
+    dal modello, così da poterlo inoltrare al client mentre viene prodotto.
+    """
+
+    _KEY = re.compile(r'"info"\s*:\s*"')
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = None  # inizio del valore ancora da decodificare
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        """Aggiunge un frammento e restituisce il nuovo testo di "info"."""
+        self.buffer += chunk
+        if self.done:
+            return ""
+        if self.pos is None:
+            match = self._KEY.search(self.buffer)
+            if match is None:
+                return ""
+            self.pos = match.end()
+
+        out = []
+        i = self.pos
+        while i < len(self.buffer):
+            char = self.buffer[i]
+            if char == '"':
+                self.done = True
+                i += 1
+                break
+            if char != "\\":
+                out.append(char)
+                i += 1
+                continue
+            # Sequenza di escape: attende che sia completa prima di decodificarla
+            length = 2
+            if self.buffer[i + 1 : i + 2] == "u":
+                length = 6
+                if self.buffer[i + 2 : i + 4].lower() in ("d8", "d9", "da", "db"):
+                    length = 12  # coppia surrogata
+            if i + length > len(self.buffer):
+                break
+            try:
+                out.append(json.loads('"' + self.buffer[i : i + length] + '"'))
+            except json.JSONDecodeError:
+                out.append(self.buffer[i + 1 : i + length])
+            i += length
+        self.pos = i
+        return "".join(out)
+
+
+class _CityEntries:
+    """Voci della cache di una città: un embedding per riga di una matrice."""
+
+    def __init__(self, dim, capacity=16):
+        self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self.keys = [None] * capacity  # chiave della voce per riga, None se libera
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def add(self, key, vector):
+        if not self.free:
+            capacity = len(self.keys)
+            self.matrix = np.vstack([self.matrix, np.zeros_like(self.matrix)])
+            self.keys += [None] * capacity
+            self.free = list(range(2 * capacity - 1, capacity - 1, -1))
+        row = self.free.pop()
+        self.matrix[row] = vector
+        self.keys[row] = key
+        return row
+
+    def remove(self, row):
+        self.matrix[row] = 0.0
+        self.keys[row] = None
+        self.free.append(row)
+
+    def candidates(self, query, threshold):
+        """Righe con similarità >= threshold, dalla più simile."""
+        scores = self.matrix @ query
+        rows = np.flatnonzero(scores >= threshold)
+        rows = rows[np.argsort(-scores[rows])]
+        return [int(row) for row in rows if self.keys[row] is not None]
+
+
+class SemanticCache:
+    """
+    Cache LRU con scadenza delle risposte, indicizzata per città ed embedding
+    dell'ultima richiesta dell'utente: una nuova richiesta con similarità
+    coseno maggiore o uguale a threshold rispetto a una già vista riusa la
+    query riformulata e, se disponibile, la risposta finale. Le richieste
+    il cui servizio è riconosciuto senza embedding (lookup_text) cercano
+    solo la stessa richiesta, a meno di maiuscole e punteggiatura.
+
+    Gli embedding di ogni città sono righe di una matrice, quindi una ricerca
+    è un solo prodotto matrice-vettore sulle voci di quella città. Ogni voce
+    ricorda la versione dell'indice con cui è stata generata e viene scartata
+    quando il vectorstore cambia (documenti aggiunti, modificati o rimossi,
+    anche da un ricaricamento).
+    """
+
+    def __init__(self, max_size=1024, ttl=3600.0, threshold=0.95):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = OrderedDict()
+        self._cities = {}  # città -> _CityEntries
+        self._texts = {}  # (città, richiesta normalizzata) -> chiave della voce
+        self._next_key = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _is_valid(self, entry, vectorstore, now):
+        return entry["expires"] >= now and entry["version"] == vectorstore.version
+
+    def lookup(self, city, embedding, vectorstore):
+        """Restituisce la voce più simile sopra la soglia, oppure None."""
+        now = time.monotonic()
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        partition = self._cities.get(city)
+        rows = partition.candidates(query, self.threshold) if partition else []
+        for row in rows:
+            entry = self._entries[partition.keys[row]]
+            if self._is_valid(entry, vectorstore, now):
+                self.hits += 1
+                self._entries.move_to_end(entry["key"])
+                return entry
+            self.discard(entry)
+        self.misses += 1
+        return None
+
+    def lookup_text(self, city, text, vectorstore):
+        """Restituisce la voce della stessa richiesta, senza embedding, oppure None."""
+        entry = self._entries.get(self._texts.get((city, normalize_text(text))))
+        if entry is not None and self._is_valid(entry, vectorstore, time.monotonic()):
+            self.hits += 1
+            self._entries.move_to_end(entry["key"])
+            return entry
+        if entry is not None:
+            self.discard(entry)
+        self.misses += 1
+        return None
+
+    def store(self, city, text, embedding, formatted_query, output, version):
+        """Salva la risposta; senza embedding la trova solo lookup_text."""
+        key = self._next_key
+        self._next_key += 1
+        row = None
+        if embedding is not None:
+            vector = np.asarray(embedding, dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+            partition = self._cities.get(city)
+            if partition is None:
+                partition = self._cities[city] = _CityEntries(len(vector))
+            row = partition.add(key, vector)
+        text = normalize_text(text)
+        previous = self._entries.get(self._texts.get((city, text)))
+        if previous is not None:
+            self.discard(previous)
+        self._texts[(city, text)] = key
+        self._entries[key] = {
+            "key": key,
+            "city": city,
+            "text": text,
+            "row": row,
+            "formatted_query": formatted_query,
+            "version": version,
+            "output": output,
+            "expires": time.monotonic() + self.ttl,
+        }
+        while len(self._entries) > self.max_size:
+            self.discard(next(iter(self._entries.values())))
+
+    def discard(self, entry):
+        if self._entries.pop(entry["key"], None) is None:
+            return
+        if entry["row"] is not None:
+            self._cities[entry["city"]].remove(entry["row"])
+        if self._texts.get((entry["city"], entry["text"])) == entry["key"]:
+            del self._texts[(entry["city"], entry["text"])]
+
+    def clear(self):
+        self._entries.clear()
+        self._cities.clear()
+        self._texts.clear()
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+semantic_cache = (
+    SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD)
+    if SEMANTIC_CACHE_ENABLED
+    else None
+)
+
+
 # Configura il vectorstore Chroma
-def initialize_chroma(docs):
-    db = ChromaDB(docs)
+def initialize_chroma(docs, catalogue: ServiceCatalogue = None, embeddings=None):
+    db = ChromaDB(docs, catalogue=catalogue, embeddings=embeddings)
     return db
 
 
 # Classe per gestire le interazioni con OpenAI e Chroma
 class LlamaChromaHandler:
-    def __init__(self, vectorstore):
-        self.client = OpenAI(
-            base_url="https://api.aimlapi.com/v1",  # URL dell'API
-            api_key=os.getenv("API_KEY"),  # Chiave API
-        )
+    def __init__(
+        self, vectorstore, client: AsyncOpenAI = None, strategy=RETRIEVAL_STRATEGY
+    ):
+        if strategy not in RETRIEVAL_STRATEGIES:
+            raise ValueError(f"Strategia di ricerca sconosciuta: {strategy}")
+        self.client = client if client is not None else get_llm_client()
         self.vectorstore = vectorstore
+        self.strategy = strategy
+
+    async def send_response(self, query: str, result: str, on_info=None) -> str:
+        """
+        Invia una richiesta al modello Llama e restituisce solo un JSON strutturato.
 
-    def send_response(self, query: str, result: str) -> str:
-        """Invia una richiesta al modello Llama e restituisce solo un JSON strutturato."""
+        Se on_info è fornita, la risposta viene generata in streaming e il testo
+        del campo "info" viene passato a on_info man mano che arriva.
+        """
         user_content = f"""Richiesta originale dell'utente: {query}
                             Risposta dal database: {result}"""
 
-        response = self.client.chat.completions.create(
-            model="meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo",  # Modello utilizzato
-            messages=[
-                {
-                    "role": "system",
-                    "content": """Sei un assistente esperto di comunicazione chiara e accessibile per i cittadini. Ricevi una risposta da un database contenente dati come città, date, orari disponibili e altre informazioni, insieme alla richiesta originale dell'utente. Il tuo compito è:
+        messages = [
+            {
+                "role": "system",
+                "content": """Sei un assistente esperto di comunicazione chiara e accessibile per i cittadini. Ricevi una risposta da un database contenente dati come città, date, orari disponibili e altre informazioni, insieme alla richiesta originale dell'utente. Il tuo compito è:
         1. Valutare se la risposta dal database è sufficientemente correlata con la richiesta dell'utente. 
             - Se lo è, formulare una risposta semplice, chiara, concisa e facilmente comprensibile da qualunque cittadino, mantenendo solo le informazioni più rilevanti, in particolare informazioni relative ad indirizzi/dove trovare il servizio.
             - Se non lo è, generare autonomamente una risposta pertinente basandoti solo sulla richiesta dell'utente.
@@ -62,75 +286,125 @@ class LlamaChromaHandler:
         
         nota: il campo is_info deve obbligatoriamente essere lowercase
         """,
-                },
-                {"role": "user", "content": user_content},
-            ],
+            },
+            {"role": "user", "content": user_content},
+        ]
+        metrics.record_prompt_tokens("answer", count_message_tokens(messages))
+        response = await chat_completion(
+            self.client,
+            model=LLM_MODEL,  # Modello utilizzato
+            messages=messages,
             max_tokens=256,
+            stream=on_info is not None,
         )
-        llm_response = response.choices[0].message.content.strip()
+        if on_info is None:
+            llm_response = response.choices[0].message.content.strip()
+        else:
+            extractor = InfoStreamExtractor()
+            async for chunk in response:
+                if getattr(chunk, "usage", None) is not None:
+                    metrics.record_llm_usage(LLM_MODEL, chunk.usage)
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                delta = extractor.feed(chunk.choices[0].delta.content)
+                if delta:
+                    await on_info(delta)
+            llm_response = extractor.buffer.strip()
 
-        if isinstance(llm_response, str):
-            try:
-                llm_response = json.loads(llm_response)
-            except json.JSONDecodeError:
-                logger.error("Errore durante il caricamento del JSON: %s", llm_response)
+        try:
+            # strict=False accetta gli a capo non codificati nelle stringhe
+            llm_response = json.loads(llm_response, strict=False)
+        except json.JSONDecodeError:
+            logger.error("Errore durante il caricamento del JSON: %s", llm_response)
 
         return llm_response
 
-    def send_request(self, prompt: str) -> str:
+    async def send_request(self, prompt: str) -> str:
         """Invia una richiesta al modello OpenAI."""
-        response = self.client.chat.completions.create(
-            model="meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo",  # Modello utilizzato
-            messages=[
-                {
-                    "role": "system",
-                    "content": """Sei un assistente esperto di ricerca. Ricevi una richiesta utente e riformulala per essere adatta a una ricerca semantica per similarità in un database vettoriale (ChromaDB).
+        messages = [
+            {
+                "role": "system",
+                "content": """Sei un assistente esperto di ricerca. Ricevi una richiesta utente e riformulala per essere adatta a una ricerca semantica per similarità in un database vettoriale (ChromaDB).
     Assicurati che la richiesta sia chiara, concisa e rappresenti al meglio l'intento originale dell'utente. Rispondi esclusivamente con la richiesta sinteticamente senza scrivere altro.""",
-                },
-                {"role": "user", "content": prompt},
-            ],
+            },
+            {"role": "user", "content": prompt},
+        ]
+        metrics.record_prompt_tokens("rewrite", count_message_tokens(messages))
+        response = await chat_completion(
+            self.client,
+            model=LLM_MODEL,  # Modello utilizzato
+            messages=messages,
             max_tokens=128,
         )
         return response.choices[0].message.content.strip()
 
-    def process_query(self, input_text: str, city: str):
+    async def _parallel_query(self, input_text: str, city: str):
+        """
+        Cerca con il messaggio grezzo mentre il modello riformula la richiesta,
+        e restituisce il risultato con lo score (distanza) migliore.
+        """
+        raw_query = last_user_turn(input_text)
+        rewrite = asyncio.create_task(self._timed_send_request(input_text))
         try:
-            # Fase 1: Formatta la query con il modello AI
-            logger.info("Formattazione della query tramite OpenAI...")
+            raw_results = await self.vectorstore.aget_from_chroma(raw_query, city)
+            if raw_results and raw_results[0][1] <= PARALLEL_ACCEPT_SCORE:
+                logger.info("Risultato grezzo sufficiente, riformulazione annullata.")
+                return {"results": raw_results, "formatted_query": raw_query}
+
+            formatted_query = await rewrite
+            results = await self.vectorstore.aget_from_chroma(formatted_query, city)
+        finally:
+            rewrite.cancel()
+
+        if raw_results and (not results or raw_results[0][1] < results[0][1]):
+            return {"results": raw_results, "formatted_query": raw_query}
+        return {"results": results, "formatted_query": formatted_query}
+
+    async def rewrite_query(self, input_text: str) -> str:
+        """Restituisce la query da cercare secondo la strategia configurata."""
+        if self.strategy == "raw":
+            return last_user_turn(input_text)
+        if self.strategy == "heuristic":
+            return heuristic_rewrite(last_user_turn(input_text))
+        logger.info("Formattazione della query tramite OpenAI...")
+        return await self._timed_send_request(input_text)
+
+    async def _timed_send_request(self, input_text: str) -> str:
+        with metrics.stage("query_rewrite"):
+            return await self.send_request(input_text)
+
+    async def process_query(self, input_text: str, city: str, formatted_query=None):
+        try:
+            if formatted_query is None and self.strategy == "parallel":
+                return await self._parallel_query(input_text, city)
 
-            formatted_query = self.send_request(input_text)
+            # Fase 1: Formatta la query (se non già in cache)
+            if formatted_query is None:
+                formatted_query = await self.rewrite_query(input_text)
 
-            # Fase 2: Ricerca nel vectorstore
+            # Fase 2: Ricerca nel vectorstore (eseguita fuori dall'event loop)
             logger.info("Esecuzione della ricerca su Chroma...")
-            results = self.vectorstore.get_from_chroma(formatted_query, city)
-            logging.info(" Risultati: %s", results)
+            results = await self.vectorstore.aget_from_chroma(formatted_query, city)
+            logger.debug("Risultati: %s", results)
 
             # Restituisci i risultati
-            return {"results": results}
+            return {"results": results, "formatted_query": formatted_query}
         except Exception as e:
             logger.error("Errore durante l'elaborazione della query: %s", e)
             raise
 
-    def format_response(self, query, result):
-        if result == "nothing":
-            metadata_formatted = "Nessun risultato trovato."
-            date_orari = None
-            need_to_do = None
-        else:
-            metadata_formatted = " ".join(
-                f"{key} {value}" for key, value in result.items()
-            )
-            date_orari = result.get("date_orari")
-            need_to_do = result.get("need_to_do")
-        llm_response = self.send_response(query, metadata_formatted)
+    async def format_response(self, query, record: ServiceRecord = None, on_info=None):
         """
-        implement the response formatting here, to obtain date e orari disponibili, e info 
+        Genera la risposta per il servizio trovato (None se non c'è alcun
+        risultato). date_orari e need_to_do sono già convertiti nel catalogo,
+        quindi vengono restituiti così come sono; al modello arrivano solo i
+        campi utili alla richiesta (vedi context.build_record_context).
         """
-        if isinstance(llm_response, str):
-            try:
-                llm_response = json.loads(llm_response)
-            except json.JSONDecodeError:
-                logger.error("Errore durante il caricamento del JSON: %s", llm_response)
+        metadata_formatted = build_record_context(record, last_user_turn(query))
+        date_orari = record.date_orari if record is not None else None
+        need_to_do = record.need_to_do if record is not None else None
+        with metrics.stage("answer_generation"):
+            llm_response = await self.send_response(query, metadata_formatted, on_info)
 
         result_json = {
             "llm_response": llm_response,
@@ -140,25 +414,18 @@ class LlamaChromaHandler:
         return result_json
 
 
-def clean_dict(data):
-    if isinstance(data, dict):
-        return {k: clean_dict(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [clean_dict(item) for item in data]
-    elif isinstance(data, str):
-        # Rimuove \n e spazi extra
-        cleaned_str = data.replace("\n", "").strip()
-        # Prova a caricare come JSON se possibile
-        try:
-            return json.loads(cleaned_str)
-        except (json.JSONDecodeError, TypeError):
-            return cleaned_str
-    else:
-        return data
-
-
 # Funzione principale per eseguire la gestione
-def run_handler(query: str, vectorstore: ChromaDB, city: str = None):
+async def run_handler(
+    query: str, vectorstore: ChromaDB, city: str = None, on_info=None, router=None
+):
+    """
+    Esegue la pipeline RAG per una richiesta. Se on_info è fornita, il testo
+    della risposta viene inoltrato in streaming tramite questa coroutine.
+
+    Con un router (IntentRouter) le prenotazioni di un servizio riconosciuto
+    ricevono le date disponibili senza chiamare il modello, e le richieste di
+    informazioni su un servizio riconosciuto saltano riformulazione e ricerca.
+    """
     try:
         logger.info("Avvio del handler...")
 
@@ -169,21 +436,96 @@ def run_handler(query: str, vectorstore: ChromaDB, city: str = None):
         if city is not None:
             city = city.lower().strip()
 
-        result = handler.process_query(query, city)
-        logging.info(" Risultati: %s", result)
-
-        # Mostra i risultati
-        if result["results"] is None:
-            output = handler.format_response(query, "nothing")
-        else:
-            metadata = result["results"][0][0].metadata
-
-            output = handler.format_response(query, metadata)
-
-        clean_output = clean_dict(output)
-
-        return clean_output
-
+        # L'embedding dell'ultima richiesta è calcolato una sola volta per
+        # router, cache semantica e ricerca, e solo se serve
+        with reuse_embeddings():
+            turn = last_user_turn(query)
+            route = None
+            if router is not None and city is not None:
+                route = await router.route(turn, city, vectorstore)
+                if route is not None and route.intent == "booking":
+                    logger.info("Prenotazione instradata localmente: %s", route)
+                    output = await router.booking_answer(route.record)
+                    if on_info is not None:
+                        await on_info(output["llm_response"]["info"])
+                    return output
+
+            # Servizio riconosciuto dal router o da una corrispondenza
+            # lessicale forte con una scheda: niente riformulazione né ricerca
+            record = None
+            if route is not None:
+                logger.info("Servizio riconosciuto localmente: %s", route)
+                record = route.record
+            elif city is not None:
+                with metrics.stage("lexical_search"):
+                    _, strong = vectorstore.lexical_search(turn, city)
+                if strong is not None:
+                    logger.info("Corrispondenza lessicale forte, embedding non calcolato.")
+                    metrics.RETRIEVAL_PATH.labels("lexical").inc()
+                    record = vectorstore.resolve(strong[0])
+            # Riconosciuto dalle sole parole: la cache cerca la stessa
+            # richiesta, senza calcolare l'embedding
+            lexical = record is not None and (route is None or route.method == "lexical")
+
+            # Cerca una richiesta simile già servita per questa città: conta solo
+            # l'ultima richiesta, la cronologia la renderebbe sempre diversa
+            cached = None
+            embedding = None
+            if semantic_cache is not None:
+                with metrics.stage("cache_lookup"):
+                    version = vectorstore.version
+                    if lexical:
+                        cached = semantic_cache.lookup_text(city, turn, vectorstore)
+                    else:
+                        embedding = await vectorstore.aembed_query(turn)
+                        cached = semantic_cache.lookup(city, embedding, vectorstore)
+                metrics.set_cache_result("miss" if cached is None else "hit")
+                if cached is not None and cached["output"] is not None:
+                    logger.info("Risposta servita dalla cache semantica.")
+                    output = copy.deepcopy(cached["output"])
+                    if on_info is not None:
+                        await on_info(output["llm_response"]["info"])
+                    return output
+
+            # Al modello arriva la cronologia riassunta entro il budget di token
+            prompt = build_history(query)
+            if record is not None:
+                formatted_query = cached["formatted_query"] if cached else None
+                output = await handler.format_response(prompt, record, on_info)
+            else:
+                result = await handler.process_query(
+                    prompt, city, cached["formatted_query"] if cached else None
+                )
+                logger.debug("Risultati: %s", result)
+                formatted_query = result["formatted_query"]
+
+                # Mostra i risultati
+                if result["results"] is None:
+                    output = await handler.format_response(prompt, None, on_info)
+                else:
+                    record = vectorstore.resolve(result["results"][0][0])
+                    output = await handler.format_response(prompt, record, on_info)
+
+            if semantic_cache is not None:
+                # La risposta finale è riusabile solo se il modello ha restituito JSON
+                llm_response = output["llm_response"]
+                reusable = isinstance(llm_response, dict) and "info" in llm_response
+                if cached is not None:
+                    semantic_cache.discard(cached)
+                semantic_cache.store(
+                    city,
+                    turn,
+                    embedding,
+                    formatted_query,
+                    copy.deepcopy(output) if reusable else None,
+                    version,
+                )
+
+            return output
+
+    except asyncio.CancelledError:
+        logger.info("Esecuzione del handler annullata.")
+        raise
     except Exception as e:
-        logger.error(f"Errore durante l'esecuzione del handler: {e}")
+        logger.error("Errore durante l'esecuzione del handler: %s", e)
         raise
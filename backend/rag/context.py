@@ -0,0 +1,245 @@
+import math
+import os
+import re
+
+from .catalogue import ServiceRecord
+from .lexical_index import analyze
+from .retrieval import _ANSWER_PREFIX, _HUMAN_PREFIX
+
+# Costruzione del contesto passato al modello:
+#   compact - solo i campi utili all'intento, passaggi rilevanti di info e
+#             cronologia riassunta, entro un budget di token
+#   full    - descrizione completa del servizio e cronologia integrale
+#             (comportamento originale)
+PROMPT_CONTEXTS = ("compact", "full")
+PROMPT_CONTEXT = os.getenv("PROMPT_CONTEXT", "compact")
+
+# Token massimi per la descrizione del servizio e per la cronologia
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "300"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "120"))
+# Token massimi di una risposta salvata nella cronologia
+HISTORY_ANSWER_TOKENS = int(os.getenv("HISTORY_ANSWER_TOKENS", "40"))
+# Date e fasce orarie riportate al modello per una prenotazione
+CONTEXT_MAX_DATES = int(os.getenv("CONTEXT_MAX_DATES", "3"))
+
+# Un verbo o un nome di prenotazione esplicito; gli altri indizi (date
+# libere, quando posso) rendono l'intento solo probabile. Orari e
+# disponibilità non indicano una prenotazione ("quali sono gli orari dello
+# sportello?") ma rendono incerta anche una richiesta di informazioni
+_EXPLICIT_BOOKING_CUES = re.compile(r"\b(prenot\w*|appuntament\w*)", re.IGNORECASE)
+_BOOKING_CUES = re.compile(
+    r"\b(prenot\w*|appuntament\w*|fissar\w*|date libere|quando posso|slot)",
+    re.IGNORECASE,
+)
+_UNCERTAIN_CUES = re.compile(r"\b(orari\w*|disponibil\w*)", re.IGNORECASE)
+# Passaggi con indirizzi, che il modello deve sempre poter citare, e con
+# riferimenti a sportelli e uffici
+_STREET = re.compile(
+    r"\b(?:[Vv]ia|[Vv]iale|[Pp]iazza(?:le)?|[Cc]orso|[Ll]argo)[ \t]+[A-ZÀ-Ý0-9]"
+)
+_OFFICE_CUES = re.compile(
+    r"\b(indirizzo|sportello|ufficio|municipio|commissariato|sede)\b", re.IGNORECASE
+)
+_WORD = re.compile(r"\w+|[^\w\s]")
+_SPLIT_PASSAGES = re.compile(r"\n\s*\n|\n(?=\s)|(?<=[.;:])\s+(?=[A-ZÀ-Ý])")
+
+try:
+    import tiktoken
+
+    # Il tokenizer di Llama 3 deriva da quello dei modelli OpenAI: cl100k
+    # ne è un'approssimazione vicina
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken non installato o vocabolario non disponibile
+    _encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Numero di token di un testo (stimato se tiktoken non è installato)."""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # Circa un token ogni 4 caratteri di una parola, uno per la punteggiatura
+    return sum(math.ceil(len(piece) / 4) for piece in _WORD.findall(text))
+
+
+def count_message_tokens(messages) -> int:
+    """Token in input di una chat completion (con il costo fisso dei ruoli)."""
+    return sum(4 + count_tokens(message["content"]) for message in messages)
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Tronca il testo a parole intere entro max_tokens."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    out = []
+    used = 1  # il segno di troncamento
+    for word in text.split():
+        cost = count_tokens(word)
+        if used + cost > max_tokens:
+            break
+        out.append(word)
+        used += cost
+    return " ".join(out) + "…"
+
+
+def detect_intent(query: str):
+    """
+    Intento dell'ultima richiesta e confidenza: ("booking", 1.0) con una
+    parola di prenotazione esplicita, ("booking", 0.5) con un indizio più
+    debole, ("info", 0.5) con orari o disponibilità, altrimenti ("info", 1.0).
+    """
+    if _EXPLICIT_BOOKING_CUES.search(query):
+        return "booking", 1.0
+    if _BOOKING_CUES.search(query):
+        return "booking", 0.5
+    if _UNCERTAIN_CUES.search(query):
+        return "info", 0.5
+    return "info", 1.0
+
+
+def relevant_passages(info: str, query: str, max_tokens: int) -> str:
+    """
+    Estrae da info i passaggi più pertinenti alla richiesta entro max_tokens,
+    nell'ordine originale. I passaggi con un indirizzo hanno la
+    precedenza; se nessun passaggio è pertinente si tiene l'inizio del testo.
+    """
+    passages = [
+        " ".join(p.split()) for p in _SPLIT_PASSAGES.split(info) if p and p.strip()
+    ]
+    if not passages or max_tokens <= 0:
+        return ""
+    keywords = set(analyze(query))
+
+    scored = []
+    for index, passage in enumerate(passages):
+        score = len(keywords.intersection(analyze(passage)))
+        if _STREET.search(passage):
+            score += 10
+        elif _OFFICE_CUES.search(passage):
+            score += 1
+        scored.append((score, count_tokens(passage) + 1, index, passage))
+    if all(score == 0 for score, _, _, _ in scored):
+        scored = [(len(passages) - i, cost, i, p) for _, cost, i, p in scored]
+
+    # A parità di punteggio prima i passaggi brevi, che lasciano spazio ad altri
+    selected = []
+    used = 0
+    for score, cost, index, passage in sorted(scored, key=lambda s: (-s[0], s[1])):
+        if score == 0:
+            break
+        if used + cost > max_tokens:
+            if not selected:
+                selected.append((index, truncate_tokens(passage, max_tokens)))
+            continue
+        selected.append((index, passage))
+        used += cost
+    return " ".join(passage for _, passage in sorted(selected))
+
+
+def address_passage(info: str) -> str:
+    """Primo passaggio di info con un indirizzo, oppure stringa vuota."""
+    for passage in _SPLIT_PASSAGES.split(info):
+        if passage and _STREET.search(passage):
+            return " ".join(passage.split())
+    return ""
+
+
+def _compact_date_orari(date_orari, max_dates=CONTEXT_MAX_DATES):
+    dates = sorted(date_orari)[:max_dates]
+    text = "; ".join(f"{date}: {', '.join(date_orari[date])}" for date in dates)
+    if len(date_orari) > max_dates:
+        text += f" (e altre {len(date_orari) - max_dates} date)"
+    return text or "nessuna data disponibile"
+
+
+def build_record_context(
+    record: ServiceRecord, query: str, budget=CONTEXT_TOKEN_BUDGET, mode=PROMPT_CONTEXT
+) -> str:
+    """
+    Descrizione del servizio per la risposta del modello.
+
+    In modalità compact contiene il comune, il servizio, le date disponibili
+    (solo per le prenotazioni) o i documenti necessari (per le richieste di
+    informazioni) e i passaggi di info più pertinenti, entro budget token.
+    """
+    if record is None:
+        return "Nessun risultato trovato."
+    if mode == "full":
+        return record.prompt_text()
+
+    lines = [f"comune: {record.comune}", f"servizio: {record.service}"]
+    intent, confidence = detect_intent(query)
+    # Con un intento incerto il modello riceve sia le date sia i documenti
+    if intent == "booking" or confidence < 1.0:
+        lines.append(f"date disponibili: {_compact_date_orari(record.date_orari)}")
+    if intent == "info" and record.need_to_do:
+        lines.append(f"documenti necessari: {'; '.join(record.need_to_do)}")
+    text = "\n".join(lines)
+    remaining = budget - count_tokens(text) - 2
+    passages = relevant_passages(record.info, query, remaining)
+    if passages:
+        text += f"\ninfo: {passages}"
+    return text
+
+
+def _split_turns(history: str):
+    """Divide la cronologia concatenata in turni (prefisso, testo)."""
+    turns = []
+    pattern = re.compile(
+        f"({re.escape(_HUMAN_PREFIX)}|{re.escape(_ANSWER_PREFIX)})", re.IGNORECASE
+    )
+    parts = pattern.split(history)
+    for prefix, text in zip(parts[1::2], parts[2::2]):
+        turns.append((prefix.lower(), " ".join(text.split())))
+    return turns
+
+
+def build_history(history: str, budget=HISTORY_TOKEN_BUDGET, mode=PROMPT_CONTEXT) -> str:
+    """
+    Cronologia passata al modello: l'ultima richiesta dell'utente per intero,
+    preceduta da un riassunto dei turni precedenti (i più recenti per primi
+    nel budget, i più vecchi troncati o omessi).
+    """
+    if mode == "full":
+        return history
+    turns = _split_turns(history)
+    if not turns:
+        return history
+    last_human = max(
+        (i for i, (prefix, _) in enumerate(turns) if prefix == _HUMAN_PREFIX),
+        default=len(turns) - 1,
+    )
+    current = f"{_HUMAN_PREFIX}{turns[last_human][1]}\n"
+
+    summary = []
+    remaining = budget
+    for prefix, text in reversed(turns[:last_human]):
+        label = "utente" if prefix == _HUMAN_PREFIX else "assistente"
+        entry = f"{label}: {text}"
+        cost = count_tokens(entry) + 1
+        if cost > remaining:
+            if remaining > 8:
+                summary.append(truncate_tokens(entry, remaining - 1))
+            break
+        summary.append(entry)
+        remaining -= cost
+    if not summary:
+        return current
+    return f"riepilogo della conversazione: {' | '.join(reversed(summary))}\n{current}"
+
+
+def history_entry(result, mode=PROMPT_CONTEXT) -> str:
+    """
+    Voce della cronologia per una risposta: in modalità compact solo il testo
+    mostrato all'utente, troncato, al posto dell'intero risultato (date,
+    orari e documenti sono già nel contesto del servizio).
+    """
+    if mode == "full":
+        return f"{_ANSWER_PREFIX}{result}\n"
+    llm_response = result.get("llm_response") if isinstance(result, dict) else result
+    if isinstance(llm_response, dict):
+        llm_response = llm_response.get("info", "")
+    text = str(llm_response or "")
+    text = truncate_tokens(" ".join(text.split()), HISTORY_ANSWER_TOKENS)
+    return f"{_ANSWER_PREFIX}{text}\n"
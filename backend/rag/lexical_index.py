@@ -0,0 +1,170 @@
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+
+from langchain.docstore.document import Document
+
+from .retrieval import heuristic_rewrite
+
+# Ricerca ibrida: indice BM25 per comune sui page_content (elenchi di parole
+# chiave del servizio) combinato con la similarità degli embedding
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# Scorciatoia lessicale: se la richiesta contiene per intero una delle voci
+# del page_content del primo documento, con punteggio BM25 almeno
+# LEXICAL_SHORTCUT_SCORE e almeno LEXICAL_SHORTCUT_RATIO volte il secondo,
+# il documento viene restituito senza calcolare l'embedding della richiesta
+LEXICAL_SHORTCUT_SCORE = float(os.getenv("LEXICAL_SHORTCUT_SCORE", "1.0"))
+LEXICAL_SHORTCUT_RATIO = float(os.getenv("LEXICAL_SHORTCUT_RATIO", "1.5"))
+# Fusione: peso della similarità coseno; il punteggio BM25 s pesa
+# s / (s + LEXICAL_HALF_SCORE), cioè 0.5 quando s = LEXICAL_HALF_SCORE
+HYBRID_DENSE_WEIGHT = float(os.getenv("HYBRID_DENSE_WEIGHT", "0.7"))
+LEXICAL_HALF_SCORE = float(os.getenv("LEXICAL_HALF_SCORE", "2.0"))
+# Candidati considerati da ciascuna delle due ricerche
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "4"))
+
+# Suffissi flessivi e derivativi rimossi dallo stemmer, dal più lungo
+_SUFFIXES = (
+    "azioni", "azione", "amenti", "amento", "imenti", "imento", "mente",
+    "zioni", "zione", "ando", "endo", "are", "ere", "ire", "ita", "iche",
+    "ichi", "ici", "ico", "ica", "i", "e", "a", "o",
+)
+
+
+def stem(word):
+    """Stemmer leggero per l'italiano (residenza/residenze, rinnovo/rinnovare)."""
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[: -len(suffix)]
+    return word
+
+
+def analyze(text):
+    """Termini di un testo: senza parole vuote, senza accenti, ridotti alla radice."""
+    normalized = unicodedata.normalize("NFD", heuristic_rewrite(text).lower())
+    normalized = "".join(c for c in normalized if not unicodedata.combining(c))
+    return [stem(word) for word in re.findall(r"\w+", normalized)]
+
+
+class LexicalIndex:
+    """
+    Indice invertito BM25 per comune, costruito al caricamento dai
+    page_content delle schede. Per ogni termine il peso BM25 di ogni documento
+    è precalcolato, quindi una ricerca somma idf * peso sulle sole liste dei
+    termini della richiesta.
+    """
+
+    def __init__(
+        self,
+        k1=BM25_K1,
+        b=BM25_B,
+        shortcut_score=LEXICAL_SHORTCUT_SCORE,
+        shortcut_ratio=LEXICAL_SHORTCUT_RATIO,
+        dense_weight=HYBRID_DENSE_WEIGHT,
+        half_score=LEXICAL_HALF_SCORE,
+    ):
+        self.k1 = k1
+        self.b = b
+        self.shortcut_score = shortcut_score
+        self.shortcut_ratio = shortcut_ratio
+        self.dense_weight = dense_weight
+        self.half_score = half_score
+        # comune -> (documenti, termine -> [(indice documento, idf * peso)])
+        self._comuni = {}
+        # record_id -> termini di ogni voce del page_content
+        self._phrases = {}
+
+    def build(self, records):
+        """Ricostruisce l'indice dalle schede (ServiceRecord) indicizzate."""
+        groups = {}
+        for record in records:
+            groups.setdefault(record.comune, []).append(record)
+
+        comuni = {}
+        phrases = {}
+        for comune, group in groups.items():
+            documents = [
+                Document(page_content=r.page_content, metadata=r.index_metadata())
+                for r in group
+            ]
+            for record in group:
+                entries = re.split(r"[,.;]", record.page_content)
+                phrases[record.id] = [
+                    frozenset(terms) for terms in map(analyze, entries) if terms
+                ]
+            terms = [Counter(analyze(r.page_content)) for r in group]
+            lengths = [sum(t.values()) for t in terms]
+            average = sum(lengths) / len(lengths) or 1.0
+            frequency = Counter(term for t in terms for term in t)
+            postings = {}
+            for index, (counts, length) in enumerate(zip(terms, lengths)):
+                norm = self.k1 * (1 - self.b + self.b * length / average)
+                for term, tf in counts.items():
+                    df = frequency[term]
+                    idf = math.log(1 + (len(group) - df + 0.5) / (df + 0.5))
+                    weight = idf * tf * (self.k1 + 1) / (tf + norm)
+                    postings.setdefault(term, []).append((index, weight))
+            comuni[comune] = (documents, postings)
+        # Sostituzione in un solo passo: le ricerche in corso vedono l'indice
+        # precedente o quello nuovo, mai uno parziale
+        self._comuni, self._phrases = comuni, phrases
+
+    def search(self, text, comune, k=HYBRID_CANDIDATES):
+        """[(documento, punteggio BM25)] in ordine decrescente, solo punteggi > 0."""
+        if comune not in self._comuni:
+            return []
+        documents, postings = self._comuni[comune]
+        scores = {}
+        for term in set(analyze(text)):
+            for index, weight in postings.get(term, ()):
+                scores[index] = scores.get(index, 0.0) + weight
+        ranked = sorted(scores.items(), key=lambda item: -item[1])[:k]
+        return [(documents[index], score) for index, score in ranked]
+
+    def strong_hit(self, text, hits):
+        """
+        Il primo risultato di search(text), se abbastanza netto da saltare gli
+        embedding: una sua voce compare per intero nella richiesta e il
+        punteggio supera le soglie.
+        """
+        if not hits or hits[0][1] < self.shortcut_score:
+            return None
+        if len(hits) > 1 and hits[0][1] < self.shortcut_ratio * hits[1][1]:
+            return None
+        terms = set(analyze(text))
+        phrases = self._phrases.get(hits[0][0].metadata["record_id"], ())
+        if not any(phrase <= terms for phrase in phrases):
+            return None
+        return hits[0]
+
+    def fuse(self, dense, lexical):
+        """
+        Combina i risultati degli embedding ([(documento, distanza)], distanza
+        L2 al quadrato tra vettori normalizzati, cioè 2 - 2 cos) con quelli
+        BM25. Restituisce [(documento, distanza fusa)] in ordine crescente,
+        con distanza fusa = 2 - 2 (w cos + (1 - w) s / (s + half)): con w = 1
+        coincide con la distanza di Chroma.
+
+        Un documento trovato solo da BM25 non è tra i primi per similarità,
+        quindi il suo coseno è al più quello dell'ultimo candidato denso:
+        si usa questo limite.
+        """
+        cosines = {d.metadata["record_id"]: 1 - distance / 2 for d, distance in dense}
+        floor = min(cosines.values(), default=0.0)
+        candidates = {d.metadata["record_id"]: d for d, _ in dense}
+        bm25 = {}
+        for doc, score in lexical:
+            candidates.setdefault(doc.metadata["record_id"], doc)
+            bm25[doc.metadata["record_id"]] = score
+
+        fused = []
+        for doc_id, doc in candidates.items():
+            score = bm25.get(doc_id, 0.0)
+            combined = self.dense_weight * cosines.get(doc_id, floor) + (
+                1 - self.dense_weight
+            ) * (score / (score + self.half_score))
+            fused.append((doc, 2 - 2 * combined))
+        return sorted(fused, key=lambda item: item[1])
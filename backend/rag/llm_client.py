@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import random
+
+import httpx
+from dotenv import load_dotenv
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    AsyncOpenAI,
+)
+
+from . import metrics
+from .providers import Provider, ProviderPool, load_provider_configs
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Endpoint e modello (con più provider vedi LLM_PROVIDERS in providers.py)
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://api.aimlapi.com/v1")
+LLM_MODEL = os.getenv("LLM_MODEL", "meta-llama/Meta-Llama-3.1-405B-Instruct-Turbo")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+
+# Pool di connessioni HTTP condiviso da tutte le sessioni
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+
+# Retry con backoff esponenziale e jitter su 429/5xx ed errori di rete
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+
+_client = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _create_client(base_url, api_key, timeout=LLM_TIMEOUT) -> AsyncOpenAI:
+    http2 = _http2_available()
+    http_client = httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=timeout,
+    )
+    logger.info(f"Client LLM inizializzato ({base_url}, http2={http2}).")
+    return AsyncOpenAI(
+        base_url=base_url,  # URL dell'API
+        api_key=api_key,  # Chiave API
+        timeout=timeout,
+        # I retry sono gestiti da chat_completion
+        max_retries=0,
+        http_client=http_client,
+    )
+
+
+def init_llm_client() -> ProviderPool:
+    """
+    Crea il client condiviso (un pool di provider, ognuno con il proprio
+    pool di connessioni); da chiamare una volta all'avvio dell'app.
+    """
+    global _client
+    if _client is None:
+        providers = [
+            Provider(
+                config["name"],
+                _create_client(
+                    config["base_url"],
+                    os.getenv(config["api_key_env"]),
+                    float(config.get("timeout", LLM_TIMEOUT)),
+                ),
+                config["model"],
+            )
+            for config in load_provider_configs(LLM_BASE_URL, LLM_MODEL)
+        ]
+        _client = ProviderPool(providers, is_failure=_is_retryable)
+    return _client
+
+
+def get_llm_client() -> ProviderPool:
+    """Restituisce il client condiviso, creandolo se non è ancora stato fatto."""
+    return _client if _client is not None else init_llm_client()
+
+
+async def close_llm_client():
+    """Chiude il client condiviso e i suoi pool di connessioni."""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.close()
+        logger.info("Client LLM chiuso.")
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (APIConnectionError, APITimeoutError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+def _backoff_delay(attempt: int, error: Exception) -> float:
+    # Rispetta Retry-After se il provider lo indica
+    if isinstance(error, APIStatusError):
+        retry_after = error.response.headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), LLM_BACKOFF_MAX)
+            except ValueError:
+                pass
+    # Full jitter: attesa casuale in [0, base * 2^attempt]
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2**attempt))
+
+
+async def chat_completion(client, **kwargs):
+    """
+    Esegue una chat completion ritentando gli errori transitori. client è il
+    pool di provider condiviso (ProviderPool) o un singolo AsyncOpenAI.
+    """
+    create = (
+        client.create
+        if isinstance(client, ProviderPool)
+        else client.chat.completions.create
+    )
+    if kwargs.get("stream"):
+        # Gli stream riportano i token consumati solo se richiesto, in un
+        # ultimo frammento senza choices (letto da send_response)
+        kwargs.setdefault("stream_options", {"include_usage": True})
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            response = await create(**kwargs)
+        except Exception as e:
+            if attempt == LLM_MAX_RETRIES or not _is_retryable(e):
+                metrics.LLM_ERRORS.labels(type(e).__name__).inc()
+                raise
+            metrics.LLM_RETRIES.labels(type(e).__name__).inc()
+            delay = _backoff_delay(attempt, e)
+            logger.warning(
+                f"Errore transitorio dal modello ({e}), nuovo tentativo tra {delay:.2f}s."
+            )
+            await asyncio.sleep(delay)
+            continue
+        if not kwargs.get("stream"):
+            metrics.record_llm_usage(
+                getattr(response, "model", None) or kwargs.get("model"), response.usage
+            )
+        return response
@@ -0,0 +1,255 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import reprlib
+import sys
+import time
+import traceback
+
+from . import metrics
+
+# Configurazione unica del logging (configure_logging, chiamata da main.py e
+# dagli script): chi registra un messaggio lo mette solo in coda, un thread
+# in background lo formatta e lo scrive su stderr e su LOG_FILE
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json": un oggetto per riga con session_id e trace_id; "text": leggibile
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# File di log in aggiunta a stderr (vuoto: solo stderr)
+LOG_FILE = os.getenv("LOG_FILE", "pai.log")
+# Messaggi in attesa di scrittura: oltre questo limite vengono scartati
+# (e contati in pai_log_records_dropped_total) invece di bloccare la richiesta
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Frazione dei messaggi registrati per livello, ad es. "DEBUG=0.01,INFO=0.5";
+# i livelli non indicati sono registrati sempre
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+# Lunghezza massima di ogni argomento e campo extra nei messaggi sotto
+# WARNING (0: nessun limite); avvisi ed errori sono scritti per intero
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "500"))
+
+_session_id = contextvars.ContextVar("pai_log_session_id", default=None)
+
+# Attributi di ogni LogRecord: il resto sono campi passati con extra=
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_listener = None
+_handler = None
+_sampled = metrics.LOG_RECORDS_DROPPED.labels("sampled")
+_queue_full = metrics.LOG_RECORDS_DROPPED.labels("queue_full")
+
+
+def set_session(session_id):
+    """Associa i messaggi del task asyncio corrente a una sessione."""
+    _session_id.set(session_id)
+
+
+def parse_sample_rates(value):
+    """"DEBUG=0.01,INFO=0.5" -> {10: 0.01, 20: 0.5}"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, rate = item.partition("=")
+        level = logging.getLevelName(name.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError(f"LOG_SAMPLE_RATES: livello sconosciuto {name!r}")
+        rates[level] = float(rate)
+    return rates
+
+
+class _Shortener(reprlib.Repr):
+    """repr limitato: liste, dizionari e stringhe lunghe vengono accorciati
+    senza costruire prima la rappresentazione completa."""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.maxstring = self.maxother = limit
+        self.maxlist = self.maxtuple = self.maxdict = self.maxset = 8
+        self.maxlevel = 4
+
+    def shorten(self, value):
+        if isinstance(value, (int, float, bool)) or value is None:
+            return value
+        if isinstance(value, str):
+            text = value
+        else:
+            text = self.repr(value)
+        if len(text) > self.limit:
+            return f"{text[: self.limit]}...[{len(text) - self.limit} caratteri omessi]"
+        return text
+
+
+class ContextFilter(logging.Filter):
+    """
+    Eseguito da chi registra il messaggio, quindi deve costare poco: applica
+    il campionamento per livello e copia session_id e trace_id dal contesto
+    asyncio corrente (dopo, nel thread di scrittura, non sarebbero più
+    disponibili).
+    """
+
+    def __init__(self, sample_rates=None):
+        super().__init__()
+        self.sample_rates = sample_rates or {}
+
+    def filter(self, record):
+        rate = self.sample_rates.get(record.levelno, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            _sampled.inc()
+            return False
+        trace = metrics.current_request()
+        record.trace_id = trace.trace_id if trace is not None else None
+        record.session_id = _session_id.get()
+        return True
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler che non formatta il messaggio: QueueHandler.prepare lo
+    formatterebbe nel chiamante (sull'event loop) per poterlo serializzare
+    tra processi, mentre qui la coda è in memoria e la formattazione avviene
+    nel thread di scrittura. Gli argomenti passano per riferimento: vanno
+    registrati oggetti che non vengono modificati dopo (risultati, payload
+    già letti).
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _queue_full.inc()
+
+
+class JsonFormatter(logging.Formatter):
+    """Un oggetto JSON per riga, con gli argomenti lunghi troncati."""
+
+    def __init__(self, max_field_chars=LOG_MAX_FIELD_CHARS):
+        super().__init__()
+        self.shortener = _Shortener(max_field_chars) if max_field_chars else None
+
+    def fields(self, record):
+        truncate = self.shortener is not None and record.levelno < logging.WARNING
+        # Come record.getMessage, ma con copie troncate degli argomenti: il
+        # record è condiviso con gli altri handler e non va modificato
+        message = str(record.msg)
+        if record.args:
+            args = record.args
+            if truncate and isinstance(args, dict):
+                args = {key: self.shortener.shorten(v) for key, v in args.items()}
+            elif truncate:
+                args = tuple(self.shortener.shorten(v) for v in args)
+            message = message % args
+        if truncate:
+            message = self.shortener.shorten(message)
+
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": message,
+            "session_id": getattr(record, "session_id", None),
+            "trace_id": getattr(record, "trace_id", None),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = self.shortener.shorten(value) if truncate else value
+        if record.exc_info:
+            entry["exception"] = "".join(traceback.format_exception(*record.exc_info))
+        return entry
+
+    def format(self, record):
+        return json.dumps(self.fields(record), ensure_ascii=False, default=str)
+
+
+class TextFormatter(JsonFormatter):
+    """Come il formato precedente, con trace_id e argomenti troncati."""
+
+    def format(self, record):
+        entry = self.fields(record)
+        line = (
+            f"{entry['ts']} - {entry['logger']} - {entry['level']} - "
+            f"[{entry['session_id'] or '-'} {entry['trace_id'] or '-'}] {entry['message']}"
+        )
+        if "exception" in entry:
+            line += "\n" + entry["exception"].rstrip()
+        return line
+
+
+def _output_handlers(log_format, log_file, max_field_chars, streams):
+    formatter_class = JsonFormatter if log_format == "json" else TextFormatter
+    if streams is not None:
+        handlers = [logging.StreamHandler(stream) for stream in streams]
+    else:
+        handlers = [logging.StreamHandler(sys.stderr)]
+        if log_file:
+            handlers.append(logging.FileHandler(log_file, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter_class(max_field_chars))
+    return handlers
+
+
+def _start_listener(handlers):
+    global _listener
+    _listener = logging.handlers.QueueListener(
+        _handler.queue, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+
+
+def _restart_after_fork():
+    # Il thread di scrittura non sopravvive alla fork (serve.py): ogni worker
+    # riparte con una coda nuova e un proprio thread
+    if _listener is not None:
+        _handler.queue = queue.Queue(_handler.queue.maxsize)
+        _start_listener(_listener.handlers)
+
+
+def stop_logging():
+    """Scrive i messaggi ancora in coda e ferma il thread di scrittura."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def configure_logging(
+    level=LOG_LEVEL,
+    log_format=LOG_FORMAT,
+    log_file=LOG_FILE,
+    sample_rates=LOG_SAMPLE_RATES,
+    max_field_chars=LOG_MAX_FIELD_CHARS,
+    queue_size=LOG_QUEUE_SIZE,
+    streams=None,
+):
+    """
+    Sostituisce gli handler del logger radice con la coda verso il thread di
+    scrittura. Chiamarla di nuovo riconfigura il logging (e svuota la coda
+    precedente). Con streams i messaggi vanno su quegli stream invece che su
+    stderr e log_file.
+    """
+    global _handler
+    stop_logging()
+    if isinstance(sample_rates, str):
+        sample_rates = parse_sample_rates(sample_rates)
+
+    _handler = BackgroundQueueHandler(queue.Queue(queue_size))
+    _handler.addFilter(ContextFilter(sample_rates))
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _start_listener(_output_handlers(log_format, log_file, max_field_chars, streams))
+
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_after_fork)
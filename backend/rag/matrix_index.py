@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+from langchain.docstore.document import Document
+
+
+def _fingerprint(ids):
+    """Hash dell'insieme di ID, per capire se l'indice su disco è aggiornato."""
+    digest = hashlib.sha256()
+    for doc_id in sorted(ids):
+        digest.update(doc_id.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class MatrixIndex:
+    """
+    Indice k-NN in memoria con una matrice float32 contigua di embedding
+    normalizzati per ogni comune, salvata in .npy e aperta in memory-map.
+
+    search() restituisce la distanza L2 al quadrato calcolata come 2 - 2 cos,
+    che coincide con quella di Chroma per embedding a norma unitaria (come
+    quelli di all-MiniLM-L6-v2), così la soglia SEARCH_MAX_DISTANCE resta valida.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.fingerprint = None
+        # comune -> (matrice, ids, documenti, metadati)
+        self._comuni = {}
+
+    @classmethod
+    def from_chroma(cls, vectorstore, directory):
+        """Apre l'indice su disco, ricostruendolo se non allineato a Chroma."""
+        index = cls(directory)
+        ids = vectorstore.get(include=[])["ids"]
+        if not index.load(expected_fingerprint=_fingerprint(ids)):
+            index.rebuild_from_chroma(vectorstore)
+        return index
+
+    def rebuild_from_chroma(self, vectorstore):
+        data = vectorstore.get(include=["embeddings", "metadatas", "documents"])
+        self.build(data["ids"], data["embeddings"], data["metadatas"], data["documents"])
+
+    def build(self, ids, embeddings, metadatas, documents):
+        """Scrive su disco le matrici per comune e le riapre in memory-map."""
+        groups = {}
+        for i, metadata in enumerate(metadatas):
+            groups.setdefault(metadata.get("comune"), []).append(i)
+
+        os.makedirs(self.directory, exist_ok=True)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        manifest = {"fingerprint": _fingerprint(ids), "comuni": {}}
+        for n, (comune, rows) in enumerate(sorted(groups.items(), key=str)):
+            matrix = np.ascontiguousarray(embeddings[rows])
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix /= np.where(norms == 0, 1, norms)
+
+            filename = f"comune_{n}.npy"
+            # Nome temporaneo per processo: due processi che ricostruiscono
+            # l'indice non scrivono mai sullo stesso file
+            tmp_path = os.path.join(self.directory, f"{filename}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as file:
+                np.save(file, matrix)
+            os.replace(tmp_path, os.path.join(self.directory, filename))
+            manifest["comuni"][filename] = {
+                "comune": comune,
+                "ids": [ids[i] for i in rows],
+                "documents": [documents[i] for i in rows],
+                "metadatas": [metadatas[i] for i in rows],
+            }
+
+        tmp_path = os.path.join(self.directory, f"index.json.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.directory, "index.json"))
+        self.load()
+        logging.info(f"Indice matriciale ricostruito: {len(ids)} documenti.")
+
+    def load(self, expected_fingerprint=None):
+        """Apre l'indice su disco; restituisce False se assente o non aggiornato."""
+        try:
+            with open(os.path.join(self.directory, "index.json"), "r", encoding="utf-8") as file:
+                manifest = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        if expected_fingerprint is not None and manifest["fingerprint"] != expected_fingerprint:
+            return False
+
+        comuni = {}
+        for filename, entry in manifest["comuni"].items():
+            matrix = np.load(os.path.join(self.directory, filename), mmap_mode="r")
+            if matrix.shape[0] != len(entry["ids"]):
+                # Matrice già riscritta da un'altra ricostruzione in corso
+                return False
+            comuni[entry["comune"]] = (
+                matrix,
+                entry["ids"],
+                entry["documents"],
+                entry["metadatas"],
+            )
+        # Sostituzione atomica: le ricerche in corso usano ancora le vecchie matrici
+        self._comuni = comuni
+        self.fingerprint = manifest["fingerprint"]
+        return True
+
+    def ids(self):
+        """ID dei documenti indicizzati."""
+        return {doc_id for _, ids, _, _ in self._comuni.values() for doc_id in ids}
+
+    def search(self, embedding, comune, k=1):
+        """Restituisce fino a k coppie (Document, distanza) per il comune."""
+        entry = self._comuni.get(comune)
+        if entry is None:
+            return []
+        matrix, ids, documents, metadatas = entry
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        similarities = matrix @ query
+
+        k = min(k, len(ids))
+        if k < len(ids):
+            top = np.argpartition(-similarities, k - 1)[:k]
+        else:
+            top = np.arange(len(ids))
+        top = top[np.argsort(-similarities[top])]
+
+        return [
+            (
+                Document(page_content=documents[i], metadata=metadatas[i]),
+                float(2.0 - 2.0 * similarities[i]),
+            )
+            for i in top
+        ]
@@ -0,0 +1,242 @@
+import contextvars
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_DURATION = Histogram(
+    "pai_stage_duration_seconds",
+    "Durata di ogni fase della pipeline per richiesta",
+    ["stage", "city", "cache"],
+    buckets=_BUCKETS,
+)
+REQUEST_DURATION = Histogram(
+    "pai_request_duration_seconds",
+    "Durata totale di una richiesta websocket",
+    ["city", "cache"],
+    buckets=_BUCKETS,
+)
+REQUEST_ERRORS = Counter(
+    "pai_request_errors_total", "Richieste terminate con errore", ["error"]
+)
+CACHE_LOOKUPS = Counter(
+    "pai_semantic_cache_lookups_total", "Ricerche nella cache semantica", ["result"]
+)
+LLM_TOKENS = Counter(
+    "pai_llm_tokens_total", "Token consumati dal modello", ["model", "kind"]
+)
+LLM_RETRIES = Counter(
+    "pai_llm_retries_total", "Nuovi tentativi verso il modello", ["error"]
+)
+LLM_ERRORS = Counter(
+    "pai_llm_errors_total", "Chiamate al modello fallite definitivamente", ["error"]
+)
+RETRIEVAL_PATH = Counter(
+    "pai_retrieval_path_total",
+    "Ricerche risolte dalla sola corrispondenza lessicale (lexical), ibride "
+    "(hybrid) o solo con gli embedding (dense)",
+    ["path"],
+)
+INDEX_RELOADS = Counter(
+    "pai_index_reloads_total",
+    "Ricaricamenti dei documenti completati (ok) o falliti (error)",
+    ["result"],
+)
+INDEX_RELOAD_DURATION = Histogram(
+    "pai_index_reload_duration_seconds",
+    "Durata della costruzione di una nuova istantanea dell'indice",
+)
+BATCH_ITEMS = Counter(
+    "pai_batch_items_total",
+    "Richieste dei blocchi eseguite (ok, error) o servite da una uguale (duplicate)",
+    ["result"],
+)
+BATCH_ITEM_DURATION = Histogram(
+    "pai_batch_item_duration_seconds",
+    "Durata dell'esecuzione della pipeline per una richiesta di un blocco",
+    ["city", "cache"],
+    buckets=_BUCKETS,
+)
+LOG_RECORDS_DROPPED = Counter(
+    "pai_log_records_dropped_total",
+    "Messaggi di log non scritti: campionati (sampled) o con la coda piena (queue_full)",
+    ["reason"],
+)
+ROUTER_DECISIONS = Counter(
+    "pai_router_decisions_total",
+    "Richieste instradate localmente (booking, info) o passate al modello (fallback)",
+    ["decision", "method"],
+)
+_TOKEN_BUCKETS = (50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 8000)
+
+PROMPT_TOKENS = Histogram(
+    "pai_prompt_tokens",
+    "Token in input (stimati) per chiamata al modello",
+    ["call"],
+    buckets=_TOKEN_BUCKETS,
+)
+REQUEST_PROMPT_TOKENS = Histogram(
+    "pai_request_prompt_tokens",
+    "Token in input (stimati) di tutte le chiamate al modello di una richiesta",
+    ["city", "cache"],
+    buckets=_TOKEN_BUCKETS,
+)
+LLM_PROVIDER_REQUESTS = Counter(
+    "pai_llm_provider_requests_total",
+    "Richieste ai provider LLM per esito (ok, error, cancelled)",
+    ["provider", "outcome"],
+)
+LLM_PROVIDER_LATENCY = Histogram(
+    "pai_llm_provider_latency_seconds",
+    "Latenza delle richieste riuscite (inizio della risposta per gli stream)",
+    ["provider"],
+    buckets=_BUCKETS,
+)
+LLM_HEDGES = Counter(
+    "pai_llm_hedged_requests_total",
+    "Richieste di riserva avviate (launched) e vinte (won), risposte dopo un errore (failover)",
+    ["result"],
+)
+LLM_BREAKER_OPEN = Gauge(
+    "pai_llm_provider_circuit_open",
+    "1 se il circuit breaker del provider è aperto",
+    ["provider"],
+    multiprocess_mode="max",
+)
+ACTIVE_SESSIONS = Gauge(
+    "pai_active_websocket_sessions",
+    "Sessioni websocket attualmente aperte",
+    # Con più worker (PROMETHEUS_MULTIPROC_DIR) somma i processi attivi
+    multiprocess_mode="livesum",
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    "pai_admission_in_flight",
+    "Richieste in elaborazione ammesse dal controllo di ammissione",
+    multiprocess_mode="livesum",
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "pai_admission_queue_depth",
+    "Richieste in attesa di uno slot",
+    multiprocess_mode="livesum",
+)
+ADMISSION_WAIT = Histogram(
+    "pai_admission_wait_seconds",
+    "Attesa in coda prima dell'elaborazione",
+    buckets=_BUCKETS,
+)
+ADMISSION_REJECTED = Counter(
+    "pai_admission_rejected_total", "Richieste rifiutate o scartate", ["reason"]
+)
+
+# Comuni presenti nell'indice: le altre città finiscono nell'etichetta "other"
+# per non far crescere senza limite il numero di serie
+known_cities = set()
+
+
+class RequestTrace:
+    """Tempi e etichette di una richiesta, raccolti lungo la pipeline."""
+
+    __slots__ = ("trace_id", "city", "cache", "stages", "prompt_tokens", "start", "batch")
+
+    def __init__(self, city=None, trace_id=None, batch=False):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        # Richiesta di un blocco (rag/batch.py): durata in un istogramma a parte
+        self.batch = batch
+        self.city = city.lower().strip() if isinstance(city, str) else None
+        self.cache = "disabled"
+        self.stages = {}
+        self.prompt_tokens = {}
+        self.start = time.perf_counter()
+
+
+_current = contextvars.ContextVar("pai_request_trace", default=None)
+
+
+def start_request(city=None, trace_id=None, batch=False) -> RequestTrace:
+    """Apre la traccia della richiesta corrente (valida per il task asyncio)."""
+    trace = RequestTrace(city, trace_id, batch)
+    _current.set(trace)
+    return trace
+
+
+def current_request():
+    return _current.get()
+
+
+@contextmanager
+def stage(name):
+    """Misura una fase; le durate ripetute nella stessa richiesta si sommano."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = _current.get()
+        if trace is not None:
+            trace.stages[name] = trace.stages.get(name, 0.0) + (
+                time.perf_counter() - start
+            )
+
+
+def set_cache_result(result):
+    """Registra l'esito della cache semantica ("hit" o "miss")."""
+    CACHE_LOOKUPS.labels(result).inc()
+    trace = _current.get()
+    if trace is not None:
+        trace.cache = result
+
+
+def finish_request(trace: RequestTrace, error=None):
+    """Pubblica negli istogrammi le durate raccolte per la richiesta."""
+    city = trace.city if trace.city in known_cities else "other"
+    for name, duration in trace.stages.items():
+        STAGE_DURATION.labels(name, city, trace.cache).observe(duration)
+    duration = BATCH_ITEM_DURATION if trace.batch else REQUEST_DURATION
+    duration.labels(city, trace.cache).observe(time.perf_counter() - trace.start)
+    if trace.prompt_tokens:
+        REQUEST_PROMPT_TOKENS.labels(city, trace.cache).observe(
+            sum(trace.prompt_tokens.values())
+        )
+    if error is not None:
+        REQUEST_ERRORS.labels(type(error).__name__).inc()
+
+
+def record_prompt_tokens(call, tokens):
+    """Registra i token in input di una chiamata al modello ("rewrite", "answer")."""
+    PROMPT_TOKENS.labels(call).observe(tokens)
+    trace = _current.get()
+    if trace is not None:
+        trace.prompt_tokens[call] = trace.prompt_tokens.get(call, 0) + tokens
+
+
+def record_llm_usage(model, usage):
+    if usage is None:
+        return
+    LLM_TOKENS.labels(model, "prompt").inc(usage.prompt_tokens or 0)
+    LLM_TOKENS.labels(model, "completion").inc(usage.completion_tokens or 0)
+
+
+def render():
+    """
+    Restituisce (contenuto, content type) nel formato testuale di Prometheus.
+
+    Se è impostata PROMETHEUS_MULTIPROC_DIR (più worker, vedi serve.py) le
+    metriche di tutti i processi vengono aggregate.
+    """
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,163 @@
+import logging
+import os
+import shutil
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Modello esportato in ONNX (python -m rag.onnx_embeddings export): la
+# cartella contiene model.onnx, model_int8.onnx e tokenizer.json
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "./models/all-MiniLM-L6-v2")
+# Thread di onnxruntime per ogni inferenza (0: uno per core fisico). Con più
+# worker conviene limitarli perché non si contendano i core
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))
+# Testi per inferenza in embed_documents
+ONNX_BATCH_SIZE = int(os.getenv("ONNX_BATCH_SIZE", "32"))
+# Lunghezza massima in token, come max_seq_length di all-MiniLM-L6-v2
+ONNX_MAX_LENGTH = int(os.getenv("ONNX_MAX_LENGTH", "256"))
+
+MODEL_FILES = {False: "model.onnx", True: "model_int8.onnx"}
+TOKENIZER_FILE = "tokenizer.json"
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Embedding di un modello sentence-transformers esportato in ONNX, eseguito
+    con onnxruntime su CPU senza importare PyTorch: mean pooling sui token e
+    normalizzazione L2, come la pipeline di all-MiniLM-L6-v2. Con
+    quantized=True usa i pesi quantizzati int8 (quantizzazione dinamica).
+    """
+
+    def __init__(
+        self,
+        model_name,
+        model_dir=ONNX_MODEL_DIR,
+        quantized=False,
+        threads=ONNX_THREADS,
+        batch_size=ONNX_BATCH_SIZE,
+        max_length=ONNX_MAX_LENGTH,
+    ):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        path = os.path.join(model_dir, MODEL_FILES[quantized])
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f"{path} non trovato: esegui python -m rag.onnx_embeddings export"
+            )
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+        self.batch_size = batch_size
+        # Identifica i vettori nel manifest dell'indice: con i pesi int8 i
+        # vettori cambiano e l'indice viene ricalcolato
+        self.signature = f"{model_name}+onnx{'-int8' if quantized else ''}"
+        logger.info(f"Modello di embedding ONNX caricato da {path}.")
+
+    def _embed_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+        hidden = self.session.run(None, feeds)[0]
+
+        # Media dei token reali (esclusi quelli di padding), poi norma 1
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+    def embed_documents(self, texts):
+        # Testi di lunghezza simile nello stesso batch riducono il padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            chunk = order[start : start + self.batch_size]
+            for index, vector in zip(chunk, self._embed_batch([texts[i] for i in chunk])):
+                vectors[index] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def _export_with_torch(model_name, path):
+    """Esporta il modello dalla copia PyTorch (serve solo per l'export)."""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    sample = tokenizer(["esempio"], return_tensors="pt")
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    axes = {name: {0: "batch", 1: "sequence"} for name in names}
+    axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[name] for name in names),
+            path,
+            input_names=names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=axes,
+            opset_version=14,
+        )
+    tokenizer.save_pretrained(os.path.dirname(path))
+
+
+def export(model_name, model_dir=ONNX_MODEL_DIR, quantize=True):
+    """
+    Prepara model_dir: scarica model.onnx e tokenizer.json dal repository del
+    modello (o, se non c'è l'export ONNX, lo esegue con PyTorch) e, con
+    quantize, crea model_int8.onnx con la quantizzazione dinamica dei pesi.
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    path = os.path.join(model_dir, MODEL_FILES[False])
+    try:
+        from huggingface_hub import hf_hub_download
+
+        files = (
+            ("onnx/model.onnx", path),
+            (TOKENIZER_FILE, os.path.join(model_dir, TOKENIZER_FILE)),
+        )
+        for remote, local in files:
+            shutil.copyfile(hf_hub_download(model_name, remote), local)
+    except Exception as e:
+        logger.warning(f"Export ONNX non scaricabile ({e}), esportazione con PyTorch.")
+        _export_with_torch(model_name, path)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(
+            path, os.path.join(model_dir, MODEL_FILES[True]), weight_type=QuantType.QInt8
+        )
+    logger.info(f"Modello {model_name} esportato in {model_dir}.")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from .log_config import configure_logging
+    from .vec_db import EMBEDDING_MODEL
+
+    parser = argparse.ArgumentParser(description="Esporta il modello di embedding in ONNX")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--output", default=ONNX_MODEL_DIR)
+    parser.add_argument("--no-quantize", action="store_true")
+    args = parser.parse_args()
+    configure_logging()
+    export(args.model, args.output, quantize=not args.no_quantize)
@@ -0,0 +1,286 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Richieste "hedged": se il provider scelto non risponde entro il suo p95
+# osservato, la stessa richiesta parte verso il provider successivo e si
+# tiene la prima risposta valida, annullando l'altra
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "1") == "1"
+# Richieste di riserva al massimo per ogni chiamata
+LLM_MAX_HEDGES = int(os.getenv("LLM_MAX_HEDGES", "1"))
+# Attesa prima della richiesta di riserva: il quantile osservato, limitato a
+# [min, max]; finché i campioni sono pochi si usa il valore predefinito
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.2"))
+LLM_HEDGE_MAX_DELAY = float(os.getenv("LLM_HEDGE_MAX_DELAY", "10"))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "2"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+LLM_LATENCY_MIN_SAMPLES = int(os.getenv("LLM_LATENCY_MIN_SAMPLES", "20"))
+
+# Circuit breaker: dopo N errori consecutivi il provider viene escluso per
+# cooldown secondi, poi riceve una richiesta di prova
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+
+class ProvidersUnavailable(Exception):
+    """Tutti i provider hanno il circuit breaker aperto: la richiesta fallisce subito."""
+
+
+class LatencyTracker:
+    """Ultime latenze osservate di un provider, per calcolarne i quantili."""
+
+    def __init__(self, window=LLM_LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def quantile(self, q):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    """
+    closed: il provider riceve richieste; dopo max_failures errori
+    consecutivi passa a open e non ne riceve per cooldown secondi; poi
+    half_open: riceve una sola richiesta di prova, che lo chiude se va a buon
+    fine e lo riapre altrimenti.
+    """
+
+    def __init__(self, max_failures=LLM_BREAKER_FAILURES, cooldown=LLM_BREAKER_COOLDOWN):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def available(self):
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+            self._probing = False
+        if self.state == "half_open":
+            return not self._probing
+        return self.state == "closed"
+
+    def acquire(self):
+        if self.state == "half_open":
+            self._probing = True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == "half_open" or self.failures >= self.max_failures:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Richiesta di prova annullata prima dell'esito."""
+        self._probing = False
+
+
+class Provider:
+    """Endpoint compatibile con OpenAI: client, modello, latenze e breaker."""
+
+    def __init__(self, name, client, model, breaker=None):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        # Latenze separate per risposte complete e per l'inizio di uno stream
+        self.latency = {False: LatencyTracker(), True: LatencyTracker()}
+
+    def hedge_delay(self, stream):
+        tracker = self.latency[stream]
+        if len(tracker) < LLM_LATENCY_MIN_SAMPLES:
+            return LLM_HEDGE_DEFAULT_DELAY
+        delay = tracker.quantile(LLM_HEDGE_QUANTILE)
+        return min(LLM_HEDGE_MAX_DELAY, max(LLM_HEDGE_MIN_DELAY, delay))
+
+    def typical_latency(self, stream):
+        tracker = self.latency[stream]
+        if len(tracker) < LLM_LATENCY_MIN_SAMPLES:
+            return None
+        return tracker.quantile(0.5)
+
+
+class ProviderPool:
+    """
+    Instrada le chat completion su più provider compatibili con OpenAI.
+
+    Ogni chiamata va al provider disponibile con la latenza mediana più bassa
+    (a parità, o finché mancano campioni, nell'ordine di configurazione). Se
+    non risponde entro il proprio p95 parte una richiesta di riserva verso il
+    successivo e vince la prima risposta valida; se fallisce si passa subito
+    al successivo. Con uno stream conta l'inizio della risposta: una volta
+    ricevuti gli header lo stream non viene più duplicato.
+    """
+
+    def __init__(self, providers, is_failure, hedge=LLM_HEDGE_ENABLED, max_hedges=LLM_MAX_HEDGES):
+        if not providers:
+            raise ValueError("Nessun provider LLM configurato")
+        self.providers = providers
+        self.is_failure = is_failure
+        self.hedge = hedge
+        self.max_hedges = max_hedges
+
+    def ranked(self, stream):
+        available = [p for p in self.providers if p.breaker.available()]
+
+        def key(item):
+            index, provider = item
+            latency = provider.typical_latency(stream)
+            return (latency if latency is not None else float("inf"), index)
+
+        return [p for _, p in sorted(enumerate(available), key=key)]
+
+    async def _call(self, provider, kwargs):
+        provider.breaker.acquire()
+        start = time.perf_counter()
+        try:
+            response = await provider.client.chat.completions.create(
+                **{**kwargs, "model": provider.model}
+            )
+        except asyncio.CancelledError:
+            # Richiesta superata da un'altra: la durata è un limite inferiore
+            # della latenza, ma tenerne conto evita di sottostimare la coda
+            provider.latency[bool(kwargs.get("stream"))].observe(
+                time.perf_counter() - start
+            )
+            provider.breaker.release()
+            metrics.LLM_PROVIDER_REQUESTS.labels(provider.name, "cancelled").inc()
+            raise
+        except Exception as e:
+            if self.is_failure(e):
+                was_open = provider.breaker.state == "open"
+                provider.breaker.record_failure()
+                if not was_open and provider.breaker.state == "open":
+                    logger.warning(f"Provider LLM {provider.name} escluso: {e}")
+            else:
+                provider.breaker.release()
+            metrics.LLM_PROVIDER_REQUESTS.labels(provider.name, "error").inc()
+            metrics.LLM_BREAKER_OPEN.labels(provider.name).set(
+                int(provider.breaker.state == "open")
+            )
+            raise
+        elapsed = time.perf_counter() - start
+        provider.latency[bool(kwargs.get("stream"))].observe(elapsed)
+        provider.breaker.record_success()
+        metrics.LLM_PROVIDER_REQUESTS.labels(provider.name, "ok").inc()
+        metrics.LLM_PROVIDER_LATENCY.labels(provider.name).observe(elapsed)
+        metrics.LLM_BREAKER_OPEN.labels(provider.name).set(0)
+        return response
+
+    async def create(self, **kwargs):
+        """Come client.chat.completions.create, sul provider migliore."""
+        stream = bool(kwargs.get("stream"))
+        candidates = self.ranked(stream)
+        if not candidates:
+            raise ProvidersUnavailable("Nessun provider LLM disponibile")
+        primary, backups = candidates[0], deque(candidates[1:])
+        hedges = self.max_hedges if self.hedge else 0
+
+        tasks = {asyncio.create_task(self._call(primary, kwargs)): primary}
+        hedged = set()  # provider delle richieste di riserva
+        last_error = None
+        try:
+            while tasks:
+                timeout = primary.hedge_delay(stream) if hedges and backups else None
+                done, _ = await asyncio.wait(
+                    tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # Il primo provider è oltre il suo p95: richiesta di riserva
+                    hedges -= 1
+                    backup = backups.popleft()
+                    hedged.add(backup)
+                    metrics.LLM_HEDGES.labels("launched").inc()
+                    tasks[asyncio.create_task(self._call(backup, kwargs))] = backup
+                    continue
+                finished = [(tasks.pop(task), task.exception(), task) for task in done]
+                winners = [(p, task.result()) for p, error, task in finished if error is None]
+                if winners:
+                    provider, response = winners[0]
+                    for _, extra in winners[1:]:
+                        # Risposte arrivate insieme: chiude gli stream non usati
+                        if hasattr(extra, "close"):
+                            await extra.close()
+                    if provider in hedged:
+                        metrics.LLM_HEDGES.labels("won").inc()
+                    elif provider is not primary:
+                        metrics.LLM_HEDGES.labels("failover").inc()
+                    return response
+                for provider, error, _ in finished:
+                    if not self.is_failure(error):
+                        raise error
+                    last_error = error
+                if not tasks and backups:
+                    # Errore del provider: si passa subito al successivo
+                    backup = backups.popleft()
+                    tasks[asyncio.create_task(self._call(backup, kwargs))] = backup
+            raise last_error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def close(self):
+        for provider in self.providers:
+            await provider.client.close()
+
+    def stats(self):
+        return {
+            provider.name: {
+                "model": provider.model,
+                "breaker": provider.breaker.state,
+                "p50": provider.typical_latency(False),
+                "p95": provider.latency[False].quantile(0.95),
+                "stream_p50": provider.typical_latency(True),
+            }
+            for provider in self.providers
+        }
+
+
+def load_provider_configs(default_base_url, default_model):
+    """
+    Legge LLM_PROVIDERS: lista JSON di provider nell'ordine di preferenza, ad
+    esempio [{"name": "aimlapi", "base_url": "...", "model": "...",
+    "api_key_env": "API_KEY", "timeout": 30}]. Senza LLM_PROVIDERS c'è un
+    solo provider, configurato da LLM_BASE_URL, LLM_MODEL e API_KEY.
+    """
+    raw = os.getenv("LLM_PROVIDERS")
+    if not raw:
+        return [
+            {
+                "name": "default",
+                "base_url": default_base_url,
+                "model": default_model,
+                "api_key_env": "API_KEY",
+            }
+        ]
+    configs = json.loads(raw)
+    for index, config in enumerate(configs):
+        if "base_url" not in config:
+            raise ValueError(f"LLM_PROVIDERS[{index}]: base_url mancante")
+        config.setdefault("name", f"provider{index}")
+        config.setdefault("model", default_model)
+        config.setdefault("api_key_env", "API_KEY")
+    return configs
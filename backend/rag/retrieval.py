@@ -0,0 +1,54 @@
+import os
+import re
+import unicodedata
+
+# Strategia usata per ottenere la query da cercare su Chroma:
+#   llm       - riformulazione con il modello (comportamento originale)
+#   raw       - ultimo messaggio dell'utente, senza riformulazione
+#   heuristic - ultimo messaggio ripulito localmente da saluti e parole vuote
+#   parallel  - ricerca con il messaggio grezzo in parallelo alla
+#               riformulazione, tenendo il risultato con lo score migliore
+RETRIEVAL_STRATEGIES = ("llm", "raw", "heuristic", "parallel")
+RETRIEVAL_STRATEGY = os.getenv("RETRIEVAL_STRATEGY", "llm")
+
+# Nella strategia parallel, uno score grezzo minore o uguale a questa soglia
+# è considerato sufficiente e la riformulazione viene annullata
+PARALLEL_ACCEPT_SCORE = float(os.getenv("PARALLEL_ACCEPT_SCORE", "0.5"))
+
+_HUMAN_PREFIX = "human asked: "
+_ANSWER_PREFIX = "you answered: "
+
+_STOPWORDS = {
+    "a", "ad", "al", "alla", "allo", "ai", "agli", "alle", "buongiorno",
+    "buonasera", "ciao", "come", "con", "cosa", "da", "dal", "dalla", "dei",
+    "del", "della", "devo", "di", "dove", "e", "ed", "fare", "favore", "gli",
+    "grazie", "ho", "i", "il", "in", "io", "la", "le", "lo", "mi", "mio", "mia",
+    "ne", "nel", "nella", "per", "posso", "potrei", "quale", "quali", "quando",
+    "salve", "se", "si", "sono", "su", "sul", "sulla", "un", "una", "uno",
+    "vorrei", "voglio", "ti", "chiedo", "bisogno", "serve", "servono",
+}
+
+
+def last_user_turn(input_text: str) -> str:
+    """Estrae l'ultimo messaggio dell'utente dalla cronologia concatenata."""
+    start = input_text.rfind(_HUMAN_PREFIX)
+    if start == -1:
+        return input_text.strip()
+    turn = input_text[start + len(_HUMAN_PREFIX) :]
+    end = turn.find(f"\n{_ANSWER_PREFIX}")
+    return (turn if end == -1 else turn[:end]).strip()
+
+
+def normalize_text(text: str) -> str:
+    """Chiave delle richieste uguali: minuscole, senza punteggiatura e spazi extra."""
+    return " ".join(re.findall(r"[\w']+", unicodedata.normalize("NFC", text.lower())))
+
+
+def heuristic_rewrite(text: str) -> str:
+    """Riduce la richiesta alle parole significative, senza chiamare il modello."""
+    normalized = unicodedata.normalize("NFC", text.lower())
+    words = re.findall(r"[\w']+", normalized)
+    # Separa gli articoli elisi (l'appuntamento -> appuntamento)
+    words = [w.split("'")[-1] for w in words]
+    keywords = [w for w in words if w and w not in _STOPWORDS]
+    return " ".join(keywords) if keywords else text.strip()
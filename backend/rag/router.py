@@ -0,0 +1,210 @@
+import asyncio
+import os
+import re
+
+import numpy as np
+
+from . import metrics
+from .catalogue import ServiceCatalogue, ServiceRecord
+from .context import address_passage, detect_intent
+from .lexical_index import analyze
+
+# Instradamento locale delle richieste: intento e servizio vengono
+# riconosciuti senza chiamare il modello; le prenotazioni ricevono subito le
+# date disponibili, le richieste di informazioni saltano riformulazione e
+# ricerca. Con confidenza bassa si usa la pipeline completa.
+ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "1") == "1"
+# Similarità coseno minima con gli alias del servizio e distacco minimo dal
+# secondo servizio, per il classificatore a embedding
+ROUTER_MIN_SIMILARITY = float(os.getenv("ROUTER_MIN_SIMILARITY", "0.6"))
+ROUTER_MIN_MARGIN = float(os.getenv("ROUTER_MIN_MARGIN", "0.05"))
+# Confidenza minima dell'intento (detect_intent): con il valore predefinito
+# solo le prenotazioni esplicite ricevono le date senza il modello, e le
+# richieste su orari e disponibilità passano dalla pipeline completa
+ROUTER_MIN_INTENT_CONFIDENCE = float(os.getenv("ROUTER_MIN_INTENT_CONFIDENCE", "1.0"))
+# Date proposte nella risposta a una prenotazione
+ROUTER_BOOKING_DATES = int(os.getenv("ROUTER_BOOKING_DATES", "3"))
+
+_MONTHS = (
+    "gennaio", "febbraio", "marzo", "aprile", "maggio", "giugno", "luglio",
+    "agosto", "settembre", "ottobre", "novembre", "dicembre",
+)
+
+
+def _aliases(record: ServiceRecord):
+    """Alias del servizio: page_content elenca i nomi con cui viene cercato."""
+    aliases = [a.strip() for a in re.split(r"[,.;]", record.page_content) if a.strip()]
+    aliases.append(record.service.replace("_", " "))
+    return aliases
+
+
+def service_label(record: ServiceRecord):
+    label = _aliases(record)[0]
+    return re.sub(r"^servizio\s+", "", label, flags=re.IGNORECASE)
+
+
+class Route:
+    """Esito dell'instradamento: intento, servizio e come è stato riconosciuto."""
+
+    __slots__ = ("intent", "record", "method", "score")
+
+    def __init__(self, intent, record, method, score):
+        self.intent = intent
+        self.record = record
+        self.method = method
+        self.score = score
+
+    def __repr__(self):
+        return (
+            f"Route({self.intent}, {self.record.comune}/{self.record.service}, "
+            f"{self.method}, {self.score:.2f})"
+        )
+
+
+class IntentRouter:
+    """
+    Riconosce intento (prenotazione o informazioni) e servizio di una
+    richiesta in pochi millisecondi, senza chiamare il modello.
+
+    - regole lessicali: un alias del servizio (da page_content) compare per
+      intero nella richiesta, e per un solo servizio del comune;
+    - altrimenti classificatore a embedding: similarità coseno tra la
+      richiesta e gli alias dei servizi del comune, accettata sopra
+      min_similarity e con distacco min_margin dal secondo servizio.
+
+    L'intento deve essere riconosciuto con confidenza almeno
+    min_intent_confidence: una richiesta dall'intento incerto passa al
+    modello.
+
+    Con embeddings=None usa solo le regole lessicali. availability, se
+    impostata (BookingStore.availability), fornisce i posti ancora liberi
+    per le risposte alle prenotazioni.
+    """
+
+    def __init__(
+        self,
+        catalogue: ServiceCatalogue,
+        embeddings=None,
+        min_similarity=ROUTER_MIN_SIMILARITY,
+        min_margin=ROUTER_MIN_MARGIN,
+        min_intent_confidence=ROUTER_MIN_INTENT_CONFIDENCE,
+    ):
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+        self.min_intent_confidence = min_intent_confidence
+        self.availability = None
+        self._lexical = {}  # comune -> [(record, [termini di ogni alias])]
+        self._vectors = {}  # comune -> (matrice normalizzata, record per riga)
+
+        for record in catalogue.services():
+            aliases = _aliases(record)
+            self._lexical.setdefault(record.comune, []).append(
+                (record, [s for s in (set(analyze(a)) for a in aliases) if s])
+            )
+        if embeddings is not None:
+            for comune, entries in self._lexical.items():
+                rows = [(record, a) for record, _ in entries for a in _aliases(record)]
+                matrix = np.asarray(
+                    embeddings.embed_documents([alias for _, alias in rows]),
+                    dtype=np.float32,
+                )
+                matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12
+                self._vectors[comune] = (matrix, [record for record, _ in rows])
+
+    def match_lexical(self, text, comune):
+        """Restituisce (record, numero di parole dell'alias) oppure None."""
+        query = set(analyze(text))
+        best = {}
+        for record, aliases in self._lexical.get(comune, []):
+            length = max((len(a) for a in aliases if a <= query), default=0)
+            if length:
+                best[record.id] = (record, length)
+        if not best:
+            return None
+        ranked = sorted(best.values(), key=lambda m: -m[1])
+        # Ambiguo se due servizi hanno un alias altrettanto specifico
+        if len(ranked) > 1 and ranked[0][1] == ranked[1][1]:
+            return None
+        return ranked[0]
+
+    def match_embedding(self, embedding, comune):
+        """Restituisce (record, similarità) se il servizio è riconosciuto."""
+        if comune not in self._vectors:
+            return None
+        matrix, records = self._vectors[comune]
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = matrix @ query
+
+        best = {}
+        for record, score in zip(records, scores.tolist()):
+            if score > best.get(record.id, (None, -1.0))[1]:
+                best[record.id] = (record, score)
+        ranked = sorted(best.values(), key=lambda m: -m[1])
+        record, score = ranked[0]
+        runner_up = ranked[1][1] if len(ranked) > 1 else -1.0
+        if score < self.min_similarity or score - runner_up < self.min_margin:
+            return None
+        return record, score
+
+    async def route(self, text, comune, vectorstore=None):
+        """
+        Instrada l'ultima richiesta dell'utente; None se il servizio non è
+        riconosciuto con sufficiente confidenza.
+        """
+        with metrics.stage("routing"):
+            intent, confidence = detect_intent(text)
+            if confidence < self.min_intent_confidence:
+                metrics.ROUTER_DECISIONS.labels("fallback", "intent").inc()
+                return None
+            match = self.match_lexical(text, comune)
+            method = "lexical"
+            if match is None and vectorstore is not None and comune in self._vectors:
+                embedding = await vectorstore.aembed_query(text)
+                match = self.match_embedding(embedding, comune)
+                method = "embedding"
+        if match is None:
+            metrics.ROUTER_DECISIONS.labels("fallback", "none").inc()
+            return None
+        metrics.ROUTER_DECISIONS.labels(intent, method).inc()
+        return Route(intent, match[0], method, match[1])
+
+    async def booking_answer(self, record: ServiceRecord):
+        """
+        Risposta a una prenotazione, con le date ancora disponibili. La
+        disponibilità è letta in un thread: BookingStore attende il proprio
+        lock, tenuto da una prenotazione in corso, e interroga SQLite.
+        """
+        if self.availability is not None:
+            slots = await asyncio.to_thread(
+                self.availability, record.comune, record.service
+            )
+        else:
+            slots = record.date_orari
+        label = service_label(record)
+        if slots:
+            dates = sorted(slots)[:ROUTER_BOOKING_DATES]
+            text = (
+                f"Puoi prenotare un appuntamento per {label} a "
+                f"{record.comune.capitalize()}. Le prime date disponibili sono: "
+                + "; ".join(f"{_format_date(d)} ({', '.join(slots[d])})" for d in dates)
+                + ". Scegli data e orario tra quelli proposti."
+            )
+        else:
+            text = (
+                f"Al momento non ci sono date disponibili per {label} a "
+                f"{record.comune.capitalize()}."
+            )
+        address = address_passage(record.info)
+        if address:
+            text += f" {address}"
+        return {
+            "llm_response": {"info": text, "is_info": False},
+            "response": slots,
+            "info": record.need_to_do,
+        }
+
+
+def _format_date(date):
+    year, month, day = (int(part) for part in date.split("-"))
+    return f"{day} {_MONTHS[month - 1]} {year}"
@@ -0,0 +1,300 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+
+# Dove sono salvate le sessioni: "memory" (solo questo processo), "sqlite"
+# (condivise tra i worker della stessa macchina), "redis" (tra più nodi) o
+# "fakeredis" (lo store Redis su un server simulato in memoria, per sviluppo
+# e test senza Redis)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+SESSION_HISTORY_SIZE = int(os.getenv("SESSION_HISTORY_SIZE", "4"))
+SESSION_DB = os.getenv("SESSION_DB", "./sessions.sqlite3")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+
+def _new_token():
+    return secrets.token_urlsafe(32)
+
+
+def _token_hash(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class SessionStore:
+    """
+    Stato delle conversazioni, indipendente dalla connessione websocket.
+
+    Ogni sessione ha un ID (UUID) e un token di ripresa: un client che si
+    riconnette con entrambi ritrova la propria cronologia, anche se la nuova
+    connessione arriva a un altro worker. La cronologia è un buffer circolare
+    di history_size voci; le sessioni inattive da più di ttl secondi scadono.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, history_size=SESSION_HISTORY_SIZE):
+        self.ttl = ttl
+        self.history_size = history_size
+
+    async def create(self):
+        """Returns: tuple (session_id, resume_token)"""
+        raise NotImplementedError
+
+    async def resume(self, session_id, resume_token):
+        """True se la sessione esiste, non è scaduta e il token è corretto."""
+        raise NotImplementedError
+
+    async def append_history(self, session_id, *entries):
+        """Aggiunge voci alla cronologia e restituisce la cronologia aggiornata."""
+        raise NotImplementedError
+
+    async def get_history(self, session_id):
+        raise NotImplementedError
+
+    async def delete(self, session_id):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """Sessioni nel processo corrente: non sopravvivono a un riavvio."""
+
+    def __init__(self, ttl=SESSION_TTL, history_size=SESSION_HISTORY_SIZE):
+        super().__init__(ttl, history_size)
+        # session_id -> {"token", "history", "expires"}
+        self._sessions = {}
+
+    def _expire(self, now):
+        expired = [sid for sid, s in self._sessions.items() if s["expires"] < now]
+        for session_id in expired:
+            del self._sessions[session_id]
+
+    def _get(self, session_id):
+        now = time.monotonic()
+        session = self._sessions.get(session_id)
+        if session is None or session["expires"] < now:
+            self._sessions.pop(session_id, None)
+            return None
+        session["expires"] = now + self.ttl
+        return session
+
+    async def create(self):
+        now = time.monotonic()
+        self._expire(now)
+        session_id, token = str(uuid.uuid4()), _new_token()
+        self._sessions[session_id] = {
+            "token": _token_hash(token),
+            "history": deque(maxlen=self.history_size),
+            "expires": now + self.ttl,
+        }
+        return session_id, token
+
+    async def resume(self, session_id, resume_token):
+        session = self._get(session_id)
+        return session is not None and hmac.compare_digest(
+            session["token"], _token_hash(resume_token)
+        )
+
+    async def append_history(self, session_id, *entries):
+        session = self._get(session_id)
+        if session is None:
+            return list(entries)[-self.history_size :]
+        session["history"].extend(entries)
+        return list(session["history"])
+
+    async def get_history(self, session_id):
+        session = self._get(session_id)
+        return list(session["history"]) if session is not None else []
+
+    async def delete(self, session_id):
+        self._sessions.pop(session_id, None)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessioni in un database SQLite (WAL) condiviso dai worker della stessa
+    macchina. Le query sono eseguite in un thread per non bloccare l'event loop.
+    """
+
+    def __init__(self, path=SESSION_DB, ttl=SESSION_TTL, history_size=SESSION_HISTORY_SIZE):
+        super().__init__(ttl, history_size)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "id TEXT PRIMARY KEY, token TEXT NOT NULL, "
+            "history TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)"
+        )
+        self._lock = threading.Lock()
+
+    def _run(self, function, *args):
+        def locked():
+            with self._lock:
+                return function(*args)
+
+        return asyncio.to_thread(locked)
+
+    def _create(self):
+        now = time.time()
+        session_id, token = str(uuid.uuid4()), _new_token()
+        self._conn.execute("DELETE FROM sessions WHERE expires < ?", (now,))
+        self._conn.execute(
+            "INSERT INTO sessions (id, token, history, expires) VALUES (?, ?, '[]', ?)",
+            (session_id, _token_hash(token), now + self.ttl),
+        )
+        return session_id, token
+
+    def _touch(self, session_id):
+        now = time.time()
+        row = self._conn.execute(
+            "UPDATE sessions SET expires = ? WHERE id = ? AND expires >= ? "
+            "RETURNING token, history",
+            (now + self.ttl, session_id, now),
+        ).fetchall()
+        return row[0] if row else None
+
+    def _resume(self, session_id, resume_token):
+        row = self._touch(session_id)
+        return row is not None and hmac.compare_digest(row[0], _token_hash(resume_token))
+
+    def _append_history(self, session_id, entries):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._touch(session_id)
+            history = json.loads(row[1]) if row is not None else []
+            history = (history + list(entries))[-self.history_size :]
+            if row is not None:
+                self._conn.execute(
+                    "UPDATE sessions SET history = ? WHERE id = ?",
+                    (json.dumps(history, ensure_ascii=False), session_id),
+                )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return history
+
+    def _get_history(self, session_id):
+        row = self._touch(session_id)
+        return json.loads(row[1]) if row is not None else []
+
+    def _delete(self, session_id):
+        self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    async def create(self):
+        return await self._run(self._create)
+
+    async def resume(self, session_id, resume_token):
+        return await self._run(self._resume, session_id, resume_token)
+
+    async def append_history(self, session_id, *entries):
+        return await self._run(self._append_history, session_id, entries)
+
+    async def get_history(self, session_id):
+        return await self._run(self._get_history, session_id)
+
+    async def delete(self, session_id):
+        await self._run(self._delete, session_id)
+
+    async def close(self):
+        await self._run(self._conn.close)
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Sessioni su un server con protocollo Redis, condivise tra più nodi. La
+    cronologia è una lista limitata con LTRIM e la scadenza usa EXPIRE.
+
+    client può essere un qualsiasi client compatibile con redis.asyncio
+    (con SESSION_BACKEND=fakeredis, fakeredis.aioredis.FakeRedis).
+    """
+
+    def __init__(self, client=None, ttl=SESSION_TTL, history_size=SESSION_HISTORY_SIZE):
+        super().__init__(ttl, history_size)
+        if client is None:
+            import redis.asyncio as redis
+
+            client = redis.from_url(REDIS_URL, decode_responses=True)
+        self.redis = client
+        self._ttl = max(1, int(ttl))
+
+    @staticmethod
+    def _keys(session_id):
+        return f"pai:session:{session_id}:token", f"pai:session:{session_id}:history"
+
+    async def create(self):
+        session_id, token = str(uuid.uuid4()), _new_token()
+        token_key, _ = self._keys(session_id)
+        await self.redis.set(token_key, _token_hash(token), ex=self._ttl)
+        return session_id, token
+
+    async def _touch(self, session_id):
+        token_key, history_key = self._keys(session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.get(token_key)
+            pipe.expire(token_key, self._ttl)
+            pipe.expire(history_key, self._ttl)
+            stored, _, _ = await pipe.execute()
+        return stored
+
+    async def resume(self, session_id, resume_token):
+        stored = await self._touch(session_id)
+        if isinstance(stored, bytes):
+            stored = stored.decode()
+        return stored is not None and hmac.compare_digest(stored, _token_hash(resume_token))
+
+    async def append_history(self, session_id, *entries):
+        token_key, history_key = self._keys(session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(history_key, *entries)
+            pipe.ltrim(history_key, -self.history_size, -1)
+            pipe.expire(history_key, self._ttl)
+            pipe.expire(token_key, self._ttl)
+            pipe.lrange(history_key, 0, -1)
+            history = (await pipe.execute())[-1]
+        return [h.decode() if isinstance(h, bytes) else h for h in history]
+
+    async def get_history(self, session_id):
+        _, history_key = self._keys(session_id)
+        await self._touch(session_id)
+        history = await self.redis.lrange(history_key, 0, -1)
+        return [h.decode() if isinstance(h, bytes) else h for h in history]
+
+    async def delete(self, session_id):
+        await self.redis.delete(*self._keys(session_id))
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+def create_session_store(backend=SESSION_BACKEND):
+    """Crea lo store configurato da SESSION_BACKEND."""
+    if backend == "memory":
+        store = MemorySessionStore()
+    elif backend == "sqlite":
+        store = SQLiteSessionStore()
+    elif backend == "redis":
+        store = RedisSessionStore()
+    elif backend == "fakeredis":
+        from fakeredis.aioredis import FakeRedis  # dipendenza di sviluppo
+
+        store = RedisSessionStore(FakeRedis(decode_responses=True))
+    else:
+        raise ValueError(f"Backend delle sessioni sconosciuto: {backend}")
+    logging.info(f"Sessioni salvate con il backend {backend}.")
+    return store
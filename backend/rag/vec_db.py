@@ -1,71 +1,538 @@
+import asyncio
+import contextlib
+import contextvars
+import copy
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from chromadb import Settings as chroma_settings
 from langchain.docstore.document import Document
 from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
 
-# Configurazione del logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("chroma_add.log"), logging.StreamHandler()],
+from . import metrics
+from .catalogue import InvalidDocument, ServiceCatalogue, ServiceRecord, record_id
+from .lexical_index import HYBRID_CANDIDATES, HYBRID_SEARCH, LexicalIndex
+from .matrix_index import MatrixIndex
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Backend degli embedding: "torch" (sentence-transformers su PyTorch, fp32),
+# "onnx" (stesso modello esportato in ONNX, senza PyTorch) oppure "onnx-int8"
+# (pesi quantizzati int8); vedi rag/onnx_embeddings.py
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+
+# Versione del formato dei metadati salvati in Chroma: se cambia, la
+# collezione viene ricostruita (2 = solo comune, service e record_id)
+INDEX_FORMAT = 2
+
+# Embedding e ricerca su Chroma sono bloccanti: vengono eseguiti in un pool
+# di thread limitato per non occupare l'event loop di FastAPI.
+_search_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("VECTOR_SEARCH_WORKERS", "4")),
+    thread_name_prefix="chroma-search",
 )
 
+# Motore di ricerca: "chroma" (filtro sui metadati di Chroma) oppure "matrix"
+# (MatrixIndex, matrici NumPy per comune allineate alla collezione Chroma)
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "chroma")
 
-class ChromaDB:
-    def __init__(self, docs=None, persist_directory="./chroma_data"):
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2"
+# Distanza massima (L2 al quadrato tra embedding normalizzati, o distanza
+# fusa con la ricerca ibrida) per accettare il documento trovato
+SEARCH_MAX_DISTANCE = float(os.getenv("SEARCH_MAX_DISTANCE", "1.15"))
+
+# Documenti per blocco di inserimento durante la sincronizzazione dell'indice
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "256"))
+
+# Micro-batching degli embedding delle query
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5"))
+
+# Embedding già calcolati per il task asyncio corrente (testo -> vettore):
+# le richieste in blocco (rag/batch.py) li calcolano insieme per comune, e
+# durante una richiesta (reuse_embeddings) vi finiscono quelli calcolati
+_precomputed = contextvars.ContextVar("pai_precomputed_embeddings", default=None)
+
+
+def use_precomputed_embeddings(vectors):
+    """aembed_query restituirà questi vettori ({testo: vettore}) nel task corrente."""
+    _precomputed.set(vectors)
+
+
+@contextlib.contextmanager
+def reuse_embeddings():
+    """
+    Nel blocco aembed_query calcola una sola volta l'embedding di ogni
+    testo: router, cache semantica e ricerca condividono lo stesso vettore.
+    """
+    if _precomputed.get() is not None:
+        # Richiesta di un blocco: i vettori precalcolati fanno già da memoria
+        yield
+        return
+    token = _precomputed.set({})
+    try:
+        yield
+    finally:
+        _precomputed.reset(token)
+
+
+class EmbeddingBatcher:
+    """
+    Raccoglie le richieste di embedding di tutte le sessioni e le calcola con
+    un'unica chiamata al modello quando si raggiungono max_batch_size testi o
+    sono trascorsi max_wait_ms dalla prima richiesta in attesa.
+
+    Va usato dall'event loop: embed() restituisce il vettore della singola
+    richiesta tramite un future.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        max_batch_size=EMBEDDING_BATCH_SIZE,
+        max_wait_ms=EMBEDDING_BATCH_WAIT_MS,
+        executor=_search_executor,
+    ):
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self._pending = []
+        self._timer = None
+
+    async def embed(self, text):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        # Testi identici nello stesso batch vengono calcolati una sola volta
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        loop = asyncio.get_running_loop()
+        result = loop.run_in_executor(
+            self.executor, self.embeddings.embed_documents, texts
         )
+
+        def deliver(result):
+            error = result.exception()
+            vectors = None if error else dict(zip(texts, result.result()))
+            for text, future in batch:
+                if future.done():  # richiesta annullata nel frattempo
+                    continue
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(vectors[text])
+
+        result.add_done_callback(deliver)
+
+
+def load_embeddings(backend=EMBEDDING_BACKEND):
+    """Carica il modello di embedding (operazione lenta, da fare una volta)."""
+    if backend == "torch":
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+    if backend in ("onnx", "onnx-int8"):
+        from .onnx_embeddings import OnnxEmbeddings
+
+        return OnnxEmbeddings(EMBEDDING_MODEL, quantized=backend == "onnx-int8")
+    raise ValueError(f"EMBEDDING_BACKEND non valido: {backend}")
+
+
+def embedding_signature(embeddings):
+    """Identifica i vettori prodotti da embeddings (modello e backend)."""
+    return getattr(embeddings, "signature", EMBEDDING_MODEL)
+
+
+def document_id(doc):
+    """Restituisce un ID stabile calcolato dall'hash di contenuto e metadati."""
+    if "record_id" in doc.metadata:
+        return doc.metadata["record_id"]
+    return record_id(doc.page_content, doc.metadata)
+
+
+class ChromaDB:
+    def __init__(
+        self, docs=None, persist_directory="./chroma_data", catalogue=None, embeddings=None
+    ):
+        self.embeddings = embeddings if embeddings is not None else load_embeddings()
         self.setting = chroma_settings(is_persistent=True, anonymized_telemetry=False)
-        if docs is None:
-            self.vectorstore = Chroma(
-                persist_directory=persist_directory,
-                client_settings=self.setting,
-                embedding_function=self.embeddings,
-            )
+        self.manifest_path = os.path.normpath(persist_directory) + ".manifest.json"
+        self.vectorstore = Chroma(
+            persist_directory=persist_directory,
+            client_settings=self.setting,
+            embedding_function=self.embeddings,
+        )
+        self.embedding_batcher = EmbeddingBatcher(self.embeddings)
+        # Schede dei servizi, risolte tramite il record_id salvato in Chroma
+        self.catalogue = catalogue if catalogue is not None else ServiceCatalogue()
+        # ID dei documenti indicizzati e contatore delle modifiche, usati
+        # dalla cache semantica per invalidare le risposte non più valide
+        self.document_ids = set()
+        self.version = 0
+        self.matrix_index = None
+        # Indice BM25 per comune sulle schede indicizzate (ricerca ibrida)
+        self.lexical_index = LexicalIndex() if HYBRID_SEARCH else None
+        # Istantanea che ha sostituito questa dopo un ricaricamento (reload)
+        self.successor = None
+        if docs is not None:
+            self.sync_documents(docs)
         else:
-            self.vectorstore = Chroma.from_documents(
-                documents=docs,
-                embedding=self.embeddings,
-                persist_directory=persist_directory,
-                client_settings=self.setting,
+            stored = self.vectorstore.get(include=["metadatas"])
+            self.document_ids = set(stored["ids"])
+            metrics.known_cities.update(m.get("comune") for m in stored["metadatas"])
+            self.refresh_lexical_index()
+        if VECTOR_INDEX == "matrix":
+            self.matrix_index = MatrixIndex.from_chroma(
+                self.vectorstore, os.path.normpath(persist_directory) + ".matrix"
+            )
+
+    def read_only(self):
+        """
+        Copia che cerca solo nell'indice matriciale e non ha il client
+        Chroma: serve.py la passa ai worker, che non devono usare la
+        connessione SQLite aperta dal processo principale prima della fork.
+        """
+        if self.matrix_index is None:
+            raise ValueError("La copia in sola lettura richiede VECTOR_INDEX=matrix")
+        view = copy.copy(self)
+        view.vectorstore = None
+        view.successor = None
+        return view
+
+    def follow(self, catalogue):
+        """
+        Copia in sola lettura allineata all'indice matriciale su disco, dopo
+        che il processo che lo scrive (il master di serve.py) l'ha
+        sincronizzato. Le schede sono quelle di catalogue, letto dagli
+        stessi documenti. None se l'indice su disco è quello già in uso.
+
+        Raises:
+            ValueError: se l'indice su disco non è leggibile o contiene
+                documenti assenti da catalogue (documenti modificati di nuovo
+                nel frattempo: il prossimo ricaricamento li allineerà)
+        """
+        matrix_index = MatrixIndex(self.matrix_index.directory)
+        if not matrix_index.load():
+            raise ValueError("Indice matriciale su disco assente o in ricostruzione")
+        if matrix_index.fingerprint == self.matrix_index.fingerprint:
+            return None
+        ids = matrix_index.ids()
+        missing = sum(1 for doc_id in ids if catalogue.get(doc_id) is None)
+        if missing:
+            raise ValueError(f"{missing} documenti dell'indice non sono nel catalogo")
+        view = copy.copy(self)
+        view.catalogue = catalogue
+        view.matrix_index = matrix_index
+        view.document_ids = ids
+        view.version = self.version + 1
+        view.successor = None
+        if self.lexical_index is not None:
+            view.lexical_index = LexicalIndex()
+            view.refresh_lexical_index()
+        self.successor = view
+        return view
+
+    def refresh_lexical_index(self):
+        if self.lexical_index is not None:
+            self.lexical_index.build(
+                r for r in self.catalogue.records() if r.id in self.document_ids
+            )
+
+    def has_document(self, doc_id):
+        return doc_id in self.document_ids
+
+    def resolve(self, doc):
+        """Restituisce il ServiceRecord corrispondente a un documento trovato."""
+        record = self.catalogue.get(doc.metadata.get("record_id"))
+        if record is None and self.successor is not None:
+            # Documento inserito da un ricaricamento mentre la ricerca era in corso
+            return self.successor.resolve(doc)
+        if record is None:
+            raise LookupError(f"Documento {document_id(doc)} non presente nel catalogo")
+        return record
+
+    def _as_index_document(self, doc):
+        """
+        Converte un documento con i metadati originali nel formato indicizzato,
+        aggiungendone la scheda al catalogo.
+        """
+        if "record_id" in doc.metadata:
+            return doc
+        record = ServiceRecord.from_raw(
+            doc.page_content, doc.metadata, doc.metadata.get("service")
+        )
+        self.catalogue.add(record)
+        return Document(page_content=record.page_content, metadata=record.index_metadata())
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError:
+            logging.warning(f"Manifest {self.manifest_path} non valido, verrà ricreato.")
+            return {}
+
+    def _save_manifest(self, documents):
+        manifest = {
+            "embedding_model": embedding_signature(self.embeddings),
+            "index_format": INDEX_FORMAT,
+            "documents": documents,
+        }
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def reload(self, docs, catalogue):
+        """
+        Restituisce una nuova istantanea dell'indice allineata a docs, le cui
+        schede finiscono in catalogue, mentre questa resta utilizzabile:
+        condivide la collezione Chroma e il modello, e calcola solo gli
+        embedding dei documenti nuovi o modificati.
+
+        Le ricerche ancora in corso su questa istantanea possono trovare i
+        documenti appena inseriti: resolve() li cerca nel catalogo della
+        nuova, già completo quando vengono inseriti in Chroma (i vettori
+        nuovi sono inseriti prima di eliminare quelli superati).
+
+        Returns:
+            tuple: (nuova istantanea, documenti aggiunti, vettori eliminati)
+        """
+        snapshot = copy.copy(self)
+        snapshot.catalogue = catalogue
+        snapshot.document_ids = set(self.document_ids)
+        snapshot.successor = None
+        if self.lexical_index is not None:
+            snapshot.lexical_index = LexicalIndex()
+        self.successor = snapshot
+        try:
+            added, deleted = snapshot.sync_documents(docs, allow_empty=False)
+        except Exception:
+            self.successor = None
+            raise
+        return snapshot, added, deleted
+
+    def sync_documents(self, docs, batch_size=INDEX_BATCH_SIZE, allow_empty=True):
+        """
+        Allinea la collezione persistita ai documenti forniti, calcolando solo
+        gli embedding dei documenti nuovi o modificati.
+
+        Ogni documento è identificato da document_id(), quindi un file
+        modificato produce un nuovo ID: il vecchio vettore viene eliminato e
+        quello nuovo inserito. I vettori senza un documento corrispondente
+        (file rimossi o duplicati di vecchie esecuzioni) vengono eliminati.
+        Con allow_empty=False, se non viene letto alcun documento (cartella
+        non leggibile) la collezione resta invariata e viene sollevato
+        ValueError.
+
+        docs può essere un generatore: i documenti nuovi sono inseriti a
+        blocchi di batch_size in un thread dedicato mentre si leggono i
+        successivi, quindi in memoria restano al più due blocchi più gli ID.
+
+        Returns:
+            tuple: (numero di documenti aggiunti, numero di vettori eliminati)
+        """
+        try:
+            manifest = self._load_manifest()
+            stored_ids = set(self.vectorstore.get(include=[])["ids"])
+            if stored_ids and (
+                manifest.get("embedding_model") != embedding_signature(self.embeddings)
+                or manifest.get("index_format") != INDEX_FORMAT
+            ):
+                logging.info(
+                    "Modello di embedding o formato cambiato, ricostruzione dell'indice."
+                )
+                self.vectorstore.delete(ids=list(stored_ids))
+                stored_ids = set()
+
+            wanted = {}  # ID -> comune
+            added = 0
+            pending = []
+            in_flight = None
+            with ThreadPoolExecutor(max_workers=1, thread_name_prefix="chroma-index") as writer:
+                for doc in docs:
+                    try:
+                        doc = self._as_index_document(doc)
+                    except InvalidDocument as e:
+                        logging.error(f"Documento scartato: {e}")
+                        continue
+                    doc_id = document_id(doc)
+                    if doc_id in wanted:
+                        continue
+                    wanted[doc_id] = doc.metadata.get("comune")
+                    if doc_id in stored_ids:
+                        continue
+                    pending.append((doc_id, doc))
+                    if len(pending) >= batch_size:
+                        if in_flight is not None:
+                            in_flight.result()
+                        in_flight = self._submit_batch(writer, pending)
+                        added += len(pending)
+                        pending = []
+                if in_flight is not None:
+                    in_flight.result()
+                if pending:
+                    self._submit_batch(writer, pending).result()
+                    added += len(pending)
+
+            if not wanted and not allow_empty:
+                raise ValueError("Nessun documento letto, indice non modificato.")
+            to_delete = [doc_id for doc_id in stored_ids if doc_id not in wanted]
+            if to_delete:
+                self.vectorstore.delete(ids=to_delete)
+                self.version += 1
+            self.document_ids = set(wanted)
+            metrics.known_cities.update(wanted.values())
+            if self.matrix_index is not None and (added or to_delete):
+                self.matrix_index.rebuild_from_chroma(self.vectorstore)
+
+            self.refresh_lexical_index()
+            self._save_manifest(wanted)
+            logging.info(
+                f"Indice sincronizzato: {added} aggiunti, "
+                f"{len(to_delete)} eliminati, {len(wanted) - added} invariati."
             )
+            return added, len(to_delete)
+        except Exception as e:
+            logging.error(f"Errore durante la sincronizzazione dell'indice Chroma: {e}")
+            raise
 
-    def add_to_chroma(self, documents):
+    def _submit_batch(self, writer, pending):
+        ids = [doc_id for doc_id, _ in pending]
+        documents = [doc for _, doc in pending]
+        return writer.submit(self.add_to_chroma, documents, ids, False)
+
+    def add_to_chroma(self, documents, ids=None, refresh_index=True):
         try:
             logging.info("Aggiunta dei documenti al database Chroma...")
+            documents = [self._as_index_document(doc) for doc in documents]
             texts = [doc.page_content for doc in documents]
             metadatas = [doc.metadata for doc in documents]
+            if ids is None:
+                ids = [document_id(doc) for doc in documents]
 
-            # Aggiunge i documenti e i relativi metadati
-            self.vectorstore.add_texts(texts=texts, metadatas=metadatas)
+            # Aggiunge (o aggiorna) i documenti e i relativi metadati
+            self.vectorstore.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+            self.document_ids.update(ids)
+            self.version += 1
+            if refresh_index and self.matrix_index is not None:
+                self.matrix_index.rebuild_from_chroma(self.vectorstore)
+            if refresh_index:
+                self.refresh_lexical_index()
             logging.info(f"Aggiunti {len(documents)} documenti a Chroma.")
         except Exception as e:
             logging.error(f"Errore durante l'aggiunta di documenti a Chroma: {e}")
             raise
 
+    def lexical_search(self, query, comune):
+        """
+        Restituisce (risultati BM25, corrispondenza forte o None); senza
+        ricerca ibrida ([], None).
+        """
+        if self.lexical_index is None:
+            return [], None
+        hits = self.lexical_index.search(query, comune, HYBRID_CANDIDATES)
+        return hits, self.lexical_index.strong_hit(query, hits)
+
     def get_from_chroma(self, query, comune="roma"):
+        hits, strong = self.lexical_search(query, comune)
+        if strong is not None:
+            return [(strong[0], 0.0)]
+        return self.get_from_chroma_by_vector(
+            self.embeddings.embed_query(query), comune, hits
+        )
+
+    def _dense_search(self, embedding, comune, k):
+        if self.matrix_index is not None:
+            return self.matrix_index.search(embedding, comune, k=k)
+        return self.vectorstore.similarity_search_by_vector_with_relevance_scores(
+            embedding, k=k, filter={"comune": comune}
+        )
+
+    def get_from_chroma_by_vector(self, embedding, comune="roma", lexical_hits=None):
+        """
+        Cerca il documento più vicino del comune; con lexical_hits (risultati
+        BM25 della stessa richiesta) combina le due classifiche.
+        """
         try:
-            logging.info("Esecuzione della ricerca su Chroma...")
-            results = self.vectorstore.similarity_search_with_score(
-                query, k=1, filter={"comune": comune}
-            )
+            logging.debug("Esecuzione della ricerca su Chroma...")
+            if lexical_hits:
+                dense = self._dense_search(embedding, comune, HYBRID_CANDIDATES)
+                results = self.lexical_index.fuse(dense, lexical_hits)[:1]
+            else:
+                results = self._dense_search(embedding, comune, 1)
 
-            logging.info("Ricerca completata con successo.")
-            filtered_results = [(doc, score) for doc, score in results if score <= 1.15]
-            logging.info("Risultati: %s", results)
+            filtered_results = [
+                (doc, score) for doc, score in results if score <= SEARCH_MAX_DISTANCE
+            ]
+            logging.debug("Risultati: %s", results)
 
             if filtered_results:
-                logging.info("Risultato trovato con score <= 0.2.")
+                logging.info(
+                    "Risultato trovato: %s (distanza %.3f)",
+                    document_id(filtered_results[0][0]),
+                    filtered_results[0][1],
+                )
                 return filtered_results
             else:
                 logging.info("Nessun risultato soddisfa i criteri di similarità.")
                 return None
 
         except Exception as e:
-            logging.error(f"Errore durante l'elaborazione della query: {e}")
+            logging.error("Errore durante l'elaborazione della query: %s", e)
             raise
+
+    async def aembed_query(self, query):
+        """Calcola l'embedding di una query tramite il servizio di batching."""
+        vectors = _precomputed.get()
+        if vectors is not None and query in vectors:
+            return vectors[query]
+        vector = await self.embedding_batcher.embed(query)
+        if vectors is not None:
+            vectors[query] = vector
+        return vector
+
+    async def aembed_documents(self, texts):
+        """Embedding di più testi con un'unica chiamata, nel pool di ricerca."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _search_executor, self.embeddings.embed_documents, list(texts)
+        )
+
+    async def aget_from_chroma(self, query, comune="roma"):
+        """
+        Versione asincrona di get_from_chroma, eseguita nel pool di ricerca.
+        Con una corrispondenza lessicale forte l'embedding non viene calcolato.
+        """
+        with metrics.stage("lexical_search"):
+            hits, strong = self.lexical_search(query, comune)
+        if strong is not None:
+            logging.info("Corrispondenza lessicale forte, embedding non calcolato.")
+            metrics.RETRIEVAL_PATH.labels("lexical").inc()
+            return [(strong[0], 0.0)]
+        metrics.RETRIEVAL_PATH.labels("hybrid" if hits else "dense").inc()
+
+        with metrics.stage("embedding"):
+            embedding = await self.aembed_query(query)
+        loop = asyncio.get_running_loop()
+        with metrics.stage("search"):
+            return await loop.run_in_executor(
+                _search_executor, self.get_from_chroma_by_vector, embedding, comune, hits
+            )
@@ -0,0 +1,209 @@
+"""
+Serve the app with several worker processes that share the embedding model,
+the service catalogue and the vector index.
+
+`uvicorn --workers N` starts every worker with a fresh interpreter, so each
+one loads its own model and index and memory grows linearly with N. Here the
+master imports main.py once (model, catalogue, index sync) and then forks the
+workers: the model weights and the Python objects are shared copy-on-write,
+and the memory-mapped matrix index is shared through the page cache.
+
+Usage (from the backend directory):
+    python serve.py --workers 4 --port 8000
+
+Notes:
+- VECTOR_INDEX must be "matrix" (the default here): workers search the
+  read-only mmap snapshot and never get the master's Chroma client, whose
+  SQLite connection must not be used across a fork.
+- OMP_NUM_THREADS / MKL_NUM_THREADS default to 1: parallelism comes from the
+  workers, and the master never forks while an OpenMP pool is running.
+- Prometheus metrics are aggregated across workers through
+  PROMETHEUS_MULTIPROC_DIR (a temporary directory unless already set).
+- Per-process resources (LLM client, booking and session stores) are opened
+  by the lifespan handler, i.e. in each worker after the fork.
+- Documents are reloaded by the master (on SIGHUP, which POST /admin/reload
+  sends from any worker, or every RELOAD_INTERVAL seconds when they changed):
+  it syncs the index once and sends SIGUSR1 to the workers, which read the
+  documents again and reopen the rewritten matrix index in place
+  (main.follow_reload). No worker is restarted, so websocket connections and
+  the sessions held in memory survive the reload.
+
+benchmarks/worker_memory.py measures the memory used per extra worker in
+this mode and with `uvicorn --workers`.
+"""
+
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("VECTOR_INDEX", "matrix")
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="pai-metrics-")
+
+import uvicorn
+from prometheus_client import multiprocess
+
+logger = logging.getLogger("serve")
+
+
+def bind_socket(host, port):
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock, log_level):
+    """Body of a forked worker: serves the preloaded app on the shared socket."""
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    config = uvicorn.Config(app, log_level=log_level, lifespan="on")
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def spawn_worker(app, sock, log_level):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(app, sock, log_level)
+        finally:
+            # os._exit skips atexit: write the log records still queued
+            from rag.log_config import stop_logging
+
+            stop_logging()
+            os._exit(0)
+    logger.info(f"Started worker {pid}")
+    return pid
+
+
+class DocumentWatcher:
+    """RELOAD_INTERVAL check run by the master, like main.watch_documents."""
+
+    def __init__(self, directory, interval):
+        from init_db import documents_state
+
+        self.state = documents_state
+        self.directory = directory
+        self.interval = interval
+        self.loaded = self.previous = documents_state(directory)
+        self.next_check = time.monotonic() + interval
+
+    def changed(self):
+        """True once a change has been stable for a whole interval."""
+        if time.monotonic() < self.next_check:
+            return False
+        self.next_check = time.monotonic() + self.interval
+        state = self.state(self.directory)
+        stable = state != self.loaded and state == self.previous
+        if stable:
+            self.loaded = state
+        self.previous = state
+        return stable
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "2"))
+    )
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    sock = bind_socket(args.host, args.port)
+
+    # Preload: model, catalogue and index are loaded once, in the master
+    import main as application
+
+    application.preload()
+    application.supervisor_pid = os.getpid()
+    app = application.app
+
+    # Move every object loaded so far out of the garbage collector's reach,
+    # so collections in the workers don't write to (and un-share) their pages
+    gc.collect()
+    gc.freeze()
+
+    workers = {}  # pid -> start time
+    stopping = False
+    reload_requested = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            os.kill(pid, signal.SIGTERM)
+
+    def request_reload(signum, frame):
+        nonlocal reload_requested
+        reload_requested = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, request_reload)
+    # Inherited by the workers until their lifespan installs the handler:
+    # the default action would kill a worker still starting up
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    watcher = None
+    if application.RELOAD_INTERVAL > 0:
+        watcher = DocumentWatcher(application.DOCUMENTS_DIR, application.RELOAD_INTERVAL)
+
+    for _ in range(args.workers):
+        workers[spawn_worker(app, sock, args.log_level)] = time.monotonic()
+
+    # Supervise: restart workers that die and reload the documents, until
+    # asked to stop
+    while workers:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            started = workers.pop(pid, None)
+            multiprocess.mark_process_dead(pid)
+            if not stopping and started is not None:
+                logger.warning(f"Worker {pid} exited with status {status}, restarting")
+                # Don't spin when workers fail at startup
+                if time.monotonic() - started < 5:
+                    time.sleep(1)
+                workers[spawn_worker(app, sock, args.log_level)] = time.monotonic()
+            continue
+        if stopping:
+            time.sleep(0.2)
+            continue
+
+        if watcher is not None and watcher.changed():
+            reload_requested = True
+        if reload_requested:
+            reload_requested = False
+            try:
+                application.reload_preloaded()
+            except Exception:
+                logger.exception("Document reload failed, workers keep the previous snapshot")
+            else:
+                # Workers forked from now on inherit the new snapshot frozen
+                gc.collect()
+                gc.freeze()
+                for pid in workers:
+                    os.kill(pid, signal.SIGUSR1)
+        time.sleep(0.2)
+
+    sock.close()
+    logger.info("All workers stopped")
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
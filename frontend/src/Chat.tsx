@@ -19,6 +19,7 @@ interface Message {
   text: string;
   sender: 'user' | 'bot';
   data_ora?: { [key: string]: string[] };
+  streaming?: boolean;
 }
 
 export const Chat: FC = () => {
@@ -45,7 +46,13 @@ export const Chat: FC = () => {
   const [hoveredButton, setHoveredButton] = useState<string | null>(null);
 
   useEffect(() => {
-    const ws = new WebSocket(`ws${window.location.protocol === 'https:' ? 's' : ''}://${window.location.host}/ws`);
+    // Riprende la sessione precedente (e la sua cronologia) dopo una riconnessione
+    const saved = sessionStorage.getItem('pai_session');
+    const session = saved ? JSON.parse(saved) : null;
+    const query = session
+      ? `?session_id=${encodeURIComponent(session.id)}&resume_token=${encodeURIComponent(session.resume_token)}`
+      : '';
+    const ws = new WebSocket(`ws${window.location.protocol === 'https:' ? 's' : ''}://${window.location.host}/ws${query}`);
 
     ws.onopen = () => {
       console.log('Connected to WebSocket');
@@ -55,15 +62,62 @@ export const Chat: FC = () => {
     ws.onmessage = (event: MessageEvent) => {
       const data = JSON.parse(event.data);
 
-      setMessages((prev: Message[]) => [
-        ...prev,
-        {
-          id: prev.length,
-          text: data.message.llm_response.info,
-          sender: 'bot',
-          data_ora: data.message.response
-        }
-      ]);
+      if (data.session) {
+        sessionStorage.setItem('pai_session', JSON.stringify(data.session));
+      }
+
+      // Frammento della risposta in streaming: lo accoda al messaggio in corso
+      if (data.type === 'delta') {
+        setMessages((prev: Message[]) => {
+          const last = prev[prev.length - 1];
+          if (last && last.streaming) {
+            return [...prev.slice(0, -1), { ...last, text: last.text + data.message.info }];
+          }
+          return [...prev, { id: prev.length, text: data.message.info, sender: 'bot', streaming: true }];
+        });
+        setIsTyping(false);
+        return;
+      }
+
+      // Server occupato: il messaggio non è stato elaborato
+      if (data.type === 'busy') {
+        setMessages((prev: Message[]) => [
+          ...prev,
+          {
+            id: prev.length,
+            text: `Il servizio è momentaneamente occupato, riprova tra ${Math.ceil(data.retry_after)} secondi.`,
+            sender: 'bot'
+          }
+        ]);
+        setIsTyping(false);
+        return;
+      }
+
+      // Messaggio di sistema (servizio in avvio, errore): solo testo
+      if (typeof data.message === 'string') {
+        setMessages((prev: Message[]) => {
+          const last = prev[prev.length - 1];
+          const base = last && last.streaming ? prev.slice(0, -1) : prev;
+          return [...base, { id: base.length, text: data.message, sender: 'bot' }];
+        });
+        setIsTyping(false);
+        return;
+      }
+
+      // Risposta completa: sostituisce l'eventuale messaggio in streaming
+      setMessages((prev: Message[]) => {
+        const last = prev[prev.length - 1];
+        const base = last && last.streaming ? prev.slice(0, -1) : prev;
+        return [
+          ...base,
+          {
+            id: base.length,
+            text: data.message.llm_response.info,
+            sender: 'bot',
+            data_ora: data.message.response
+          }
+        ];
+      });
 
       setIsTyping(false);
     };
@@ -103,7 +157,7 @@ export const Chat: FC = () => {
     };
 
     setMessages((prev: Message[]) => [...prev, userMessage]);
-    socketRef.current?.send(JSON.stringify({ message: inputValue, city: selectedCity }));
+    socketRef.current?.send(JSON.stringify({ message: inputValue, city: selectedCity, stream: true }));
     setInputValue('');
     setIsTyping(true);
   };